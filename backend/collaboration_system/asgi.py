@@ -12,6 +12,7 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 import mindmaps.routing
+from mindmaps.lifespan import LifespanApp
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'collaboration_system.settings')
 
@@ -22,4 +23,5 @@ application = ProtocolTypeRouter({
             mindmaps.routing.websocket_urlpatterns
         )
     ),
+    "lifespan": LifespanApp(),
 })
@@ -56,6 +56,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'mindmaps.profiling.ProfilerMiddleware',
+    'mindmaps.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'collaboration_system.urls'
@@ -79,6 +81,13 @@ WSGI_APPLICATION = 'collaboration_system.wsgi.application'
 ASGI_APPLICATION = 'collaboration_system.asgi.application'
 
 # Channels
+# 单进程部署可以改用进程内通道层，广播直接投递到各连接的队列，不经过 Redis：
+# CHANNEL_LAYERS = {
+#     'default': {
+#         'BACKEND': 'mindmaps.layers.FastInMemoryChannelLayer',
+#         'CONFIG': {'capacity': 500},
+#     },
+# }
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -141,6 +150,70 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# 编辑日志归档
+EDIT_LOG_ARCHIVE_ROOT = BASE_DIR / 'archives' / 'edit_logs'
+EDIT_LOG_RETENTION_DAYS = 180
+# 每隔多少条差异日志写入一次节点完整快照
+EDIT_LOG_SNAPSHOT_INTERVAL = 20
+
+# 思维导图检查点：每累计多少条编辑或间隔多少小时创建一次
+MAP_CHECKPOINT_EVERY_EDITS = 500
+MAP_CHECKPOINT_INTERVAL_HOURS = 24
+# 近 keep_all_days 天全部保留，daily_days 天内每天保留一个，更早的每月保留一个
+MAP_CHECKPOINT_RETENTION = {
+    'keep_all_days': 7,
+    'daily_days': 90,
+}
+
+# 协作房间分片：房间组按一致性哈希分布到这些通道层（CHANNEL_LAYERS 中的别名）上。
+# 增加分片时把原来的列表填到 MINDMAP_ROOM_SHARDS_PREVIOUS，迁移期间广播同时发往新旧分片，
+# 迁移前建立的连接全部断开后再清空
+MINDMAP_ROOM_SHARDS = ['default']
+MINDMAP_ROOM_SHARDS_PREVIOUS = []
+
+# 协作光标每秒最多广播/推送的次数
+MINDMAP_CURSOR_FLUSH_HZ = 20
+
+# 协作房间在线状态：存放在 Redis 有序集合中（设为 None 时使用进程内存储）；
+# 超过 MINDMAP_PRESENCE_TTL 秒没有心跳的连接视为离线
+MINDMAP_PRESENCE_REDIS_URL = 'redis://127.0.0.1:6379/1'
+MINDMAP_PRESENCE_TTL = 60
+
+# 协作房间事件日志：每个房间保留最近多少条带序号的修改事件，供断线重连的客户端补发；
+# 存放在 Redis 中（设为 None 时使用进程内存储）
+MINDMAP_EVENT_LOG_REDIS_URL = 'redis://127.0.0.1:6379/1'
+MINDMAP_EVENT_LOG_SIZE = 1000
+
+# 协商使用 MessagePack 协议的 WebSocket 连接，超过该字节数的消息会用 zlib 压缩
+MINDMAP_WS_COMPRESS_MIN_BYTES = 1024
+# 客户端发来的压缩帧解压后的最大字节数，超过时拒绝该帧
+MINDMAP_WS_MAX_FRAME_BYTES = 1024 * 1024
+
+# 每个 WebSocket 连接发送队列的上限，客户端跟不上时丢弃积压的房间事件并改发快照
+MINDMAP_WS_QUEUE_LIMIT = 200
+
+# 节点文本协同编辑：停止输入多少秒后写回数据库，持续输入时最长多少秒写回一次；
+# 每个文档在内存中保留的历史操作条数
+MINDMAP_TEXT_FLUSH_DELAY = 2
+MINDMAP_TEXT_FLUSH_MAX_DELAY = 10
+MINDMAP_TEXT_HISTORY_SIZE = 200
+
+# node_update 的数据库写入：停止修改多少秒后写回，持续修改时最长多少秒写回一次
+MINDMAP_NODE_WRITE_DELAY = 1
+MINDMAP_NODE_WRITE_MAX_DELAY = 5
+
+# 请求分析（mindmaps.profiling.ProfilerMiddleware）：管理员（会话登录）带该请求头的请求，或按比例随机抽取的请求
+# 记录查询次数、重复查询、SQL 和视图耗时，最近的样本由 /api/mindmaps/request-profiles/ 查看
+MINDMAP_PROFILE_HEADER = 'X-Mindmap-Profile'
+MINDMAP_PROFILE_SAMPLE_RATE = 0
+MINDMAP_PROFILE_BUFFER_SIZE = 200
+
+# 监控指标（mindmaps.metrics）：/metrics 允许管理员、带 Authorization: Bearer <MINDMAP_METRICS_TOKEN>
+# 的请求和 MINDMAP_METRICS_ALLOWED_IPS 中的地址访问。部署在 nginx、daphne 等反向代理之后时
+# 所有请求的 REMOTE_ADDR 都是代理地址，不要把 127.0.0.1 加入列表，应使用令牌
+MINDMAP_METRICS_TOKEN = None
+MINDMAP_METRICS_ALLOWED_IPS = []
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -188,6 +261,7 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'x-mindmap-profile',
 ]
 
 # 允许的请求方法
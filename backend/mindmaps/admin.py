@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import MindMapNode, NodeEditLog, NodeAttachment, NodeImage, AssociativeLine, NodeTag, NodeGeneralization
+from .models import MindMapNode, NodeEditLog, EditLogArchive, MapCheckpoint, NodeAttachment, NodeImage, AssociativeLine, NodeTag, NodeGeneralization, NodeEntity
 
 @admin.register(MindMapNode)
 class MindMapNodeAdmin(admin.ModelAdmin):
@@ -13,10 +13,37 @@ class MindMapNodeAdmin(admin.ModelAdmin):
 
 @admin.register(NodeEditLog)
 class NodeEditLogAdmin(admin.ModelAdmin):
-    list_display = ['node', 'user', 'action', 'timestamp']
+    list_display = ['node_uid', 'project', 'user', 'action', 'timestamp']
     list_filter = ['action', 'timestamp']
-    search_fields = ['node__text', 'user__real_name', 'user__username']
+    search_fields = ['node_uid', 'user__real_name', 'user__username']
     readonly_fields = ['timestamp']
+    raw_id_fields = ['node', 'project', 'user']
+    list_select_related = ['project', 'user']
+    # 日志表很大，避免每次列表页都做全表计数
+    show_full_result_count = False
+
+@admin.register(EditLogArchive)
+class EditLogArchiveAdmin(admin.ModelAdmin):
+    list_display = ['project', 'month', 'entry_count', 'file_size', 'first_timestamp', 'last_timestamp']
+    list_filter = ['month']
+    search_fields = ['project__name', 'project__case_number']
+    readonly_fields = [
+        'file_path', 'entry_count', 'file_size', 'first_timestamp', 'first_log_id',
+        'last_timestamp', 'last_log_id', 'created_at', 'updated_at'
+    ]
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('project')
+
+@admin.register(MapCheckpoint)
+class MapCheckpointAdmin(admin.ModelAdmin):
+    list_display = ['project', 'last_log_timestamp', 'node_count', 'data_size', 'created_at']
+    search_fields = ['project__name', 'project__case_number']
+    readonly_fields = ['last_log_id', 'last_log_timestamp', 'node_count', 'data_size', 'created_at']
+    exclude = ['data']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('project').defer('data')
 
 @admin.register(NodeAttachment)
 class NodeAttachmentAdmin(admin.ModelAdmin):
@@ -58,13 +85,13 @@ class AssociativeLineAdmin(admin.ModelAdmin):
 
 @admin.register(NodeTag)
 class NodeTagAdmin(admin.ModelAdmin):
-    list_display = ['text', 'node', 'sort_order', 'created_at']
+    list_display = ['text', 'project', 'node', 'sort_order', 'created_at']
     list_filter = ['created_at']
-    search_fields = ['text', 'node__text']
+    search_fields = ['text', 'node__text', 'project__name']
     ordering = ['node', 'sort_order']
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('node')
+        return super().get_queryset(request).select_related('project', 'node')
 
 @admin.register(NodeGeneralization)
 class NodeGeneralizationAdmin(admin.ModelAdmin):
@@ -75,3 +102,12 @@ class NodeGeneralizationAdmin(admin.ModelAdmin):
     
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('node')
+
+@admin.register(NodeEntity)
+class NodeEntityAdmin(admin.ModelAdmin):
+    list_display = ['value', 'kind', 'project', 'node']
+    list_filter = ['kind']
+    search_fields = ['value', 'project__name', 'project__case_number']
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('project', 'node')
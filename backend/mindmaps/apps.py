@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class MindmapsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mindmaps'
+
+    def ready(self):
+        # 注册监控指标，并在数据库连接建立时安装查询计数
+        from . import metrics  # noqa: F401
+        # 注册全文检索索引的信号处理器
+        from . import search  # noqa: F401
+        # 注册实体索引的信号处理器
+        from . import entities  # noqa: F401
+        # 注册标签索引的信号处理器
+        from . import tags  # noqa: F401
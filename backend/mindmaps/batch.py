@@ -0,0 +1,296 @@
+"""思维导图批量操作
+
+WebSocket 的 batch 消息一次提交多个 node_create / node_update / node_delete 操作。
+整批在一个事务中按 创建 → 更新 → 删除 的顺序批量写入，编辑日志也一次写入；
+任何一个操作不合法则整批回滚。
+
+更新操作可以带上所基于的版本号 version：与读取到的版本不一致，或写入时发现
+读取之后被其他请求修改过（写入后的版本号不是读取时加一），都按冲突整批回滚。
+"""
+import os
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import MindMapNode, NodeEditLog, NodeImage, NodeAttachment, generate_node_id, nodes_saved
+
+MAX_BATCH_OPERATIONS = 500
+
+# 批量更新允许修改的字段
+UPDATABLE_FIELDS = set(MindMapNode.STATE_FIELDS)
+
+
+class BatchError(Exception):
+    """批量操作不合法，index 为出错操作在批次中的序号"""
+
+    def __init__(self, index, message):
+        super().__init__(message)
+        self.index = index
+        self.message = message
+
+
+class BatchConflict(BatchError):
+    """更新的节点已被他人修改，node 为回滚后节点的当前状态（已删除时为 None）"""
+
+    def __init__(self, index, node_uid):
+        super().__init__(index, f'节点已被他人修改: {node_uid}')
+        self.node_uid = node_uid
+        self.node = None
+
+
+def _split_operations(operations, can_edit):
+    """校验并按类型拆分操作，保留各自在批次中的序号"""
+    creates, updates, deletes = [], [], []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            raise BatchError(index, '操作格式错误')
+        operation_type = operation.get('type')
+        if operation_type == 'node_create':
+            creates.append((index, operation))
+        elif operation_type == 'node_update':
+            updates.append((index, operation))
+        elif operation_type == 'node_delete':
+            deletes.append((index, operation))
+        else:
+            raise BatchError(index, f'不支持的操作类型: {operation_type}')
+
+        if operation_type != 'node_delete' and not can_edit:
+            raise BatchError(index, '没有编辑权限')
+    return creates, updates, deletes
+
+
+def _load_nodes(project_id, creates, updates, deletes):
+    """一次查询加载批次涉及的已有节点"""
+    uids = set()
+    for _, operation in creates:
+        if operation.get('parent_id'):
+            uids.add(operation['parent_id'])
+    for _, operation in updates:
+        uids.add(operation.get('node_id'))
+        parent_uid = (operation.get('updates') or {}).get('parent_node_uid')
+        if parent_uid:
+            uids.add(parent_uid)
+    for _, operation in deletes:
+        uids.add(operation.get('node_id'))
+    uids.discard(None)
+
+    nodes = MindMapNode.objects.filter(
+        project_id=project_id,
+        node_id__in=uids
+    ).select_related('creator')
+    return {node.node_id: node for node in nodes}
+
+
+def _build_created_nodes(project_id, user, creates, nodes):
+    created = []
+    for index, operation in creates:
+        node_data = operation.get('node_data') or {}
+        parent_id = operation.get('parent_id')
+        parent = None
+        if parent_id:
+            parent = nodes.get(parent_id)
+            if parent is None:
+                raise BatchError(index, f'父节点不存在: {parent_id}')
+
+        node = MindMapNode(
+            project_id=project_id,
+            node_id=node_data.get('uid') or generate_node_id(),
+            parent_node_uid=parent_id or '',
+            creator=user,
+            text=node_data.get('text', ''),
+            rich_text=node_data.get('rich_text', False),
+            expand=node_data.get('expand', True),
+            icon=node_data.get('icon', []),
+            hyperlink=node_data.get('hyperlink', ''),
+            hyperlink_title=node_data.get('hyperlink_title', ''),
+            note=node_data.get('note', ''),
+            tags=node_data.get('tags', []),
+            level=parent.level + 1 if parent else 0
+        )
+        if node.node_id in nodes:
+            raise BatchError(index, f'节点已存在: {node.node_id}')
+        nodes[node.node_id] = node
+        created.append((index, node))
+
+    # 节点UID全局唯一，其他案件中已存在的UID也不能使用
+    index_by_uid = {node.node_id: index for index, node in created}
+    duplicate = MindMapNode.objects.filter(
+        node_id__in=list(index_by_uid)
+    ).values_list('node_id', flat=True).first()
+    if duplicate:
+        raise BatchError(index_by_uid[duplicate], f'节点已存在: {duplicate}')
+    return [node for _, node in created]
+
+
+def _apply_updates(user, updates, nodes):
+    """修改节点字段，返回 ({uid: 节点}, {uid: 修改前状态}, {uid: 读取时的版本号}, 修改过的字段)"""
+    updated = {}
+    old_states = {}
+    versions = {}
+    changed_fields = set()
+    for index, operation in updates:
+        node = nodes.get(operation.get('node_id'))
+        if node is None:
+            raise BatchError(index, f"节点不存在: {operation.get('node_id')}")
+        # 与单条更新一致，只能修改自己创建的节点
+        if node.creator_id != user.id:
+            raise BatchError(index, f'无权限修改节点: {node.node_id}')
+
+        fields = operation.get('updates') or {}
+        unknown = set(fields) - UPDATABLE_FIELDS
+        if unknown:
+            raise BatchError(index, f"不支持修改字段: {', '.join(sorted(unknown))}")
+
+        if node.node_id not in old_states:
+            old_states[node.node_id] = node.get_state()
+            versions[node.node_id] = node.version
+        version = operation.get('version')
+        if version is not None:
+            if not isinstance(version, int):
+                raise BatchError(index, 'version必须是整数')
+            if version != versions[node.node_id]:
+                raise BatchConflict(index, node.node_id)
+
+        parent_uid = fields.get('parent_node_uid')
+        if 'parent_node_uid' in fields and parent_uid != node.parent_node_uid:
+            parent = nodes.get(parent_uid) if parent_uid else None
+            if parent_uid and parent is None:
+                raise BatchError(index, f'父节点不存在: {parent_uid}')
+            node.level = parent.level + 1 if parent else 0
+
+        for field, value in fields.items():
+            setattr(node, field, value)
+        changed_fields.update(fields)
+        updated[node.node_id] = node
+    return updated, old_states, versions, changed_fields
+
+
+def _check_versions(updates, updated, versions):
+    """读回写入后的版本号，不是读取时加一说明期间被其他请求修改过"""
+    index_by_uid = {}
+    for index, operation in updates:
+        index_by_uid.setdefault(operation.get('node_id'), index)
+    written = MindMapNode.objects.filter(
+        id__in=[node.id for node in updated.values()]
+    ).values_list('node_id', 'version')
+    for uid, version in written:
+        if version != versions[uid] + 1:
+            raise BatchConflict(index_by_uid[uid], uid)
+        updated[uid].version = version
+
+
+def _collect_deletes(project_id, user, deletes, nodes):
+    to_delete = {}
+    index_by_uid = {}
+    for index, operation in deletes:
+        node = nodes.get(operation.get('node_id'))
+        if node is None:
+            raise BatchError(index, f"节点不存在: {operation.get('node_id')}")
+        if node.is_system_default or node.is_root or node.creator_id != user.id:
+            raise BatchError(index, f'无权限删除节点: {node.node_id}')
+        to_delete[node.node_id] = node
+        index_by_uid.setdefault(node.node_id, index)
+
+    if to_delete:
+        # 子节点也在本批次中删除时允许删除父节点
+        blocking = MindMapNode.objects.filter(
+            project_id=project_id,
+            parent_node_uid__in=list(to_delete)
+        ).exclude(node_id__in=list(to_delete)).values_list('parent_node_uid', flat=True).first()
+        if blocking:
+            raise BatchError(index_by_uid[blocking], f'节点存在子节点，不能删除: {blocking}')
+    return to_delete
+
+
+def apply_node_batch(project_id, user, operations, can_edit):
+    """在一个事务中应用一批节点操作
+
+    Args:
+        operations: 与单条消息格式相同的 node_create / node_update / node_delete 操作列表
+        can_edit: 用户是否有编辑权限（创建和更新需要）
+
+    Returns:
+        dict: {'created': [节点], 'updated': [节点], 'deleted': [节点UID]}，
+              本批次中创建又删除的节点不出现在结果中
+
+    Raises:
+        BatchError: 任一操作不合法，整批回滚
+        BatchConflict: 更新的节点已被他人修改，整批回滚
+    """
+    creates, updates, deletes = _split_operations(operations, can_edit)
+
+    try:
+        created, updated, to_delete = _write_batch(project_id, user, creates, updates, deletes)
+    except BatchConflict as e:
+        e.node = MindMapNode.objects.select_related('creator').filter(
+            project_id=project_id,
+            node_id=e.node_uid
+        ).first()
+        raise
+
+    created_uids = {node.node_id for node in created}
+    return {
+        'created': [node for node in created if node.node_id not in to_delete],
+        'updated': [
+            node for uid, node in updated.items()
+            if uid not in to_delete and uid not in created_uids
+        ],
+        'deleted': [uid for uid in to_delete if uid not in created_uids],
+    }
+
+
+def _remove_files(paths):
+    """删除已删除节点的图片和附件文件；事务回滚时记录恢复，文件也保留"""
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _write_batch(project_id, user, creates, updates, deletes):
+    """在一个事务中写入，返回 (创建的节点, {uid: 更新的节点}, {uid: 删除的节点})"""
+    with transaction.atomic():
+        nodes = _load_nodes(project_id, creates, updates, deletes)
+        created = _build_created_nodes(project_id, user, creates, nodes)
+        if created:
+            MindMapNode.objects.bulk_create(created)
+            nodes_saved.send(sender=MindMapNode, nodes=created, fields=None)
+
+        updated, old_states, versions, changed_fields = _apply_updates(user, updates, nodes)
+        if updated:
+            now = timezone.now()
+            for node in updated.values():
+                node.updated_at = now
+                node.version = F('version') + 1
+            MindMapNode.objects.bulk_update(
+                list(updated.values()),
+                sorted(changed_fields | {'level', 'updated_at', 'version'})
+            )
+            _check_versions(updates, updated, versions)
+            nodes_saved.send(sender=MindMapNode, nodes=list(updated.values()), fields=changed_fields)
+
+        to_delete = _collect_deletes(project_id, user, deletes, nodes)
+
+        # 删除前写日志，删除日志需要节点的完整状态
+        entries = [(node, 'create', None) for node in created]
+        for uid, node in updated.items():
+            old_state = old_states[uid]
+            action = 'move' if old_state['parent_node_uid'] != node.parent_node_uid else 'update'
+            entries.append((node, action, old_state))
+        entries.extend((node, 'delete', None) for node in to_delete.values())
+        NodeEditLog.record_many(user, entries)
+
+        if to_delete:
+            delete_ids = [node.id for node in to_delete.values()]
+            # 图片和附件记录随节点级联删除，文件在事务提交后再删除
+            file_paths = [
+                item.file.path
+                for model in (NodeImage, NodeAttachment)
+                for item in model.objects.filter(node_id__in=delete_ids)
+                if item.file
+            ]
+            MindMapNode.objects.filter(id__in=delete_ids).delete()
+            if file_paths:
+                transaction.on_commit(lambda: _remove_files(file_paths))
+
+    return created, updated, to_delete
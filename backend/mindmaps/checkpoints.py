@@ -0,0 +1,141 @@
+"""思维导图检查点的创建与保留策略
+
+检查点在以下任一条件满足时创建：
+- 距上一个检查点已累计 MAP_CHECKPOINT_EVERY_EDITS 条编辑日志；
+- 距上一个检查点已超过 MAP_CHECKPOINT_INTERVAL_HOURS 小时，且期间有编辑。
+
+旧检查点按 MAP_CHECKPOINT_RETENTION 逐级稀疏化：近期全部保留，
+之后每天保留一个，更早的每月保留一个。最新的检查点始终保留。
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from projects.models import Project
+from .models import NodeEditLog, MapCheckpoint
+from .pagination import keyset_after
+
+DEFAULT_RETENTION = {
+    'keep_all_days': 7,
+    'daily_days': 90,
+}
+
+
+def get_edits_threshold():
+    return getattr(settings, 'MAP_CHECKPOINT_EVERY_EDITS', 500)
+
+
+def get_interval():
+    return timedelta(hours=getattr(settings, 'MAP_CHECKPOINT_INTERVAL_HOURS', 24))
+
+
+def get_retention():
+    retention = dict(DEFAULT_RETENTION)
+    retention.update(getattr(settings, 'MAP_CHECKPOINT_RETENTION', {}))
+    return retention
+
+
+def latest_checkpoint(project):
+    """案件最新的检查点（不加载数据）；project 可以是案件对象或ID"""
+    return MapCheckpoint.objects.filter(project=project).defer('data').order_by(
+        '-last_log_timestamp', '-last_log_id'
+    ).first()
+
+
+def edits_since(project, checkpoint):
+    """上一个检查点之后的编辑日志条数"""
+    logs = NodeEditLog.objects.filter(project=project)
+    if checkpoint is not None:
+        logs = logs.filter(keyset_after((checkpoint.last_log_timestamp, checkpoint.last_log_id)))
+    return logs.count()
+
+
+def checkpoint_due(project, now=None):
+    """判断案件是否需要创建新的检查点"""
+    now = now or timezone.now()
+    checkpoint = latest_checkpoint(project)
+    edits = edits_since(project, checkpoint)
+    if checkpoint is None:
+        return edits > 0 or project.nodes.exists()
+    if edits >= get_edits_threshold():
+        return True
+    return edits > 0 and now - checkpoint.created_at >= get_interval()
+
+
+def create_checkpoint_if_due(project, force=False):
+    """按策略创建检查点，返回新检查点或 None"""
+    if not force and not checkpoint_due(project):
+        return None
+    _reset_edit_counter(project.id)
+    return MapCheckpoint.create_for_project(project)
+
+
+def _edit_counter_key(project_id):
+    return f'mindmap_checkpoint_edits:{project_id}'
+
+
+def _reset_edit_counter(project_id):
+    cache.set(_edit_counter_key(project_id), 0, None)
+
+
+def note_edit(project_id, count=1):
+    """记录编辑次数，累计达到阈值时立即创建检查点
+
+    计数保存在缓存中，只用于及时触发；是否真正需要创建以数据库中的日志条数为准，
+    多进程下各自计数也不会重复创建。
+    """
+    key = _edit_counter_key(project_id)
+    try:
+        count = cache.incr(key, count)
+    except ValueError:
+        cache.set(key, count, None)
+    if count < get_edits_threshold():
+        return None
+    _reset_edit_counter(project_id)
+    if edits_since(project_id, latest_checkpoint(project_id)) < get_edits_threshold():
+        return None
+    return MapCheckpoint.create_for_project(Project.objects.get(id=project_id))
+
+
+def select_checkpoints_to_prune(checkpoints, now=None, retention=None):
+    """按保留策略挑选需要删除的检查点
+
+    Args:
+        checkpoints: 同一案件的检查点，按时间倒序排列
+    """
+    now = now or timezone.now()
+    retention = retention or get_retention()
+    keep_all_before = now - timedelta(days=retention['keep_all_days'])
+    daily_before = now - timedelta(days=retention['daily_days'])
+
+    to_prune = []
+    seen_buckets = set()
+    for index, checkpoint in enumerate(checkpoints):
+        timestamp = timezone.localtime(checkpoint.last_log_timestamp)
+        if index == 0 or checkpoint.last_log_timestamp >= keep_all_before:
+            continue
+        if checkpoint.last_log_timestamp >= daily_before:
+            bucket = ('day', timestamp.date())
+        else:
+            bucket = ('month', timestamp.year, timestamp.month)
+        # 倒序遍历，每个时间段内先遇到的就是最新的一个
+        if bucket in seen_buckets:
+            to_prune.append(checkpoint)
+        else:
+            seen_buckets.add(bucket)
+    return to_prune
+
+
+def prune_checkpoints(project, now=None, dry_run=False):
+    """按保留策略删除案件的旧检查点，返回删除数量"""
+    checkpoints = list(
+        MapCheckpoint.objects.filter(project=project).only(
+            'id', 'project_id', 'last_log_timestamp', 'last_log_id'
+        ).order_by('-last_log_timestamp', '-last_log_id')
+    )
+    to_prune = select_checkpoints_to_prune(checkpoints, now=now)
+    if to_prune and not dry_run:
+        MapCheckpoint.objects.filter(id__in=[checkpoint.id for checkpoint in to_prune]).delete()
+    return len(to_prune)
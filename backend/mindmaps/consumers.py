@@ -1,20 +1,58 @@
-import json
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 from .models import MindMapNode, NodeEditLog
-from projects.models import Project, ProjectMember
+from .rooms import room_group_name, group_send, publish
+from .sharding import room_layer_alias
+from .cursors import CursorCoalescer
+from .batch import apply_node_batch, BatchError, BatchConflict, MAX_BATCH_OPERATIONS
+from . import protocol
+from .text_ot import text_hub, OT_FIELDS, StaleRevision
+from .write_buffer import node_write_buffer, VersionConflict
+from . import presence
+from . import event_log
+from .outbox import Outbox
+from . import metrics
+from projects.models import ProjectMember
 
 User = get_user_model()
+logger = logging.getLogger(__name__)
+
+# receive 处理的消息类型，其余类型在监控指标中记为 other
+RECEIVE_TYPES = {
+    'node_create', 'node_update', 'node_delete', 'batch', 'text_open', 'text_op',
+    'text_close', 'cursor_move', 'user_selection', 'replay', 'resync',
+}
 
 class MindMapConsumer(AsyncWebsocketConsumer):
+    @property
+    def channel_layer_alias(self):
+        """连接加入房间所在分片的通道层（在 connect 之前、建立通道时读取）"""
+        return room_layer_alias(room_group_name(self.scope['url_route']['kwargs']['project_id']))
+    
     async def connect(self):
         self.project_id = self.scope['url_route']['kwargs']['project_id']
-        self.room_group_name = f'mindmap_{self.project_id}'
+        self.room_group_name = room_group_name(self.project_id)
         self.user = self.scope['user']
+        # 自己的光标待广播，其他用户的光标待推送，都按周期合并
+        self.cursor_outbox = CursorCoalescer(self.broadcast_cursor)
+        self.cursor_inbox = CursorCoalescer(self.send_cursors)
+        # 房间内其他用户的最新光标位置，每帧 cursors 都是完整快照
+        self.cursor_positions = {}
+        self.heartbeat_task = None
+        # 发往客户端的帧经发送队列写出，客户端跟不上时丢弃房间事件并改发快照
+        self.outbox = Outbox(self.write_frame, self.build_resync_frame)
         
-        # 检查用户权限
-        if not await self.check_permission():
+        # 根据握手时声明的子协议选择消息编码，未声明时使用 JSON
+        self.protocol, subprotocol = protocol.negotiate(self.scope.get('subprotocols'))
+        
+        # 连接时查询一次成员权限并缓存，权限变化时通过 member_permission_changed 事件更新
+        self.permission = await self.load_permission()
+        if self.permission is None:
             await self.close()
             return
         
@@ -24,22 +62,45 @@ class MindMapConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
         
-        await self.accept()
+        await self.accept(subprotocol)
         
-        # 发送当前在线用户列表
+        # 登记在线状态，发送当前在线用户列表，用户首次上线时通知房间
+        joined = await sync_to_async(presence.join)(self.room_group_name, self.user, self.channel_name)
         await self.send_online_users()
+        # 已加入房间组后再读取事件日志，之后的事件都会实时收到
+        await self.replay_missed_events(self.get_last_seq())
+        if joined:
+            await self.broadcast({'type': 'user_joined', 'user': self.user.username})
+        # 连接数与 disconnect 中的减少对应，以心跳任务是否启动为准
+        metrics.WS_CONNECTIONS.inc(str(self.project_id))
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat_loop())
     
     async def disconnect(self, close_code):
+        self.cursor_outbox.close()
+        self.cursor_inbox.close()
+        self.outbox.close()
+        # 写回本连接缓冲的修改，释放打开的协同文本
+        await node_write_buffer.flush_channel(self.channel_name)
+        await text_hub.close_channel(self.channel_name)
+        
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            metrics.WS_CONNECTIONS.dec(str(self.project_id))
+            left = await sync_to_async(presence.leave)(self.room_group_name, self.user, self.channel_name)
+            if left:
+                await self.broadcast({'type': 'user_left', 'user': self.user.username})
+        
         # 离开房间组
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
     
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = protocol.decode(text_data, bytes_data)
             message_type = data.get('type')
+            metrics.WS_MESSAGES.inc(message_type if message_type in RECEIVE_TYPES else 'other')
             
             if message_type == 'node_create':
                 await self.handle_node_create(data)
@@ -47,21 +108,27 @@ class MindMapConsumer(AsyncWebsocketConsumer):
                 await self.handle_node_update(data)
             elif message_type == 'node_delete':
                 await self.handle_node_delete(data)
+            elif message_type == 'batch':
+                await self.handle_batch(data)
+            elif message_type == 'text_open':
+                await self.handle_text_open(data)
+            elif message_type == 'text_op':
+                await self.handle_text_op(data)
+            elif message_type == 'text_close':
+                await self.handle_text_close(data)
             elif message_type == 'cursor_move':
                 await self.handle_cursor_move(data)
             elif message_type == 'user_selection':
                 await self.handle_user_selection(data)
+            elif message_type == 'replay':
+                await self.handle_replay(data)
+            elif message_type == 'resync':
+                await self.handle_resync(data)
                 
-        except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': '无效的JSON格式'
-            }))
+        except ValueError:
+            await self.send_error('无效的消息格式')
         except Exception as e:
-            await self.send(text_data=json.dumps({
-                'type': 'error', 
-                'message': str(e)
-            }))
+            await self.send_error(str(e))
     
     async def handle_node_create(self, data):
         """处理节点创建"""
@@ -70,7 +137,7 @@ class MindMapConsumer(AsyncWebsocketConsumer):
             parent_id = data.get('parent_id')
             
             # 检查编辑权限
-            if not await self.check_edit_permission():
+            if not self.can_edit():
                 await self.send_error("没有编辑权限")
                 return
             
@@ -78,14 +145,11 @@ class MindMapConsumer(AsyncWebsocketConsumer):
             node = await self.create_node(node_data, parent_id)
             
             # 广播给房间内所有用户
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'node_created',
-                    'node': await self.serialize_node(node),
-                    'user': self.user.username
-                }
-            )
+            await self.broadcast({
+                'type': 'node_created',
+                'node': serialize_node(node),
+                'user': self.user.username
+            })
             
         except Exception as e:
             await self.send_error(f"创建节点失败: {str(e)}")
@@ -97,25 +161,45 @@ class MindMapConsumer(AsyncWebsocketConsumer):
             updates = data.get('updates', {})
             
             # 检查编辑权限
-            if not await self.check_edit_permission():
+            if not self.can_edit():
                 await self.send_error("没有编辑权限")
                 return
             
-            # 更新节点
-            node = await self.update_node(node_id, updates)
+            # 正在协同编辑的文本字段转换为文本操作，由协同文档合并和写回
+            updates = dict(updates)
+            for field in OT_FIELDS:
+                document = text_hub.get(node_id, field, self.project_id)
+                # 无权修改时不转换，由写回缓冲区按同样的规则拒绝
+                if field in updates and document is not None and document.can_be_edited_by(self.user):
+                    op = text_hub.replace(document, str(updates.pop(field) or ''), self.user)
+                    await self.broadcast_text_op(document, op)
+            if not updates:
+                return
+            
+            # 更新节点：立即广播，数据库写入由缓冲区合并后延迟进行
+            try:
+                node = await node_write_buffer.update(
+                    self.project_id, node_id, self.user, self.channel_name, updates,
+                    version=data.get('version')
+                )
+            except VersionConflict as e:
+                # 返回节点当前状态，客户端据此合并后重新提交
+                await self.send_message({
+                    'type': 'conflict',
+                    'node_id': node_id,
+                    'node': serialize_node(e.node)
+                })
+                return
             if not node:
                 await self.send_error("节点不存在或无权限修改")
                 return
             
             # 广播给房间内所有用户
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'node_updated',
-                    'node': await self.serialize_node(node),
-                    'user': self.user.username
-                }
-            )
+            await self.broadcast({
+                'type': 'node_updated',
+                'node': serialize_node(node),
+                'user': self.user.username
+            })
             
         except Exception as e:
             await self.send_error(f"更新节点失败: {str(e)}")
@@ -125,113 +209,375 @@ class MindMapConsumer(AsyncWebsocketConsumer):
         try:
             node_id = data.get('node_id')
             
-            # 删除节点
+            # 删除节点，先写回缓冲的修改以保持日志顺序
+            await node_write_buffer.flush([node_id])
             success = await self.delete_node(node_id)
             if not success:
                 await self.send_error("删除失败：节点不存在、无权限或存在子节点")
                 return
+            text_hub.discard(node_id)
             
             # 广播给房间内所有用户
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'node_deleted',
-                    'node_id': node_id,
-                    'user': self.user.username
-                }
-            )
+            await self.broadcast({
+                'type': 'node_deleted',
+                'node_id': node_id,
+                'user': self.user.username
+            })
             
         except Exception as e:
             await self.send_error(f"删除节点失败: {str(e)}")
     
+    async def handle_batch(self, data):
+        """处理批量操作：一个事务内批量写入，只广播一条 nodes_changed 事件"""
+        operations = data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            await self.send_error("批量操作不能为空")
+            return
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            await self.send_error(f"批量操作最多 {MAX_BATCH_OPERATIONS} 条")
+            return
+        
+        # 先写回批次涉及节点的缓冲修改，批量操作基于数据库中的最新状态
+        await node_write_buffer.flush([
+            operation.get('node_id') for operation in operations
+            if isinstance(operation, dict) and operation.get('node_id')
+        ])
+        
+        try:
+            changes = await self.apply_batch(operations)
+        except BatchConflict as e:
+            await self.send_message({
+                'type': 'conflict',
+                'node_id': e.node_uid,
+                'node': serialize_node(e.node) if e.node else None,
+                'message': f"批量操作失败: {e.message}",
+                'index': e.index
+            })
+            return
+        except BatchError as e:
+            await self.send_message({
+                'type': 'error',
+                'message': f"批量操作失败: {e.message}",
+                'index': e.index
+            })
+            return
+        except Exception as e:
+            await self.send_error(f"批量操作失败: {str(e)}")
+            return
+        
+        # 同步正在协同编辑的文档：删除的丢弃，批量写入的文本转换为文本操作
+        for node_uid in changes['deleted']:
+            text_hub.discard(node_uid)
+        for node in changes['updated']:
+            for field in OT_FIELDS:
+                document = text_hub.get(node['id'], field, self.project_id)
+                if document is not None and document.text != node[field]:
+                    op = text_hub.sync_external(document, node[field], self.user)
+                    await self.broadcast_text_op(document, op)
+        
+        await self.broadcast({
+            'type': 'nodes_changed',
+            'user': self.user.username,
+            **changes
+        })
+    
+    async def handle_text_open(self, data):
+        """打开节点文本的协同文档，返回当前文本和版本号"""
+        node_id = data.get('node_id')
+        field = data.get('field')
+        if field not in OT_FIELDS:
+            await self.send_error("不支持协同编辑的字段")
+            return
+        
+        if not self.can_edit():
+            await self.send_error("没有编辑权限")
+            return
+        
+        document = await text_hub.load(self.project_id, node_id, field)
+        if document is None:
+            await self.send_error("节点不存在")
+            return
+        if not document.editable:
+            await self.send_error("系统默认节点不能修改")
+            return
+        if not document.can_be_edited_by(self.user):
+            await self.send_error("只能编辑自己创建的节点")
+            return
+        document = text_hub.subscribe(document, self.channel_name)
+        await self.send_message({'type': 'text_state', **document.state()})
+    
+    async def handle_text_op(self, data):
+        """处理字符级文本操作：与并发操作转换后应用，只广播转换后的操作"""
+        node_id = data.get('node_id')
+        field = data.get('field')
+        revision = data.get('revision')
+        
+        if not self.can_edit():
+            await self.send_error("没有编辑权限")
+            return
+        document = text_hub.get(node_id, field, self.project_id)
+        if document is None or self.channel_name not in document.subscribers:
+            await self.send_error("请先打开协同文本")
+            return
+        if not document.editable:
+            await self.send_error("系统默认节点不能修改")
+            return
+        if not document.can_be_edited_by(self.user):
+            await self.send_error("只能编辑自己创建的节点")
+            return
+        if not isinstance(revision, int) or isinstance(revision, bool):
+            await self.send_error("缺少版本号")
+            return
+        
+        try:
+            op = text_hub.submit(document, revision, data.get('op'), self.user)
+        except StaleRevision:
+            # 版本过旧，返回最新状态让客户端重新同步
+            await self.send_message({'type': 'text_state', 'resync': True, **document.state()})
+            return
+        except ValueError as e:
+            await self.send_error(f"文本操作无效: {str(e)}")
+            return
+        
+        await self.broadcast_text_op(document, op, data.get('op_id'))
+    
+    async def handle_text_close(self, data):
+        await text_hub.close(data.get('node_id'), data.get('field'), self.channel_name)
+    
+    async def broadcast_text_op(self, document, op, op_id=None):
+        """广播文本操作；revision 为应用后的版本号，客户端发现不连续时应重新打开文档"""
+        await self.broadcast({
+            'type': 'text_op',
+            'node_id': document.node_uid,
+            'field': document.field,
+            'revision': document.revision,
+            'op': op,
+            'op_id': op_id,
+            'user': self.user.username
+        })
+    
     async def handle_cursor_move(self, data):
-        """处理光标移动"""
-        await self.channel_layer.group_send(
+        """处理光标移动：只记录最新位置，由合并器限频广播"""
+        self.cursor_outbox.put(self.user.username, (data.get('x', 0), data.get('y', 0)))
+    
+    async def broadcast_cursor(self, pending):
+        """向房间广播自己最新的光标位置"""
+        x, y = pending[self.user.username]
+        await group_send(
             self.room_group_name,
             {
                 'type': 'cursor_moved',
                 'user': self.user.username,
-                'x': data.get('x', 0),
-                'y': data.get('y', 0)
+                'x': x,
+                'y': y
             }
         )
     
     async def handle_user_selection(self, data):
         """处理用户选择"""
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_selected',
-                'user': self.user.username,
-                'node_id': data.get('node_id')
-            }
+        await self.broadcast({
+            'type': 'user_selected',
+            'user': self.user.username,
+            'node_id': data.get('node_id')
+        })
+    
+    async def broadcast(self, message):
+        """向房间广播消息：发送方编码一次，接收方直接转发；修改类事件带有序号"""
+        await publish(self.room_group_name, message)
+    
+    async def send_message(self, message):
+        """按本连接协商的协议编码并发送消息"""
+        await self.send_frame(protocol.encode(message, self.protocol))
+    
+    async def send_frame(self, frame):
+        """放入发送队列，直接回复本连接的帧不会被丢弃"""
+        self.outbox.put(frame)
+    
+    async def write_frame(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+    
+    async def forward(self, event):
+        """转发 broadcast 预先编码好的帧（必要时转换为本连接的协议），客户端跟不上时可以丢弃或合并"""
+        self.outbox.put(
+            protocol.broadcast_frame(event['frame'], self.protocol),
+            droppable=True,
+            merge_key=event.get('merge_key')
         )
     
+    async def build_snapshot(self, seq=None):
+        """案件所有节点的快照消息，seq 为快照对应的事件序号"""
+        if seq is None:
+            try:
+                seq = await sync_to_async(event_log.current_seq)(self.room_group_name)
+            except Exception as e:
+                logger.error(f"Failed to read event log of {self.room_group_name}: {str(e)}")
+                seq = 0
+        return {
+            'type': 'snapshot',
+            'seq': seq,
+            'nodes': await self.load_snapshot()
+        }
+    
+    async def build_resync_frame(self):
+        """发送队列积压丢弃事件后，以快照让客户端重新同步"""
+        return protocol.encode(await self.build_snapshot(), self.protocol)
+    
     # WebSocket事件处理器
     async def node_created(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
     
     async def node_updated(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
     
     async def node_deleted(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
+    
+    async def nodes_changed(self, event):
+        await self.forward(event)
+    
+    async def text_op(self, event):
+        await self.forward(event)
     
     async def cursor_moved(self, event):
-        # 不发送给自己
+        # 不发送给自己；其他用户的光标合并后按周期批量推送
         if event['user'] != self.user.username:
-            await self.send(text_data=json.dumps(event))
+            self.cursor_inbox.put(event['user'], {
+                'user': event['user'],
+                'x': event['x'],
+                'y': event['y']
+            })
+    
+    async def send_cursors(self, pending):
+        """推送光标快照：发送队列中只保留最新一帧，客户端跟不上时不会积压"""
+        self.cursor_positions.update(pending)
+        self.outbox.put(
+            protocol.encode({'type': 'cursors', 'cursors': list(self.cursor_positions.values())}, self.protocol),
+            droppable=True,
+            merge_key='cursors'
+        )
     
     async def user_selected(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.forward(event)
+    
+    async def user_joined(self, event):
+        await self.forward(event)
+    
+    async def user_left(self, event):
+        self.cursor_positions.pop(event['user'], None)
+        await self.forward(event)
+    
+    async def member_permission_changed(self, event):
+        """成员权限被修改或成员被移除"""
+        if event['user_id'] != self.user.id:
+            return
+        
+        self.permission = event['permission']
+        if self.permission is None:
+            # 直接写出而不经发送队列，否则关闭连接时队列中的提示会被丢弃
+            await self.write_frame(protocol.encode({'type': 'error', 'message': "你已被移出该案件"}, self.protocol))
+            await self.close()
+            return
+        
+        await self.send_message({
+            'type': 'permission_changed',
+            'permission': self.permission
+        })
     
     async def send_error(self, message):
         """发送错误消息"""
-        await self.send(text_data=json.dumps({
+        await self.send_message({
             'type': 'error',
             'message': message
-        }))
+        })
     
     async def send_online_users(self):
-        """发送在线用户列表"""
-        # 这里可以实现获取在线用户的逻辑
-        await self.send(text_data=json.dumps({
+        """发送在线用户列表，之后只推送上线/离线的增量"""
+        users = await sync_to_async(presence.online_users)(self.room_group_name)
+        await self.send_message({
             'type': 'online_users',
-            'users': [self.user.username]  # 简化实现
-        }))
+            'users': users
+        })
     
-    @database_sync_to_async
-    def check_permission(self):
-        """检查用户是否有项目访问权限"""
+    async def handle_replay(self, data):
+        """客户端发现事件序号有缺口（多进程转发时事件可能乱序或丢失）时请求补发"""
+        last_seq = data.get('last_seq')
+        if not isinstance(last_seq, int) or isinstance(last_seq, bool):
+            await self.send_error("缺少事件序号")
+            return
+        await self.replay_missed_events(last_seq)
+    
+    async def handle_resync(self, data):
+        """客户端多次请求补发仍未补齐缺口时，请求完整快照重新同步"""
+        await self.send_message(await self.build_snapshot())
+    
+    async def replay_missed_events(self, last_seq):
+        """补发 last_seq 之后的事件，缺失的事件已不在日志中时发送完整快照；last_seq 为 None（新连接）时只告知当前序号"""
         try:
-            project = Project.objects.get(id=self.project_id)
-            member = ProjectMember.objects.get(project=project, user=self.user)
-            return True
-        except (Project.DoesNotExist, ProjectMember.DoesNotExist):
-            return False
+            if last_seq is None:
+                seq = await sync_to_async(event_log.current_seq)(self.room_group_name)
+                await self.send_message({'type': 'sync', 'seq': seq})
+                return
+            seq, events = await sync_to_async(event_log.events_since)(self.room_group_name, last_seq)
+        except Exception as e:
+            logger.error(f"Failed to read event log of {self.room_group_name}: {str(e)}")
+            seq, events = 0, None
+        
+        if events is None:
+            await self.send_message(await self.build_snapshot(seq))
+            return
+        for event in events:
+            await self.send_message(event)
     
-    @database_sync_to_async
-    def check_edit_permission(self):
-        """检查用户是否有编辑权限"""
+    def get_last_seq(self):
+        """连接地址中客户端收到的最大事件序号，新连接或格式错误时返回 None"""
+        query = parse_qs(self.scope.get('query_string', b'').decode('latin-1'))
         try:
-            project = Project.objects.get(id=self.project_id)
-            member = ProjectMember.objects.get(project=project, user=self.user)
-            return member.permission in ['edit', 'admin']
-        except (Project.DoesNotExist, ProjectMember.DoesNotExist):
-            return False
+            return int(query['last_seq'][0])
+        except (KeyError, ValueError):
+            return None
+    
+    async def heartbeat_loop(self):
+        """定期刷新在线状态，并通知房间因进程崩溃等原因过期离线的用户"""
+        while True:
+            await asyncio.sleep(presence.get_heartbeat_interval())
+            try:
+                expired = await sync_to_async(presence.heartbeat)(
+                    self.room_group_name, self.user, self.channel_name
+                )
+                for username in expired:
+                    await self.broadcast({'type': 'user_left', 'user': username})
+            except Exception as e:
+                logger.error(f"Presence heartbeat failed in {self.room_group_name}: {str(e)}")
+    
+    @database_sync_to_async
+    def load_permission(self):
+        """查询用户在项目中的权限，不是成员时返回 None"""
+        if not self.user.is_authenticated:
+            return None
+        return ProjectMember.objects.filter(
+            project_id=self.project_id,
+            user=self.user
+        ).values_list('permission', flat=True).first()
+    
+    def can_edit(self):
+        """根据缓存的成员权限判断是否可以编辑"""
+        return self.permission in ['edit', 'admin']
     
     @database_sync_to_async
     def create_node(self, node_data, parent_id):
         """创建节点"""
-        project = Project.objects.get(id=self.project_id)
-        parent_node_uid = None
+        # 根节点的父节点UID为空字符串，与 REST 接口和批量操作一致（字段不允许 NULL）
+        parent_node_uid = ''
         if parent_id:
             # 验证父节点存在
-            parent_node = MindMapNode.objects.get(node_id=parent_id, project=project)
+            parent_node = MindMapNode.objects.get(node_id=parent_id, project_id=self.project_id)
             parent_node_uid = parent_id
         
         node = MindMapNode.objects.create(
-            project=project,
+            project_id=self.project_id,
             node_id=node_data.get('uid'),
             parent_node_uid=parent_node_uid,
             creator=self.user,
@@ -246,79 +592,22 @@ class MindMapConsumer(AsyncWebsocketConsumer):
         )
         
         # 记录日志
-        NodeEditLog.objects.create(
-            node=node,
-            user=self.user,
-            action='create',
-            new_data=node_data
-        )
+        NodeEditLog.record(node, self.user, 'create')
         
         return node
     
-    @database_sync_to_async
-    def update_node(self, node_id, updates):
-        """更新节点"""
-        try:
-            project = Project.objects.get(id=self.project_id)
-            node = MindMapNode.objects.get(node_id=node_id, project=project)
-            
-            # 检查是否有权限修改（只能修改自己创建的节点）
-            if node.creator != self.user:
-                return None
-            
-            # 保存旧数据
-            old_data = {
-                'text': node.text,
-                'rich_text': node.rich_text,
-                'expand': node.expand,
-                'icon': node.icon,
-                'hyperlink': node.hyperlink,
-                'hyperlink_title': node.hyperlink_title,
-                'note': node.note,
-                'tags': node.tags
-            }
-            
-            # 更新字段
-            for field, value in updates.items():
-                if hasattr(node, field):
-                    setattr(node, field, value)
-            
-            node.save()
-            
-            # 记录日志
-            NodeEditLog.objects.create(
-                node=node,
-                user=self.user,
-                action='update',
-                old_data=old_data,
-                new_data=updates
-            )
-            
-            return node
-        except MindMapNode.DoesNotExist:
-            return None
-    
     @database_sync_to_async
     def delete_node(self, node_id):
         """删除节点"""
         try:
-            project = Project.objects.get(id=self.project_id)
-            node = MindMapNode.objects.get(node_id=node_id, project=project)
+            node = MindMapNode.objects.get(node_id=node_id, project_id=self.project_id)
             
             # 检查删除权限
             if not node.can_be_deleted_by(self.user):
                 return False
             
             # 记录日志
-            NodeEditLog.objects.create(
-                node=node,
-                user=self.user,
-                action='delete',
-                old_data={
-                    'text': node.text,
-                    'parent_id': node.parent_node_uid if node.parent_node_uid else None
-                }
-            )
+            NodeEditLog.record(node, self.user, 'delete')
             
             node.delete()
             return True
@@ -326,19 +615,50 @@ class MindMapConsumer(AsyncWebsocketConsumer):
             return False
     
     @database_sync_to_async
-    def serialize_node(self, node):
-        """序列化节点"""
+    def load_snapshot(self):
+        """案件所有节点的当前状态，尚未写回的缓冲修改以内存中的为准"""
+        pending = node_write_buffer.pending
+        nodes = MindMapNode.objects.filter(project_id=self.project_id).select_related('creator')
+        return [
+            serialize_node(pending[node.node_id].node if node.node_id in pending else node)
+            for node in nodes
+        ]
+    
+    @database_sync_to_async
+    def apply_batch(self, operations):
+        """应用批量操作并序列化变化的节点"""
+        changes = apply_node_batch(self.project_id, self.user, operations, self.can_edit())
         return {
-            'id': node.node_id,
-            'text': node.text,
-            'rich_text': node.rich_text,
-            'expand': node.expand,
-            'icon': node.icon,
-            'hyperlink': node.hyperlink,
-            'hyperlink_title': node.hyperlink_title,
-            'note': node.note,
-            'tags': node.tags,
-            'creator': node.creator.username,
-            'created_at': node.created_at.isoformat(),
-            'parent_id': node.parent_node_uid if node.parent_node_uid else None
+            'created': [serialize_node(node) for node in changes['created']],
+            # 批量写入的文本随后再同步到协同文档，这里保留数据库中的值
+            'updated': [serialize_node(node, with_hot_text=False) for node in changes['updated']],
+            'deleted': changes['deleted'],
         }
+
+
+def serialize_node(node, with_hot_text=True):
+    """序列化节点
+    
+    不访问数据库：创建的节点 creator 已是当前用户，查询的节点都通过 select_related 加载了 creator
+    """
+    data = {
+        'id': node.node_id,
+        'text': node.text,
+        'rich_text': node.rich_text,
+        'expand': node.expand,
+        'icon': node.icon,
+        'hyperlink': node.hyperlink,
+        'hyperlink_title': node.hyperlink_title,
+        'note': node.note,
+        'tags': node.tags,
+        'creator': node.creator.username,
+        'created_at': node.created_at.isoformat(),
+        'parent_id': node.parent_node_uid if node.parent_node_uid else None,
+        'version': node.version
+    }
+    # 正在协同编辑的字段以内存中的文档为准，数据库可能尚未写回
+    for field in OT_FIELDS:
+        document = text_hub.get(node.node_id, field) if with_hot_text else None
+        if document is not None:
+            data[field] = document.text
+    return data
@@ -0,0 +1,64 @@
+"""协作光标的合并与限频
+
+鼠标移动事件频率很高，逐条广播会让通道层和浏览器都不堪重负。
+每个连接用两个合并器：
+- 发送端只保留自己最新的光标位置，每个周期最多向房间广播一次；
+- 接收端把房间内其他用户的光标按用户合并，每个周期只推送一帧 cursors 消息，
+  帧内是各用户的最新位置（完整快照），发送队列中只保留最新一帧。
+"""
+import asyncio
+import logging
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_flush_interval():
+    """光标刷新周期（秒），由 MINDMAP_CURSOR_FLUSH_HZ 决定"""
+    hz = getattr(settings, 'MINDMAP_CURSOR_FLUSH_HZ', 20)
+    return 1.0 / hz if hz > 0 else 0
+
+
+class CursorCoalescer:
+    """按固定周期合并数据，同一 key 只保留最新的值
+
+    空闲后的第一条数据立即刷新，之后每个周期最多刷新一次。
+    flush 是协程函数，参数为 {key: value}。
+    """
+
+    def __init__(self, flush, interval=None):
+        self._flush = flush
+        self._interval = get_flush_interval() if interval is None else interval
+        self._pending = {}
+        self._task = None
+        self._last_flush = None
+
+    def put(self, key, value):
+        self._pending[key] = value
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                if self._last_flush is not None:
+                    delay = self._last_flush + self._interval - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                pending, self._pending = self._pending, {}
+                self._last_flush = loop.time()
+                try:
+                    await self._flush(pending)
+                except Exception as e:
+                    logger.error(f"Failed to flush cursors: {str(e)}")
+        finally:
+            self._task = None
+
+    def close(self):
+        """丢弃未发送的数据并停止刷新"""
+        self._pending = {}
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
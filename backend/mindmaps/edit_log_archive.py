@@ -0,0 +1,245 @@
+"""节点编辑日志归档
+
+早于保留期限的 NodeEditLog 按 (案件, 月份) 分区写入 gzip 压缩的 NDJSON 文件，
+EditLogArchive 表作为索引记录每个文件的时间和ID范围，随后从在线表中删除。
+读取时在线表与归档文件按 (timestamp, id) 倒序合并，对外表现为同一条日志流；
+日志接口中的归档记录经 serialize_archived_logs 按在线日志相同的格式输出。
+"""
+import gzip
+import json
+from collections import defaultdict
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import NodeEditLog, EditLogArchive
+from .pagination import keyset_before, encode_cursor
+from .serializers import NodeEditLogSerializer, serialize_archived_logs
+
+# 解析后的归档文件缓存时间（秒）
+ARCHIVE_CACHE_TIMEOUT = 600
+
+
+def get_archive_root():
+    """归档文件根目录"""
+    return Path(getattr(settings, 'EDIT_LOG_ARCHIVE_ROOT', Path(settings.BASE_DIR) / 'archives' / 'edit_logs'))
+
+
+def month_key(timestamp):
+    """日志所属的归档月份（按本地时区）"""
+    return timezone.localtime(timestamp).strftime('%Y-%m')
+
+
+def log_to_record(log):
+    """将日志转换为归档记录：NodeEditLogSerializer 的输出加上案件ID"""
+    record = dict(NodeEditLogSerializer(log).data)
+    record['project_id'] = log.project_id
+    return record
+
+
+def _append_to_archive(project_id, month, logs):
+    """将同一 (案件, 月份) 的日志追加到归档文件并更新索引
+
+    gzip 允许多个压缩成员首尾相接，追加写入无需解压重写原文件。
+    """
+    relative_path = f'{project_id}/{month}.ndjson.gz'
+    path = get_archive_root() / relative_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    with gzip.open(path, 'at', encoding='utf-8') as f:
+        for log in logs:
+            f.write(json.dumps(log_to_record(log), ensure_ascii=False, cls=DjangoJSONEncoder))
+            f.write('\n')
+
+    first, last = logs[0], logs[-1]
+    archive, created = EditLogArchive.objects.get_or_create(
+        project_id=project_id,
+        month=month,
+        defaults={
+            'file_path': relative_path,
+            'first_timestamp': first.timestamp,
+            'first_log_id': first.id,
+            'last_timestamp': last.timestamp,
+            'last_log_id': last.id,
+        }
+    )
+    if not created:
+        if (first.timestamp, first.id) < (archive.first_timestamp, archive.first_log_id):
+            archive.first_timestamp, archive.first_log_id = first.timestamp, first.id
+        if (last.timestamp, last.id) > (archive.last_timestamp, archive.last_log_id):
+            archive.last_timestamp, archive.last_log_id = last.timestamp, last.id
+    archive.entry_count += len(logs)
+    archive.file_size = path.stat().st_size
+    archive.save()
+    return archive
+
+
+def archive_edit_logs(before, project_id=None, batch_size=1000, dry_run=False):
+    """归档早于 before 的编辑日志
+
+    Args:
+        before: 截止时间，早于该时间的日志被归档
+        project_id: 只归档指定案件的日志
+        batch_size: 每批处理的日志条数
+        dry_run: 只统计不写入
+
+    Returns:
+        dict: {'archived': 归档条数, 'archives': 涉及的 (案件ID, 月份) 集合}
+    """
+    queryset = NodeEditLog.objects.filter(
+        timestamp__lt=before,
+        project__isnull=False,
+    )
+    if project_id:
+        queryset = queryset.filter(project_id=project_id)
+
+    if dry_run:
+        months = {
+            (log.project_id, month_key(log.timestamp))
+            for log in queryset.only('project_id', 'timestamp').iterator(chunk_size=batch_size)
+        }
+        return {'archived': queryset.count(), 'archives': months}
+
+    queryset = queryset.select_related('node', 'user').order_by('timestamp', 'id')
+    archived = 0
+    touched = set()
+
+    while True:
+        batch = list(queryset[:batch_size])
+        if not batch:
+            break
+
+        groups = defaultdict(list)
+        for log in batch:
+            groups[(log.project_id, month_key(log.timestamp))].append(log)
+
+        # 先写文件再删库：中途失败最多产生重复归档，不会丢日志
+        with transaction.atomic():
+            for (log_project_id, month), logs in groups.items():
+                _append_to_archive(log_project_id, month, logs)
+                touched.add((log_project_id, month))
+            NodeEditLog.objects.filter(id__in=[log.id for log in batch]).delete()
+
+        archived += len(batch)
+
+    return {'archived': archived, 'archives': touched}
+
+
+def _read_archive(path):
+    """解压并解析归档文件，返回按 (timestamp, id) 倒序排列的 (键, 记录) 列表"""
+    if not path.exists():
+        return []
+
+    items = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            items.append(((parse_datetime(record['timestamp']), record['id']), record))
+    items.sort(key=lambda item: item[0], reverse=True)
+    return items
+
+
+def _load_archive(archive):
+    """读取一个归档文件，返回按 (timestamp, id) 倒序排列的 (键, 记录) 列表
+
+    翻页时同一个月份的文件会被反复读取，解析排序后的结果按索引的更新时间和文件大小缓存，
+    追加归档会更新两者，旧的缓存不再命中。
+    """
+    cache_key = f'mindmap_edit_log_archive:{archive.id}:{archive.updated_at.timestamp()}:{archive.file_size}'
+    items = cache.get(cache_key)
+    if items is None:
+        items = _read_archive(get_archive_root() / archive.file_path)
+        cache.set(cache_key, items, ARCHIVE_CACHE_TIMEOUT)
+    return items
+
+
+def iter_archived_records(project_id, before=None, after=None, since=None, until=None):
+    """按 (timestamp, id) 倒序遍历案件的归档日志
+
+    Args:
+        before: 只返回键严格小于该 (timestamp, id) 的记录
+        after: 只返回键严格大于该 (timestamp, id) 的记录
+        since: 只返回该时间及之后的记录
+        until: 只返回该时间之前的记录
+
+    归档按月分区互不重叠，借助索引中的范围跳过无关文件，只在需要时才打开文件。
+    """
+    archives = EditLogArchive.objects.filter(project_id=project_id)
+    if since:
+        archives = archives.filter(last_timestamp__gte=since)
+    if until:
+        archives = archives.filter(first_timestamp__lt=until)
+    if before:
+        timestamp, log_id = before
+        archives = archives.filter(
+            Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_log_id__lt=log_id)
+        )
+    if after:
+        timestamp, log_id = after
+        archives = archives.filter(
+            Q(last_timestamp__gt=timestamp) | Q(last_timestamp=timestamp, last_log_id__gt=log_id)
+        )
+
+    for archive in archives.order_by('-last_timestamp', '-last_log_id'):
+        for key, record in _load_archive(archive):
+            if before and key >= before:
+                continue
+            if after and key <= after:
+                return
+            if since and key[0] < since:
+                return
+            if until and key[0] >= until:
+                continue
+            yield key, record
+
+
+def fetch_log_page(queryset, project_id, page_size, before=None, serialize=None,
+                   record_filter=None, since=None, until=None, serialize_records=None):
+    """读取一页编辑日志，跨越在线表和归档文件
+
+    Args:
+        queryset: 在线日志查询集（已按案件及过滤条件过滤）
+        project_id: 案件ID，用于定位归档文件
+        page_size: 每页条数
+        before: 游标解析出的 (timestamp, id)，为空时从最新一条开始
+        serialize: 将在线日志对象转换为字典的函数
+        record_filter: 归档记录的过滤函数，与 queryset 的过滤条件一致
+        since / until: 时间范围，用于跳过范围外的归档文件
+        serialize_records: 将本页的归档记录转换为与在线日志相同格式的函数，
+            参数为 (案件ID, 记录列表)，默认使用 serialize_archived_logs
+
+    Returns:
+        tuple: (日志字典列表, 下一页游标或 None)
+    """
+    live_queryset = queryset.order_by('-timestamp', '-id')
+    if before:
+        live_queryset = live_queryset.filter(keyset_before(before))
+
+    live = [((log.timestamp, log.id), False, serialize(log)) for log in live_queryset[:page_size + 1]]
+
+    # 在线数据已能填满一页时，只有比这一页边界更新的归档记录才可能进入本页
+    boundary = live[-1][0] if len(live) > page_size else None
+    archived = iter_archived_records(project_id, before=before, after=boundary, since=since, until=until)
+    if record_filter:
+        archived = (item for item in archived if record_filter(item[1]))
+    archived = [(key, True, record) for key, record in islice(archived, page_size + 1)]
+
+    items = sorted(live + archived, key=lambda item: item[0], reverse=True)
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    next_cursor = encode_cursor(*items[-1][0]) if has_more else None
+
+    # 只转换进入本页的归档记录
+    serialize_records = serialize_records or serialize_archived_logs
+    archived_records = iter(serialize_records(project_id, [record for _, is_archived, record in items if is_archived]))
+    results = [next(archived_records) if is_archived else record for _, is_archived, record in items]
+    return results, next_cursor
@@ -0,0 +1,160 @@
+"""节点实体抽取和跨案件实体索引
+
+节点保存时从 text 和 note 中抽取手机号、身份证号、银行卡号和 IPv4 地址，规范化后写入
+NodeEntity 表（按 值+类型 建索引），查询一个号码出现在哪些案件和节点只需一次索引查找。
+
+- 手机号：1[3-9] 开头的 11 位，允许 138-0013-8000、138 0013 8000 等分隔写法；
+- 身份证号：18 位，校验出生日期和末位校验码；
+- 银行卡号：16-19 位，允许每 4 位空格分隔，须通过 Luhn 校验，且不是身份证号；
+- IP 地址：每段 0-255 的点分十进制。
+
+号码前后紧邻数字时不视为实体，避免从长数字串中截取。索引维护与全文检索相同：
+post_save 和 nodes_saved 信号时重新抽取，节点删除时随外键级联删除；
+已有数据用 backfill_entities 命令分批处理。
+"""
+import datetime
+import re
+import unicodedata
+
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.html import strip_tags
+
+from .models import MindMapNode, NodeEntity, nodes_saved
+
+# 参与抽取的节点字段
+EXTRACTED_FIELDS = {'text', 'note'}
+
+PHONE = re.compile(r'(?<![\d])(1[3-9]\d)[-\s]?(\d{4})[-\s]?(\d{4})(?![\d])')
+ID_CARD = re.compile(r'(?<![\dXx])([1-9]\d{5}(?:18|19|20)\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01])\d{3}[\dXx])(?![\dXx])')
+BANK_CARD = re.compile(r'(?<![\d])(\d{4}(?:\s?\d{4}){2}\s?\d{4,7})(?![\d])')
+IPV4 = re.compile(r'(?<![\d.])((?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d))(?![\d.])')
+
+_ID_WEIGHTS = (7, 9, 10, 5, 8, 4, 2, 1, 6, 3, 7, 9, 10, 5, 8, 4, 2)
+_ID_CHECK = '10X98765432'
+
+
+def _valid_id_card(number):
+    try:
+        datetime.date(int(number[6:10]), int(number[10:12]), int(number[12:14]))
+    except ValueError:
+        return False
+    total = sum(int(digit) * weight for digit, weight in zip(number[:17], _ID_WEIGHTS))
+    return _ID_CHECK[total % 11] == number[17].upper()
+
+
+def _luhn(number):
+    total = 0
+    for index, digit in enumerate(reversed(number)):
+        digit = int(digit)
+        if index % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def normalize_text(text):
+    """全角转半角，用于抽取和查询"""
+    return unicodedata.normalize('NFKC', text or '')
+
+
+def extract_entities(text):
+    """从文本中抽取实体，返回 {(类型, 规范化的值)}"""
+    text = normalize_text(text)
+    entities = set()
+    id_cards = set()
+    for match in ID_CARD.finditer(text):
+        number = match.group(1).upper()
+        if _valid_id_card(number):
+            entities.add(('id_card', number))
+            id_cards.add(number)
+    for match in PHONE.finditer(text):
+        entities.add(('phone', ''.join(match.groups())))
+    for match in BANK_CARD.finditer(text):
+        number = re.sub(r'\s', '', match.group(1))
+        if 16 <= len(number) <= 19 and number not in id_cards and _luhn(number):
+            entities.add(('bank_card', number))
+    for match in IPV4.finditer(text):
+        entities.add(('ip', match.group(1)))
+    return entities
+
+
+def normalize_value(value):
+    """查询值的规范化：全角转半角，号码去掉空格和连字符，身份证末位大写"""
+    value = normalize_text(value).strip()
+    if re.fullmatch(r'[\d\s-]+[Xx]?', value):
+        value = re.sub(r'[\s-]', '', value).upper()
+    return value
+
+
+def node_entities(node):
+    text = strip_tags(node.text) if node.rich_text else node.text
+    return extract_entities(f'{text}\n{node.note}')
+
+
+def index_nodes(nodes):
+    """重新抽取这些节点的实体，替换索引中的旧记录"""
+    nodes = [node for node in nodes if node.pk is not None]
+    if not nodes:
+        return
+    rows = [
+        NodeEntity(project_id=node.project_id, node_id=node.pk, kind=kind, value=value)
+        for node in nodes
+        for kind, value in node_entities(node)
+    ]
+    with transaction.atomic():
+        NodeEntity.objects.filter(node_id__in=[node.pk for node in nodes]).delete()
+        NodeEntity.objects.bulk_create(rows, batch_size=1000)
+
+
+def backfill(project_id=None, chunk_size=500):
+    """分批为已有节点建立实体索引，返回 (处理的节点数, 写入的实体数)"""
+    nodes = MindMapNode.objects.order_by('pk').only('pk', 'project_id', 'text', 'rich_text', 'note')
+    if project_id is not None:
+        nodes = nodes.filter(project_id=project_id)
+    node_count = 0
+    last_pk = 0
+    while True:
+        chunk = list(nodes.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        index_nodes(chunk)
+        node_count += len(chunk)
+        last_pk = chunk[-1].pk
+    entities = NodeEntity.objects.all()
+    if project_id is not None:
+        entities = entities.filter(project_id=project_id)
+    return node_count, entities.count()
+
+
+def lookup(value, kind=None, project_ids=None):
+    """查找提及该实体的节点，返回 [NodeEntity]（已关联项目和节点）
+
+    Args:
+        project_ids: 限定的项目ID集合，None 表示不限
+    """
+    entities = NodeEntity.objects.filter(value=normalize_value(value))
+    if kind:
+        entities = entities.filter(kind=kind)
+    if project_ids is not None:
+        entities = entities.filter(project_id__in=project_ids)
+    return list(entities.select_related('project', 'node').order_by('project_id', 'node_id'))
+
+
+# 信号处理器
+
+@receiver(post_save, sender=MindMapNode)
+def extract_saved_node(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and not EXTRACTED_FIELDS & set(update_fields)):
+        return
+    index_nodes([instance])
+
+
+@receiver(nodes_saved, sender=MindMapNode)
+def extract_bulk_saved_nodes(sender, nodes, fields=None, **kwargs):
+    if fields is not None and not EXTRACTED_FIELDS & set(fields):
+        return
+    index_nodes(nodes)
@@ -0,0 +1,159 @@
+"""协作房间事件日志
+
+修改思维导图的广播事件（节点创建/更新/删除、批量变化、文本操作）按房间编号：
+序号单调递增，写入消息的 seq 字段，并保留最近 MINDMAP_EVENT_LOG_SIZE 条。
+断线重连的客户端在连接地址上带上 ?last_seq=<收到的最大序号>，服务端只补发缺失的事件；
+缺失部分已不在日志中（或序号对不上，例如服务重启后进程内日志丢失）时改为发送完整快照。
+多进程转发时事件可能乱序到达，客户端发现序号缺口且短时间内未补齐时发送
+{'type': 'replay', 'last_seq': ...}，按同样的规则补发。
+
+每个房间一个序号计数器和一个有序集合，成员为事件的 JSON，分数为序号。
+有序集合允许多个进程取号后乱序写入，裁剪时按排名删除最旧的事件。
+配置 MINDMAP_EVENT_LOG_REDIS_URL 时存放在 Redis，否则（或未安装 redis 库时）
+退化为进程内存储，只适用于单进程部署。
+"""
+import json
+import logging
+import threading
+
+from django.conf import settings
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# 需要编号和补发的事件，在线状态、光标等瞬时事件不记录
+SEQUENCED_EVENTS = {'node_created', 'node_updated', 'node_deleted', 'nodes_changed', 'text_op'}
+
+
+def get_log_size():
+    return getattr(settings, 'MINDMAP_EVENT_LOG_SIZE', 1000)
+
+
+def _seq_key(room):
+    return f'mindmap_events_seq:{room}'
+
+
+def _log_key(room):
+    return f'mindmap_events:{room}'
+
+
+class MemoryEventLog:
+    """进程内事件日志"""
+
+    def __init__(self):
+        self._seqs = {}
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def next_seq(self, room):
+        with self._lock:
+            seq = self._seqs.get(room, 0) + 1
+            self._seqs[room] = seq
+            return seq
+
+    def add(self, room, seq, payload):
+        with self._lock:
+            events = self._rooms.setdefault(room, {})
+            events[seq] = payload
+            # 字典按写入顺序排列，最先写入的就是最旧的事件
+            while len(events) > get_log_size():
+                del events[next(iter(events))]
+
+    def current(self, room):
+        with self._lock:
+            return self._seqs.get(room, 0)
+
+    def read(self, room, after_seq):
+        """返回 (当前序号, 日志中最早的序号或 None, [(序号, 事件 JSON)])"""
+        with self._lock:
+            events = self._rooms.get(room, {})
+            return (
+                self._seqs.get(room, 0),
+                min(events) if events else None,
+                sorted((seq, payload) for seq, payload in events.items() if seq > after_seq)
+            )
+
+
+class RedisEventLog:
+    """基于 Redis 有序集合的事件日志，多进程共享"""
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url)
+
+    def next_seq(self, room):
+        return self._client.incr(_seq_key(room))
+
+    def add(self, room, seq, payload):
+        key = _log_key(room)
+        pipe = self._client.pipeline()
+        pipe.zadd(key, {payload: seq})
+        pipe.zremrangebyrank(key, 0, -get_log_size() - 1)
+        pipe.execute()
+
+    def current(self, room):
+        return int(self._client.get(_seq_key(room)) or 0)
+
+    def read(self, room, after_seq):
+        key = _log_key(room)
+        pipe = self._client.pipeline()
+        pipe.get(_seq_key(room))
+        pipe.zrange(key, 0, 0, withscores=True)
+        pipe.zrangebyscore(key, f'({after_seq}', '+inf', withscores=True)
+        current, oldest, events = pipe.execute()
+        return (
+            int(current or 0),
+            int(oldest[0][1]) if oldest else None,
+            [(int(seq), payload) for payload, seq in events]
+        )
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                url = getattr(settings, 'MINDMAP_EVENT_LOG_REDIS_URL', None)
+                if url and redis is not None:
+                    _store = RedisEventLog(url)
+                else:
+                    if url:
+                        logger.warning('redis is not installed, falling back to in-process event log')
+                    _store = MemoryEventLog()
+    return _store
+
+
+def append(room, message):
+    """给事件编号并写入日志，返回带 seq 字段的事件"""
+    store = get_store()
+    message = dict(message, seq=store.next_seq(room))
+    store.add(room, message['seq'], json.dumps(message))
+    return message
+
+
+def current_seq(room):
+    return get_store().current(room)
+
+
+def events_since(room, last_seq):
+    """读取客户端错过的事件
+
+    Returns:
+        tuple: (当前序号, 事件列表)；缺失的事件已不在日志中时事件列表为 None，需要发送快照
+    """
+    current, oldest, events = get_store().read(room, last_seq)
+    if last_seq > current:
+        # 客户端的序号比服务端还新，日志已被重置
+        return current, None
+    if last_seq == current:
+        return current, []
+    if oldest is None or oldest > last_seq + 1:
+        return current, None
+    return current, [json.loads(payload) for _, payload in events]
@@ -0,0 +1,38 @@
+import django_filters
+from django.utils.dateparse import parse_datetime
+
+from .models import NodeEditLog
+
+
+class NodeEditLogFilter(django_filters.FilterSet):
+    """编辑日志过滤条件
+
+    每个条件都对应 NodeEditLog 上以时间倒序的索引；同样的条件通过
+    matches_record 作用于归档记录，保证在线和归档日志的过滤结果一致。
+    """
+    node = django_filters.CharFilter(field_name='node_uid', help_text='节点UID')
+    user = django_filters.NumberFilter(field_name='user_id', help_text='操作用户ID')
+    action = django_filters.ChoiceFilter(choices=NodeEditLog.ACTION_CHOICES)
+    since = django_filters.IsoDateTimeFilter(field_name='timestamp', lookup_expr='gte', help_text='起始时间（含）')
+    until = django_filters.IsoDateTimeFilter(field_name='timestamp', lookup_expr='lt', help_text='截止时间（不含）')
+
+    class Meta:
+        model = NodeEditLog
+        fields = ['node', 'user', 'action', 'since', 'until']
+
+    def matches_record(self, record):
+        """判断归档记录是否满足当前过滤条件"""
+        data = self.form.cleaned_data
+        if data.get('node') and record['node_uid'] != data['node']:
+            return False
+        if data.get('user') is not None and record['user']['id'] != int(data['user']):
+            return False
+        if data.get('action') and record['action'] != data['action']:
+            return False
+        if data.get('since') or data.get('until'):
+            timestamp = parse_datetime(record['timestamp'])
+            if data.get('since') and timestamp < data['since']:
+                return False
+            if data.get('until') and timestamp >= data['until']:
+                return False
+        return True
@@ -0,0 +1,175 @@
+"""单进程部署使用的进程内通道层
+
+与 channels 自带的 InMemoryChannelLayer 接口和配置相同（expiry、group_expiry、capacity、
+channel_capacity），针对协作房间的广播做了简化：
+
+- 不复制消息：group_send 把同一个消息对象直接放进每个成员通道的队列，
+  接收方必须把消息当作只读（MindMapConsumer 只读取预先编码好的帧）；
+- 同步投递：不为每个成员创建任务，队列满的通道直接丢弃这条消息；
+- 过期清理按周期进行，而不是每次发送都扫描全部通道和组；
+- 记录通道到组的反向索引，清理过期通道时不必遍历所有组。
+
+只能在单个进程内使用，多进程部署仍需 Redis 通道层。
+"""
+import asyncio
+import time
+import uuid
+from collections import deque
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+# 过期清理的最短间隔（秒）
+SWEEP_INTERVAL = 1
+
+
+class _Mailbox:
+    """一个通道的有界消息队列"""
+
+    __slots__ = ('messages', 'capacity', 'waiter')
+
+    def __init__(self, capacity):
+        self.messages = deque()
+        self.capacity = capacity
+        self.waiter = None
+
+    def put(self, expires, message):
+        if len(self.messages) >= self.capacity:
+            return False
+        self.messages.append((expires, message))
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        return True
+
+    def expired(self, now):
+        return bool(self.messages) and self.messages[0][0] < now
+
+
+class FastInMemoryChannelLayer(BaseChannelLayer):
+    """进程内通道层，广播直接投递到各通道的队列"""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(
+            expiry=expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+            **kwargs,
+        )
+        self.group_expiry = group_expiry
+        self.channels = {}
+        self.groups = {}
+        self._channel_groups = {}
+        self._next_sweep = 0
+        # 因队列已满被丢弃的消息数
+        self.dropped = 0
+
+    def _mailbox(self, channel):
+        mailbox = self.channels.get(channel)
+        if mailbox is None:
+            mailbox = self.channels[channel] = _Mailbox(self.get_capacity(channel))
+        return mailbox
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        if not self._mailbox(channel).put(time.time() + self.expiry, message):
+            self.dropped += 1
+            raise ChannelFull(channel)
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        mailbox = self._mailbox(channel)
+        while True:
+            now = time.time()
+            while mailbox.expired(now):
+                # 消息过期说明接收方已不在，按 channels 的约定退出所有组
+                mailbox.messages.popleft()
+                self._remove_from_groups(channel)
+            if mailbox.messages:
+                return mailbox.messages.popleft()[1]
+            mailbox.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await mailbox.waiter
+            finally:
+                mailbox.waiter = None
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}.inmemory!{uuid.uuid4().hex[:12]}'
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, {})[channel] = time.time()
+        self._channel_groups.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        self._maybe_sweep()
+        members = self.groups.get(group)
+        if not members:
+            return
+        expires = time.time() + self.expiry
+        for channel in list(members):
+            if not self._mailbox(channel).put(expires, message):
+                self.dropped += 1
+
+    # Flush extension
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        self._channel_groups = {}
+
+    async def close(self):
+        pass
+
+    # Expire cleanup
+
+    def _discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        groups = self._channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self._channel_groups[channel]
+
+    def _remove_from_groups(self, channel):
+        for group in list(self._channel_groups.get(channel, ())):
+            self._discard(group, channel)
+
+    def _maybe_sweep(self):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + SWEEP_INTERVAL
+
+        for channel, mailbox in list(self.channels.items()):
+            if mailbox.expired(now):
+                while mailbox.expired(now):
+                    mailbox.messages.popleft()
+                self._remove_from_groups(channel)
+            # 没有接收方等待、也不在任何组里的空队列不再需要
+            if not mailbox.messages and mailbox.waiter is None and channel not in self._channel_groups:
+                del self.channels[channel]
+
+        cutoff = now - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined_at in list(members.items()):
+                if joined_at < cutoff:
+                    self._discard(group, channel)
@@ -0,0 +1,26 @@
+"""ASGI lifespan 处理
+
+支持 lifespan 协议的服务器（如 uvicorn）在进程退出前会发送 lifespan.shutdown，
+此时写回内存中缓冲的节点编辑和协同文本。Daphne 不发送 lifespan 事件，
+退出时依靠连接断开触发的写回。
+"""
+import logging
+
+from .write_buffer import flush_pending_edits
+
+logger = logging.getLogger(__name__)
+
+
+class LifespanApp:
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                try:
+                    await flush_pending_edits()
+                except Exception as e:
+                    logger.error(f"Failed to flush pending edits on shutdown: {str(e)}")
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
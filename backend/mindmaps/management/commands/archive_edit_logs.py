@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mindmaps.edit_log_archive import archive_edit_logs, get_archive_root
+
+
+class Command(BaseCommand):
+    help = '将过期的节点编辑日志归档为按案件、按月分区的 gzip NDJSON 文件'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            help='归档多少天之前的日志（默认使用 EDIT_LOG_RETENTION_DAYS）'
+        )
+        parser.add_argument(
+            '--before',
+            help='归档该日期之前的日志，格式 YYYY-MM-DD，优先于 --days'
+        )
+        parser.add_argument(
+            '--project-id',
+            type=int,
+            help='只归档指定项目ID的日志'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='每批处理的日志条数'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='只统计将被归档的日志，不写入文件也不删除'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('before'):
+            try:
+                before = datetime.strptime(options['before'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--before 格式应为 YYYY-MM-DD')
+            before = timezone.make_aware(before)
+        else:
+            days = options.get('days')
+            if days is None:
+                days = getattr(settings, 'EDIT_LOG_RETENTION_DAYS', 180)
+            before = timezone.now() - timedelta(days=days)
+
+        dry_run = options.get('dry_run', False)
+        result = archive_edit_logs(
+            before,
+            project_id=options.get('project_id'),
+            batch_size=options['batch_size'],
+            dry_run=dry_run
+        )
+
+        if dry_run:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'试运行：{result["archived"]} 条早于 {before:%Y-%m-%d %H:%M} 的日志'
+                    f'将归档到 {len(result["archives"])} 个文件'
+                )
+            )
+            return
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'已归档 {result["archived"]} 条日志，涉及 {len(result["archives"])} 个归档文件'
+                f'（目录: {get_archive_root()}）'
+            )
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from projects.models import Project
+from mindmaps.entities import backfill
+
+
+class Command(BaseCommand):
+    help = '为已有节点抽取手机号、身份证号、银行卡号和IP地址，分批写入实体索引'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--project-id',
+            type=int,
+            help='只处理指定项目ID'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='每批处理的节点数'
+        )
+
+    def handle(self, *args, **options):
+        project_id = options.get('project_id')
+        if project_id and not Project.objects.filter(id=project_id).exists():
+            self.stdout.write(self.style.ERROR(f'项目 ID {project_id} 不存在'))
+            return
+
+        node_count, entity_count = backfill(project_id=project_id, chunk_size=max(1, options['chunk_size']))
+        self.stdout.write(self.style.SUCCESS(f'已处理 {node_count} 个节点，索引中共 {entity_count} 个实体'))
@@ -0,0 +1,235 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+# 被测接口：名称 -> 地址模板
+ENDPOINTS = {
+    'simple_mind_map': '/api/projects/{project_id}/nodes/simple-mind-map/',
+    'tree': '/api/projects/{project_id}/nodes/tree/',
+    'nodes': '/api/projects/{project_id}/nodes/',
+    'dashboard': '/api/users/dashboard/',
+    'projects': '/api/projects/',
+    'logs': '/api/projects/{project_id}/nodes/logs/',
+}
+
+# 每个节点的子节点数，决定合成思维导图的深度
+BRANCHING = 8
+
+
+def _parse_budget(value):
+    """解析 名称=查询数[:毫秒]，两部分都可以留空"""
+    name, sep, rest = value.partition('=')
+    name = name.strip()
+    if not sep or name not in ENDPOINTS:
+        raise CommandError(f"预算格式应为 接口=查询数[:毫秒]，接口可选 {', '.join(ENDPOINTS)}")
+    queries, _, ms = rest.partition(':')
+    try:
+        return name, (int(queries) if queries else None, float(ms) if ms else None)
+    except ValueError:
+        raise CommandError(f'预算格式错误: {value}')
+
+
+class QueryCounter:
+    """统计执行的查询数；不依赖 connection.queries，大接口超过日志上限时也能准确计数"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = '在合成数据上测量思维导图和案件 REST 接口的耗时和查询数，超出预算时返回失败'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='100,1000,10000',
+            help='合成案件的节点数，逗号分隔，每个规模生成一个案件'
+        )
+        parser.add_argument('--repeat', type=int, default=3, help='每个接口请求的次数，耗时取中位数')
+        parser.add_argument(
+            '--endpoints',
+            default=','.join(ENDPOINTS),
+            help=f"要测量的接口，逗号分隔，可选 {', '.join(ENDPOINTS)}"
+        )
+        parser.add_argument('--max-queries', type=int, help='所有接口的查询数预算')
+        parser.add_argument('--max-ms', type=float, help='所有接口的耗时预算（毫秒）')
+        parser.add_argument(
+            '--budget',
+            action='append',
+            default=[],
+            help='单个接口的预算，格式 接口=查询数[:毫秒]，可重复，覆盖 --max-queries/--max-ms'
+        )
+        parser.add_argument('--image-ratio', type=float, default=0.05, help='带图片的节点比例')
+        parser.add_argument('--attachment-ratio', type=float, default=0.05, help='带附件的节点比例')
+        parser.add_argument('--line-ratio', type=float, default=0.05, help='带关联线的节点比例')
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = list(dict.fromkeys(int(size) for size in options['sizes'].split(',') if size.strip()))
+        except ValueError:
+            raise CommandError('--sizes 必须是逗号分隔的整数')
+        if not sizes or min(sizes) < 1:
+            raise CommandError('--sizes 至少需要一个正整数')
+        endpoints = [name.strip() for name in options['endpoints'].split(',') if name.strip()]
+        unknown = [name for name in endpoints if name not in ENDPOINTS]
+        if unknown:
+            raise CommandError(f"未知的接口: {', '.join(unknown)}")
+        budgets = dict(_parse_budget(value) for value in options['budget'])
+
+        # 在临时测试数据库中运行，不影响正式数据
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                results = self.run_benchmark(sizes, endpoints, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        failures = []
+        self.stdout.write(f"{'接口':<18}{'节点数':>8}{'状态':>6}{'查询数':>8}{'中位(ms)':>10}{'最大(ms)':>10}")
+        for name, size, status_code, queries, timings in results:
+            max_queries, max_ms = budgets.get(name, (None, None))
+            if max_queries is None:
+                max_queries = options.get('max_queries')
+            if max_ms is None:
+                max_ms = options.get('max_ms')
+            median_ms = statistics.median(timings) * 1000
+            problems = []
+            if status_code != 200:
+                problems.append(f'状态码 {status_code}')
+            if max_queries is not None and queries > max_queries:
+                problems.append(f'查询数 {queries} > {max_queries}')
+            if max_ms is not None and median_ms > max_ms:
+                problems.append(f'耗时 {median_ms:.1f}ms > {max_ms:g}ms')
+
+            line = (
+                f'{name:<18}{size:>8}{status_code:>6}{queries:>8}'
+                f'{median_ms:>10.1f}{max(timings) * 1000:>10.1f}'
+            )
+            if problems:
+                failures.append(f"{name}（{size} 个节点）: {'，'.join(problems)}")
+                self.stdout.write(self.style.ERROR(f"{line}  {'，'.join(problems)}"))
+            else:
+                self.stdout.write(line)
+
+        if failures:
+            raise CommandError(f'{len(failures)} 项超出预算')
+        self.stdout.write(self.style.SUCCESS('全部接口在预算之内'))
+
+    def run_benchmark(self, sizes, endpoints, options):
+        from users.models import CustomUser
+
+        user = CustomUser.objects.create_user(
+            username='bench_api', password='bench', real_name='基准测试',
+            police_number='BENCH0', phone_number='13800000000'
+        )
+        rng = random.Random(options['seed'])
+        projects = []
+        for size in sizes:
+            started = time.perf_counter()
+            project = self.create_project(user, size, rng, options)
+            self.stdout.write(f'生成 {size} 个节点的案件，用时 {time.perf_counter() - started:.1f} 秒')
+            projects.append((size, project))
+
+        client = APIClient()
+        client.force_authenticate(user=user)
+        results = []
+        for size, project in projects:
+            for name in endpoints:
+                url = ENDPOINTS[name].format(project_id=project.id)
+                timings = []
+                queries = 0
+                status_code = None
+                for _ in range(max(1, options['repeat'])):
+                    counter = QueryCounter()
+                    with connection.execute_wrapper(counter):
+                        started = time.perf_counter()
+                        response = client.get(url)
+                        timings.append(time.perf_counter() - started)
+                    queries = max(queries, counter.count)
+                    status_code = response.status_code
+                results.append((name, size, status_code, queries, timings))
+        return results
+
+    def create_project(self, user, size, rng, options):
+        """生成一个案件：size 个节点的树，按比例附带图片、附件、关联线和创建日志"""
+        from projects.models import Project, ProjectMember
+        from mindmaps.models import MindMapNode, NodeImage, NodeAttachment, AssociativeLine, NodeEditLog
+
+        project = Project.objects.create(
+            name=f'基准测试案件{size}', case_number=f'BENCH{size}',
+            filing_unit='direct', case_summary='基准测试', creator=user
+        )
+        ProjectMember.objects.get_or_create(project=project, user=user, defaults={'permission': 'edit'})
+
+        # 创建案件时会生成默认思维导图，合成节点挂在它的根节点下
+        root = MindMapNode.objects.filter(project=project, is_root=True).first()
+        if root is None:
+            root = MindMapNode.objects.create(
+                project=project, node_id=f'node_bench_{size}_root', parent_node_uid='',
+                creator=user, text=project.name, is_root=True
+            )
+        existing = MindMapNode.objects.filter(project=project).count()
+
+        nodes = []
+        parents = [root]
+        for index in range(max(0, size - existing)):
+            parent = parents[index // BRANCHING] if index // BRANCHING < len(parents) else root
+            node = MindMapNode(
+                project=project,
+                node_id=f'node_bench_{size}_{index}',
+                parent_node_uid=parent.node_id,
+                creator=user,
+                text=f'节点 {index}',
+                note='备注' * rng.randint(0, 20),
+                tags=['线索'] if index % 7 == 0 else [],
+                level=parent.level + 1,
+                sort_order=index % BRANCHING,
+            )
+            nodes.append(node)
+            parents.append(node)
+        MindMapNode.objects.bulk_create(nodes, batch_size=1000)
+        nodes = list(MindMapNode.objects.filter(project=project, node_id__in=[node.node_id for node in nodes]))
+
+        images = []
+        attachments = []
+        lines = []
+        sources = []
+        for node in nodes:
+            if rng.random() < options['image_ratio']:
+                images.append(NodeImage(
+                    node=node, file=f'node_images/bench/{node.node_id}.png',
+                    original_name='bench.png', file_size=1024, width=100, height=100, uploader=user
+                ))
+            if rng.random() < options['attachment_ratio']:
+                attachments.append(NodeAttachment(
+                    node=node, file=f'node_attachments/bench/{node.node_id}.pdf',
+                    original_name='bench.pdf', file_size=4096, uploader=user
+                ))
+            if rng.random() < options['line_ratio']:
+                target = rng.choice(nodes)
+                if target is not node and target.node_id not in node.associative_line_targets:
+                    node.associative_line_targets = [target.node_id]
+                    node.associative_line_text = {target.node_id: '关联'}
+                    lines.append(AssociativeLine(
+                        project=project, source_node=node, target_node=target,
+                        text='关联', creator=user
+                    ))
+                    sources.append(node)
+        NodeImage.objects.bulk_create(images, batch_size=1000)
+        NodeAttachment.objects.bulk_create(attachments, batch_size=1000)
+        AssociativeLine.objects.bulk_create(lines, batch_size=1000)
+        MindMapNode.objects.bulk_update(
+            sources, ['associative_line_targets', 'associative_line_text'], batch_size=1000
+        )
+        NodeEditLog.record_many(user, [(node, 'create', None) for node in nodes])
+        return project
@@ -0,0 +1,158 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+from mindmaps import protocol
+
+LAYER_BACKENDS = {
+    'fast': 'mindmaps.layers.FastInMemoryChannelLayer',
+    'inmemory': 'channels.layers.InMemoryChannelLayer',
+    'redis': 'channels_redis.core.RedisChannelLayer',
+}
+
+
+def _node_message(index):
+    """与 MindMapConsumer 广播的 node_updated 事件大小相近的消息"""
+    node_uid = f'node_bench_{index % 50}'
+    return {
+        'type': 'node_updated',
+        'node': {
+            'id': node_uid,
+            'text': f'节点内容 {index} ' * 4,
+            'rich_text': False,
+            'expand': True,
+            'icon': [],
+            'hyperlink': '',
+            'hyperlink_title': '',
+            'note': '备注' * 20,
+            'tags': ['线索'],
+            'creator': 'bench',
+            'created_at': '2025-01-01T00:00:00+08:00',
+            'parent_id': 'node_bench_root',
+            'version': index,
+        },
+        'user': 'bench',
+        'seq': index,
+    }
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = '用 MindMapConsumer 的广播负载比较通道层：房间内每条事件投递给所有连接的吞吐量和延迟'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--layers',
+            default='fast,inmemory',
+            help=f"要比较的通道层，逗号分隔，可选 {', '.join(LAYER_BACKENDS)}"
+        )
+        parser.add_argument('--rooms', type=int, default=4, help='房间数')
+        parser.add_argument('--clients', type=int, default=25, help='每个房间的连接数')
+        parser.add_argument('--messages', type=int, default=500, help='每个房间广播的事件数')
+        parser.add_argument(
+            '--cursor-ratio',
+            type=float,
+            default=0.5,
+            help='事件中光标移动（小消息）所占比例'
+        )
+        parser.add_argument('--capacity', type=int, default=1000, help='每个通道的队列容量')
+        parser.add_argument(
+            '--redis-url',
+            default='redis://127.0.0.1:6379/2',
+            help='redis 通道层使用的 Redis 地址'
+        )
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['layers'].split(',') if name.strip()]
+        unknown = [name for name in names if name not in LAYER_BACKENDS]
+        if unknown:
+            raise CommandError(f"未知的通道层: {', '.join(unknown)}")
+
+        self.stdout.write(
+            f"{options['rooms']} 个房间 × {options['clients']} 个连接，"
+            f"每个房间 {options['messages']} 条事件"
+        )
+        self.stdout.write(f"{'通道层':<10}{'耗时(s)':>10}{'投递/秒':>12}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'丢失':>8}")
+        for name in names:
+            try:
+                layer = self.make_layer(name, options)
+            except ImportError as e:
+                self.stdout.write(self.style.WARNING(f'{name:<10}跳过: {e}'))
+                continue
+            try:
+                result = asyncio.run(self.run_benchmark(layer, options))
+            except Exception as e:
+                self.stdout.write(self.style.ERROR(f'{name:<10}失败: {e}'))
+                continue
+            latencies = result['latencies']
+            self.stdout.write(
+                f"{name:<10}{result['elapsed']:>10.3f}{len(latencies) / result['elapsed']:>12.0f}"
+                f"{_percentile(latencies, 50) * 1000:>10.2f}{_percentile(latencies, 95) * 1000:>10.2f}"
+                f"{_percentile(latencies, 99) * 1000:>10.2f}{result['lost']:>8}"
+            )
+
+    def make_layer(self, name, options):
+        config = {'capacity': options['capacity']}
+        if name == 'redis':
+            config['hosts'] = [options['redis_url']]
+        return import_string(LAYER_BACKENDS[name])(**config)
+
+    async def run_benchmark(self, layer, options):
+        rooms = [f"mindmap_bench_{index}" for index in range(options['rooms'])]
+        expected = options['messages'] * options['clients'] * len(rooms)
+        latencies = []
+
+        # 事件在发送方编码一次，与 MindMapConsumer.broadcast 相同
+        cursor_every = round(1 / options['cursor_ratio']) if options['cursor_ratio'] > 0 else 0
+        events = []
+        for index in range(options['messages']):
+            if cursor_every and index % cursor_every == 0:
+                events.append({'type': 'cursor_moved', 'user': 'bench', 'x': index, 'y': index})
+            else:
+                message = _node_message(index)
+                events.append({
+                    'type': 'node_updated',
+                    'frame': protocol.encode_broadcast(message),
+                    'merge_key': message['node']['id'],
+                })
+
+        async def client(channel):
+            for _ in range(options['messages']):
+                event = await layer.receive(channel)
+                latencies.append(time.perf_counter() - event['sent_at'])
+
+        async def sender(room):
+            for event in events:
+                await layer.group_send(room, dict(event, sent_at=time.perf_counter()))
+                # 与真实连接一样，每条事件之间让出事件循环
+                await asyncio.sleep(0)
+
+        clients = []
+        for room in rooms:
+            for _ in range(options['clients']):
+                channel = await layer.new_channel()
+                await layer.group_add(room, channel)
+                clients.append(asyncio.ensure_future(client(channel)))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(room) for room in rooms))
+        # 队列满丢弃的事件永远收不到，等待一段时间后结束
+        done, pending = await asyncio.wait(clients, timeout=10)
+        elapsed = time.perf_counter() - started
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await layer.flush()
+        return {
+            'elapsed': elapsed,
+            'latencies': latencies,
+            'lost': expected - len(latencies),
+        }
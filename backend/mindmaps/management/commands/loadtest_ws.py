@@ -0,0 +1,349 @@
+import asyncio
+import contextvars
+import json
+import random
+import time
+from collections import Counter, defaultdict
+
+from asgiref.testing import ApplicationCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from mindmaps import protocol
+from mindmaps.consumers import MindMapConsumer
+from mindmaps.write_buffer import flush_pending_edits
+
+# 当前正在处理的消息类型，用于把数据库查询归到消息类型上
+current_message_type = contextvars.ContextVar('current_message_type', default='other')
+
+LAYER_BACKENDS = {
+    'fast': 'mindmaps.layers.FastInMemoryChannelLayer',
+    'inmemory': 'channels.layers.InMemoryChannelLayer',
+}
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ('create', 'update', 'cursor'):
+            raise CommandError(f'未知的消息类型: {name}')
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise CommandError(f'权重格式错误: {part}')
+    if not any(mix.values()):
+        raise CommandError('--mix 至少需要一种消息')
+    return mix
+
+
+class InstrumentedConsumer(MindMapConsumer):
+    """记录每条消息处理期间（包括它派生的延迟写回任务）执行的查询"""
+
+    async def websocket_connect(self, message):
+        current_message_type.set('connect')
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        current_message_type.set('disconnect')
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            message_type = json.loads(text_data).get('type', 'other')
+        except (TypeError, ValueError, AttributeError):
+            message_type = 'other'
+        current_message_type.set(message_type)
+        await super().receive(text_data=text_data, bytes_data=bytes_data)
+
+
+class SimulatedClient:
+    """一个模拟的协作用户：按配置的比例和速率发送消息，并记录收到的广播"""
+
+    def __init__(self, harness, application, user, project, index, subprotocols):
+        self.harness = harness
+        self.user = user
+        self.project = project
+        self.index = index
+        self.own_nodes = []
+        self.sent = 0
+        self.received = 0
+        self.communicator = ApplicationCommunicator(application, {
+            'type': 'websocket',
+            'path': f'/ws/mindmap/{project.id}/',
+            'query_string': b'',
+            'headers': [],
+            'subprotocols': subprotocols,
+            'user': user,
+            'url_route': {'kwargs': {'project_id': str(project.id)}},
+        })
+
+    async def connect(self):
+        await self.communicator.send_input({'type': 'websocket.connect'})
+        response = await self.communicator.receive_output(timeout=10)
+        if response['type'] != 'websocket.accept':
+            raise CommandError(f'连接被拒绝: {response}')
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            output = await self.communicator.output_queue.get()
+            if output['type'] != 'websocket.send':
+                return
+            message = protocol.decode(output.get('text'), output.get('bytes'))
+            self.received += 1
+            self.harness.on_message(self, message)
+
+    async def send(self, message):
+        self.sent += 1
+        await self.communicator.send_input({'type': 'websocket.receive', 'text': json.dumps(message)})
+
+    async def run(self, duration, rate, mix, rng):
+        names = list(mix)
+        weights = [mix[name] for name in names]
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            kind = rng.choices(names, weights)[0]
+            if kind == 'update' and not self.own_nodes:
+                kind = 'create'
+            marker = self.harness.mark(kind, self)
+            if kind == 'create':
+                node_uid = f'node_lt_{marker}'
+                self.own_nodes.append(node_uid)
+                await self.send({
+                    'type': 'node_create',
+                    'parent_id': self.harness.roots[self.project.id],
+                    'node_data': {'uid': node_uid, 'text': f'lt {marker}'},
+                })
+            elif kind == 'update':
+                await self.send({
+                    'type': 'node_update',
+                    'node_id': rng.choice(self.own_nodes),
+                    'updates': {'text': f'lt {marker}'},
+                })
+            else:
+                await self.send({'type': 'cursor_move', 'x': marker, 'y': self.index})
+            # 泊松到达，平均每秒 rate 条
+            await asyncio.sleep(rng.expovariate(rate))
+
+    async def close(self):
+        await self.communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        try:
+            await self.communicator.wait(timeout=10)
+        except Exception:
+            pass
+        self.reader.cancel()
+
+
+class Harness:
+    def __init__(self):
+        self.roots = {}
+        self.sent_at = {}
+        # cursors 帧是完整快照，同一编号在后续帧中重复出现，每个接收方只记录一次
+        self.received = set()
+        self.next_marker = 0
+        self.latencies = defaultdict(list)
+        self.sent_counts = Counter()
+        self.errors = Counter()
+        self.query_counts = Counter()
+        self.handled_counts = Counter()
+
+    def mark(self, kind, client):
+        """为一条消息分配编号，广播中带回这个编号以计算扇出延迟"""
+        self.next_marker += 1
+        self.sent_at[self.next_marker] = (kind, client, time.perf_counter())
+        self.sent_counts[kind] += 1
+        return self.next_marker
+
+    def _record(self, marker, receiver):
+        sent = self.sent_at.get(marker)
+        if sent is None:
+            return
+        kind, sender, sent_at = sent
+        if (marker, id(receiver)) in self.received:
+            return
+        self.received.add((marker, id(receiver)))
+        if sender is not receiver:
+            self.latencies[kind].append(time.perf_counter() - sent_at)
+
+    def on_message(self, client, message):
+        message_type = message.get('type')
+        if message_type in ('node_created', 'node_updated'):
+            text = message['node'].get('text') or ''
+            if text.startswith('lt '):
+                self._record(int(text[3:]), client)
+        elif message_type == 'cursors':
+            for cursor in message['cursors']:
+                self._record(cursor['x'], client)
+        elif message_type == 'error':
+            self.errors[message.get('message')] += 1
+
+    def count_query(self, execute, sql, params, many, context):
+        self.query_counts[current_message_type.get()] += 1
+        return execute(sql, params, many, context)
+
+
+class Command(BaseCommand):
+    help = '用模拟的协作用户压测思维导图 WebSocket：吞吐量、广播扇出延迟和每类消息的数据库查询数'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='模拟的连接数')
+        parser.add_argument('--rooms', type=int, default=5, help='案件房间数，连接平均分配到各房间')
+        parser.add_argument('--duration', type=float, default=10, help='发送消息的时长（秒）')
+        parser.add_argument('--rate', type=float, default=5, help='每个连接每秒平均发送的消息数')
+        parser.add_argument(
+            '--mix',
+            default='create=1,update=6,cursor=3',
+            help='消息类型比例，可选 create、update、cursor'
+        )
+        parser.add_argument(
+            '--layer',
+            choices=sorted(LAYER_BACKENDS),
+            default='fast',
+            help='使用的进程内通道层'
+        )
+        parser.add_argument(
+            '--protocol',
+            choices=[protocol.JSON, protocol.MSGPACK],
+            default=protocol.JSON,
+            help='连接协商的消息编码'
+        )
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['rooms'] < 1 or options['rate'] <= 0:
+            raise CommandError('--clients、--rooms、--rate 必须为正数')
+        mix = _parse_mix(options['mix'])
+
+        # 在临时测试数据库中运行，不影响正式数据
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        harness = Harness()
+
+        def install_wrapper(sender, connection, **kwargs):
+            connection.execute_wrappers.append(harness.count_query)
+
+        connection_created.connect(install_wrapper)
+        try:
+            with override_settings(
+                CHANNEL_LAYERS={'default': {'BACKEND': LAYER_BACKENDS[options['layer']]}},
+                MINDMAP_ROOM_SHARDS=['default'],
+                MINDMAP_ROOM_SHARDS_PREVIOUS=[],
+                MINDMAP_PRESENCE_REDIS_URL=None,
+                MINDMAP_EVENT_LOG_REDIS_URL=None,
+            ):
+                elapsed, clients = asyncio.run(self.run_load(harness, options, mix))
+        finally:
+            connection_created.disconnect(install_wrapper)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.report(harness, options, elapsed, clients)
+
+    def create_fixtures(self, harness, options):
+        from users.models import CustomUser
+        from projects.models import Project, ProjectMember
+        from mindmaps.models import MindMapNode
+
+        owner = CustomUser.objects.create_user(
+            username='loadtest_owner', password='loadtest', real_name='压测',
+            police_number='LT000', phone_number='13900000000'
+        )
+        projects = []
+        for index in range(options['rooms']):
+            project = Project.objects.create(
+                name=f'压测案件{index}', case_number=f'LT{index:04d}',
+                filing_unit='direct', case_summary='压测', creator=owner
+            )
+            root = MindMapNode.objects.create(
+                project=project, node_id=f'node_lt_root_{index}', parent_node_uid='',
+                creator=owner, text='压测', is_root=True
+            )
+            harness.roots[project.id] = root.node_id
+            projects.append(project)
+
+        users = []
+        for index in range(options['clients']):
+            user = CustomUser.objects.create_user(
+                username=f'loadtest_{index}', password='loadtest', real_name=f'压测{index}',
+                police_number=f'LT{index + 1:03d}', phone_number=f'139{index + 1:08d}'
+            )
+            project = projects[index % len(projects)]
+            ProjectMember.objects.create(project=project, user=user, permission='edit')
+            users.append((user, project))
+        return users
+
+    async def run_load(self, harness, options, mix):
+        from asgiref.sync import sync_to_async
+
+        users = await sync_to_async(self.create_fixtures)(harness, options)
+        harness.query_counts.clear()
+        application = InstrumentedConsumer.as_asgi()
+        subprotocols = [protocol.MSGPACK_SUBPROTOCOL] if options['protocol'] == protocol.MSGPACK else []
+
+        clients = [
+            SimulatedClient(harness, application, user, project, index, subprotocols)
+            for index, (user, project) in enumerate(users)
+        ]
+        for client in clients:
+            await client.connect()
+
+        rng = random.Random(options['seed'])
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            client.run(options['duration'], options['rate'], mix, random.Random(rng.random()))
+            for client in clients
+        ))
+        elapsed = time.perf_counter() - started
+        # 等待最后的广播送达，再写回缓冲的修改
+        await asyncio.sleep(1)
+        current_message_type.set('flush')
+        await flush_pending_edits()
+        for client in clients:
+            await client.close()
+        return elapsed, clients
+
+    def report(self, harness, options, elapsed, clients):
+        sent = sum(client.sent for client in clients)
+        received = sum(client.received for client in clients)
+        self.stdout.write(
+            f"{options['clients']} 个连接 / {options['rooms']} 个房间，通道层 {options['layer']}，"
+            f"协议 {options['protocol']}，{elapsed:.1f} 秒"
+        )
+        self.stdout.write(f'发送 {sent} 条（{sent / elapsed:.0f} 条/秒），收到 {received} 帧（{received / elapsed:.0f} 帧/秒）')
+
+        self.stdout.write('')
+        self.stdout.write(f"{'消息类型':<14}{'发送':>8}{'扇出样本':>10}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+        for kind in ('create', 'update', 'cursor'):
+            latencies = harness.latencies.get(kind, [])
+            self.stdout.write(
+                f"{kind:<14}{harness.sent_counts[kind]:>8}{len(latencies):>10}"
+                f"{_percentile(latencies, 50) * 1000:>10.2f}{_percentile(latencies, 95) * 1000:>10.2f}"
+                f"{_percentile(latencies, 99) * 1000:>10.2f}"
+            )
+
+        self.stdout.write('')
+        handled = {
+            'node_create': harness.sent_counts['create'],
+            'node_update': harness.sent_counts['update'],
+            'cursor_move': harness.sent_counts['cursor'],
+            'connect': len(clients),
+            'disconnect': len(clients),
+        }
+        self.stdout.write(f"{'数据库查询':<14}{'查询数':>8}{'每条消息':>10}")
+        for message_type, count in sorted(harness.query_counts.items()):
+            per_message = count / handled[message_type] if handled.get(message_type) else 0
+            self.stdout.write(f'{message_type:<14}{count:>8}{per_message:>10.2f}')
+
+        if harness.errors:
+            self.stdout.write('')
+            for message, count in harness.errors.most_common():
+                self.stdout.write(self.style.WARNING(f'错误 {count} 次: {message}'))
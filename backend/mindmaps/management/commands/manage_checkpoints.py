@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from projects.models import Project
+from mindmaps.checkpoints import create_checkpoint_if_due, prune_checkpoints
+
+
+class Command(BaseCommand):
+    help = '为项目批量创建思维导图检查点，并按保留策略清理旧检查点'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--project-id',
+            type=int,
+            help='只处理指定项目ID'
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='不论是否达到创建条件都创建检查点'
+        )
+        parser.add_argument(
+            '--no-create',
+            action='store_true',
+            help='只清理旧检查点，不创建新检查点'
+        )
+        parser.add_argument(
+            '--no-prune',
+            action='store_true',
+            help='只创建检查点，不清理旧检查点'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='只统计将被清理的检查点，不创建也不删除'
+        )
+
+    def handle(self, *args, **options):
+        project_id = options.get('project_id')
+        force = options.get('force', False)
+        dry_run = options.get('dry_run', False)
+
+        projects = Project.objects.only('id', 'name').order_by('id')
+        if project_id:
+            projects = projects.filter(id=project_id)
+            if not projects.exists():
+                self.stdout.write(self.style.ERROR(f'项目 ID {project_id} 不存在'))
+                return
+
+        created_count = 0
+        pruned_count = 0
+        for project in projects.iterator():
+            if not options.get('no_create') and not dry_run:
+                try:
+                    checkpoint = create_checkpoint_if_due(project, force=force)
+                except Exception as e:
+                    self.stdout.write(
+                        self.style.ERROR(f'为项目 "{project.name}" 创建检查点失败: {str(e)}')
+                    )
+                    checkpoint = None
+                if checkpoint:
+                    created_count += 1
+                    self.stdout.write(
+                        f'项目 "{project.name}" 创建检查点：{checkpoint.node_count} 个节点，'
+                        f'{checkpoint.data_size} 字节'
+                    )
+
+            if not options.get('no_prune'):
+                pruned_count += prune_checkpoints(project, dry_run=dry_run)
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING(f'试运行：将清理 {pruned_count} 个旧检查点'))
+            return
+
+        self.stdout.write(
+            self.style.SUCCESS(f'创建了 {created_count} 个检查点，清理了 {pruned_count} 个旧检查点')
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from projects.models import Project
+from mindmaps.search import rebuild
+
+
+class Command(BaseCommand):
+    help = '重建节点全文检索索引（首次部署检索功能或索引与数据不一致时使用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--project-id',
+            type=int,
+            help='只重建指定项目的索引'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='每批处理的节点数'
+        )
+
+    def handle(self, *args, **options):
+        project_id = options.get('project_id')
+        if project_id and not Project.objects.filter(id=project_id).exists():
+            self.stdout.write(self.style.ERROR(f'项目 ID {project_id} 不存在'))
+            return
+
+        count = rebuild(project_id=project_id, chunk_size=max(1, options['chunk_size']))
+        self.stdout.write(self.style.SUCCESS(f'已索引 {count} 个节点'))
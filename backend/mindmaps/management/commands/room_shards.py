@@ -0,0 +1,68 @@
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from projects.models import Project
+from mindmaps.rooms import room_group_name
+from mindmaps.sharding import HashRing, get_shards, get_previous_shards
+
+
+class Command(BaseCommand):
+    help = '查看协作房间在通道层分片上的分布，以及调整分片时需要迁移的房间'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--shards',
+            help='预览新的分片列表（逗号分隔的通道层别名），与当前配置比较'
+        )
+        parser.add_argument(
+            '--list-moved',
+            action='store_true',
+            help='列出换到其他分片的案件ID'
+        )
+
+    def handle(self, *args, **options):
+        if options.get('shards'):
+            old_shards = get_shards()
+            new_shards = [alias.strip() for alias in options['shards'].split(',') if alias.strip()]
+        else:
+            old_shards = get_previous_shards()
+            new_shards = get_shards()
+
+        missing = [alias for alias in set(old_shards) | set(new_shards) if alias not in settings.CHANNEL_LAYERS]
+        if missing and not options.get('shards'):
+            raise CommandError(f"CHANNEL_LAYERS 中没有这些分片: {', '.join(sorted(missing))}")
+        if not new_shards:
+            raise CommandError('至少需要一个分片')
+
+        new_ring = HashRing(new_shards)
+        old_ring = HashRing(old_shards) if old_shards else None
+        project_ids = list(Project.objects.order_by('id').values_list('id', flat=True))
+
+        distribution = Counter()
+        moved = []
+        for project_id in project_ids:
+            room = room_group_name(project_id)
+            shard = new_ring.get(room)
+            distribution[shard] += 1
+            if old_ring is not None and old_ring.get(room) != shard:
+                moved.append(project_id)
+
+        self.stdout.write(f'分片: {", ".join(new_shards)}，共 {len(project_ids)} 个房间')
+        for shard in new_shards:
+            self.stdout.write(f'  {shard}: {distribution[shard]}')
+        if missing:
+            self.stdout.write(self.style.WARNING(f"CHANNEL_LAYERS 中还没有这些分片: {', '.join(sorted(missing))}"))
+
+        if old_ring is None:
+            return
+        self.stdout.write(
+            self.style.WARNING(
+                f'相对 {", ".join(old_shards)}：{len(moved)} 个房间换到其他分片'
+            )
+        )
+        if options.get('list_moved'):
+            for project_id in moved:
+                self.stdout.write(f'  {project_id}: {old_ring.get(room_group_name(project_id))} -> '
+                                  f'{new_ring.get(room_group_name(project_id))}')
@@ -0,0 +1,292 @@
+"""进程内的监控指标，以 Prometheus 文本格式从 /metrics 导出
+
+指标在模块导入时注册到 registry；热路径上的记录只是一次加锁的字典更新，
+标签值按位置传入，不构造中间对象。导出时才生成文本。
+
+- http_request_duration_seconds：每个 DRF 视图和 action 的请求耗时（MetricsMiddleware）
+- http_request_queries：每个请求执行的查询数
+- db_queries_total：各数据库连接执行的查询数
+- mindmap_ws_connections：各案件房间当前的 WebSocket 连接数
+- mindmap_ws_messages_total：MindMapConsumer 收到的各类型消息数
+- mindmap_channel_layer_send_seconds：向房间组发送事件的耗时
+- mindmap_ws_outbox_*：WebSocket 发送队列的丢弃、合并、快照次数和队列深度
+- face_login_stage_seconds：人脸登录各步骤的耗时
+
+指标只覆盖当前进程，多进程部署时每个进程分别抓取。
+"""
+import bisect
+import threading
+import time
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+
+from .profiling import view_action
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class _Metric:
+    """指标基类；提供 function 时导出时调用它取值，返回 {标签值元组: 数值}"""
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), function=None, registry=registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _items(self):
+        if self.function is not None:
+            return list(self.function().items())
+        with self._lock:
+            return list(self._values.items())
+
+    def render(self):
+        return [
+            f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}'
+            for labels, value in self._items()
+        ]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        with self._lock:
+            value = self._values.get(labels, 0) - amount
+            # 归零的标签组合不再导出，避免房间等标签无限增长
+            if value:
+                self._values[labels] = value
+            else:
+                self._values.pop(labels, None)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS, registry=registry):
+        super().__init__(name, help, labelnames, registry=registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # 各分桶（最后一个是 +Inf）的计数、总和
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = []
+        for labels, (counts, total) in self._items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', _format_value(bound))])} "
+                    f'{cumulative}'
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+            lines.append(f'{self.name}_count{label_text} {cumulative}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+# HTTP
+
+HTTP_REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds', 'HTTP 请求耗时', ('view', 'action', 'method', 'status')
+)
+HTTP_REQUEST_QUERIES = Histogram(
+    'http_request_queries', '每个 HTTP 请求执行的查询数', ('view', 'action'),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+
+# 数据库
+
+DB_QUERIES = Counter('db_queries_total', '执行的数据库查询数', ('alias',))
+
+# WebSocket 和通道层
+
+WS_CONNECTIONS = Gauge('mindmap_ws_connections', '案件房间当前的 WebSocket 连接数', ('project',))
+WS_MESSAGES = Counter('mindmap_ws_messages_total', 'MindMapConsumer 收到的消息数', ('type',))
+CHANNEL_LAYER_SEND = Histogram(
+    'mindmap_channel_layer_send_seconds', '向房间组发送事件的耗时', ('alias',),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+)
+
+
+def _outbox_totals():
+    from mindmaps.outbox import totals
+    return {(key,): totals[key] for key in ('dropped', 'merged', 'resyncs')}
+
+
+def _outbox_depth():
+    from mindmaps.outbox import get_stats
+    stats = get_stats()
+    return {('queued',): stats['queued'], ('max',): stats['max_depth'], ('peak',): stats['peak_depth']}
+
+
+Counter(
+    'mindmap_ws_outbox_events_total', 'WebSocket 发送队列累计丢弃、合并的事件和发送的快照数', ('kind',),
+    function=_outbox_totals
+)
+Gauge(
+    'mindmap_ws_outbox_depth', 'WebSocket 发送队列积压的帧数：全部连接合计、当前最深、历史最深', ('kind',),
+    function=_outbox_depth
+)
+
+# 人脸登录
+
+FACE_LOGIN_STAGE = Histogram(
+    'face_login_stage_seconds', '人脸登录各步骤的耗时', ('stage', 'result'),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+)
+
+
+# 查询计数
+
+_local = threading.local()
+
+
+def _count_query(execute, sql, params, many, context):
+    _local.queries = getattr(_local, 'queries', 0) + 1
+    DB_QUERIES.inc(context['connection'].alias)
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(install_query_counter)
+
+
+def thread_query_count():
+    """当前线程累计执行的查询数，请求前后相减得到本次请求的查询数"""
+    return getattr(_local, 'queries', 0)
+
+
+# HTTP 中间件和导出接口
+
+class MetricsMiddleware:
+    """按 DRF 视图和 action 记录请求耗时和查询数"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        queries = thread_query_count()
+        request._metrics_view = ('unmatched', '')
+        response = self.get_response(request)
+        view, action = request._metrics_view
+        HTTP_REQUEST_DURATION.observe(
+            time.perf_counter() - started, view, action, request.method, f'{response.status_code // 100}xx'
+        )
+        HTTP_REQUEST_QUERIES.observe(thread_query_count() - queries, view, action)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view, action = view_action(request, view_func)
+        request._metrics_view = (view, action or '')
+        return None
+
+
+def _client_allowed(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated and (user.is_staff or user.is_superuser):
+        return True
+    token = getattr(settings, 'MINDMAP_METRICS_TOKEN', None)
+    if token and constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    # 反向代理转发的请求 REMOTE_ADDR 都是代理地址，默认不放行任何地址
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'MINDMAP_METRICS_ALLOWED_IPS', [])
+
+
+def metrics_view(request):
+    """Prometheus 抓取接口 - 仅允许管理员、带 MINDMAP_METRICS_TOKEN 的请求和 MINDMAP_METRICS_ALLOWED_IPS 中的地址访问"""
+    if not _client_allowed(request):
+        return HttpResponseForbidden('权限不足')
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,83 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:24
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_log_project(apps, schema_editor):
+    """为已有日志补全所属案件和节点UID"""
+    NodeEditLog = apps.get_model('mindmaps', 'NodeEditLog')
+    MindMapNode = apps.get_model('mindmaps', 'MindMapNode')
+    node_ids = NodeEditLog.objects.filter(project__isnull=True).values_list('node_id', flat=True).distinct()
+    for node in MindMapNode.objects.filter(id__in=list(node_ids)).only('id', 'project_id', 'node_id'):
+        NodeEditLog.objects.filter(node_id=node.id).update(
+            project_id=node.project_id,
+            node_uid=node.node_id,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0001_initial'),
+        ('projects', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EditLogArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(help_text='格式 YYYY-MM', max_length=7, verbose_name='归档月份')),
+                ('file_path', models.CharField(help_text='相对于归档根目录', max_length=255, verbose_name='归档文件路径')),
+                ('entry_count', models.PositiveIntegerField(default=0, verbose_name='日志条数')),
+                ('file_size', models.PositiveBigIntegerField(default=0, verbose_name='文件大小(字节)')),
+                ('first_timestamp', models.DateTimeField(verbose_name='最早操作时间')),
+                ('first_log_id', models.BigIntegerField(verbose_name='最早日志ID')),
+                ('last_timestamp', models.DateTimeField(verbose_name='最晚操作时间')),
+                ('last_log_id', models.BigIntegerField(verbose_name='最晚日志ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '编辑日志归档',
+                'verbose_name_plural': '编辑日志归档',
+                'ordering': ['-month'],
+            },
+        ),
+        migrations.AddField(
+            model_name='nodeeditlog',
+            name='node_uid',
+            field=models.CharField(blank=True, max_length=100, verbose_name='节点UID'),
+        ),
+        migrations.AddField(
+            model_name='nodeeditlog',
+            name='project',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='edit_logs', to='projects.project', verbose_name='所属案件'),
+        ),
+        migrations.AlterField(
+            model_name='nodeeditlog',
+            name='node',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='edit_logs', to='mindmaps.mindmapnode', verbose_name='节点'),
+        ),
+        migrations.AddIndex(
+            model_name='nodeeditlog',
+            index=models.Index(fields=['project', '-timestamp', '-id'], name='mindmaps_no_project_c69248_idx'),
+        ),
+        migrations.RunPython(backfill_log_project, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='editlogarchive',
+            name='project',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='edit_log_archives', to='projects.project', verbose_name='所属案件'),
+        ),
+        migrations.AddIndex(
+            model_name='editlogarchive',
+            index=models.Index(fields=['project', '-last_timestamp'], name='mindmaps_ed_project_9589ac_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='editlogarchive',
+            unique_together={('project', 'month')},
+        ),
+    ]
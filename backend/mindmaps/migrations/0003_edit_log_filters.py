@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:27
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0002_edit_log_archive'),
+        ('projects', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nodeeditlog',
+            name='action',
+            field=models.CharField(choices=[('create', '创建'), ('update', '更新'), ('delete', '删除'), ('move', '移动')], max_length=10, verbose_name='操作类型'),
+        ),
+        migrations.AddIndex(
+            model_name='nodeeditlog',
+            index=models.Index(fields=['node_uid', '-timestamp'], name='mindmaps_no_node_ui_9e5bdd_idx'),
+        ),
+    ]
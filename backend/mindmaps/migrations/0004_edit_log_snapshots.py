@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0003_edit_log_filters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nodeeditlog',
+            name='is_snapshot',
+            field=models.BooleanField(default=False, verbose_name='是否完整快照'),
+        ),
+    ]
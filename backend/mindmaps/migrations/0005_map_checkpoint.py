@@ -0,0 +1,34 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0004_edit_log_snapshots'),
+        ('projects', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_log_id', models.BigIntegerField(default=0, verbose_name='最后日志ID')),
+                ('last_log_timestamp', models.DateTimeField(verbose_name='最后日志时间')),
+                ('node_count', models.PositiveIntegerField(default=0, verbose_name='节点数量')),
+                ('data', models.BinaryField(verbose_name='压缩的节点状态')),
+                ('data_size', models.PositiveIntegerField(default=0, verbose_name='压缩后大小(字节)')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='map_checkpoints', to='projects.project', verbose_name='所属案件')),
+            ],
+            options={
+                'verbose_name': '思维导图检查点',
+                'verbose_name_plural': '思维导图检查点',
+                'ordering': ['-last_log_timestamp', '-last_log_id'],
+                'indexes': [models.Index(fields=['project', '-last_log_timestamp', '-last_log_id'], name='mindmaps_ma_project_fb6010_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-19 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0005_map_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mindmapnode',
+            name='version',
+            field=models.PositiveIntegerField(default=1, verbose_name='版本号'),
+        ),
+    ]
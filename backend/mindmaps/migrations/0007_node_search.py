@@ -0,0 +1,32 @@
+from django.db import migrations
+
+
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE TABLE mindmaps_nodesearch ('
+            'node_pk bigint PRIMARY KEY, project_id bigint NOT NULL, document tsvector NOT NULL)'
+        )
+        schema_editor.execute('CREATE INDEX mindmaps_nodesearch_document ON mindmaps_nodesearch USING GIN (document)')
+        schema_editor.execute('CREATE INDEX mindmaps_nodesearch_project ON mindmaps_nodesearch (project_id)')
+    else:
+        # rowid 即节点主键；内容为切分好的词，以空格分隔
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE mindmaps_nodesearch USING fts5("
+            "content, project_id UNINDEXED, tokenize = 'unicode61')"
+        )
+
+
+def drop_search_table(apps, schema_editor):
+    schema_editor.execute('DROP TABLE IF EXISTS mindmaps_nodesearch')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0006_node_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
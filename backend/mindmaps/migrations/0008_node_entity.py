@@ -0,0 +1,31 @@
+# Generated by Django 5.2.3 on 2026-10-19 13:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0007_node_search'),
+        ('projects', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NodeEntity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('phone', '手机号'), ('id_card', '身份证号'), ('bank_card', '银行卡号'), ('ip', 'IP地址')], max_length=10, verbose_name='实体类型')),
+                ('value', models.CharField(help_text='规范化后的值，如去掉分隔符的号码', max_length=40, verbose_name='实体值')),
+                ('node', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entities', to='mindmaps.mindmapnode', verbose_name='所属节点')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='node_entities', to='projects.project', verbose_name='所属项目')),
+            ],
+            options={
+                'verbose_name': '节点实体',
+                'verbose_name_plural': '节点实体',
+                'indexes': [models.Index(fields=['value', 'kind'], name='mindmaps_no_value_edfff9_idx'), models.Index(fields=['project', 'kind'], name='mindmaps_no_project_1aefa7_idx')],
+                'unique_together': {('node', 'kind', 'value')},
+            },
+        ),
+    ]
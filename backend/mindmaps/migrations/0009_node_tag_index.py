@@ -0,0 +1,64 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def clear_node_tags(apps, schema_editor):
+    # NodeTag 此前没有使用，改为由 MindMapNode.tags 生成
+    apps.get_model('mindmaps', 'NodeTag').objects.all().delete()
+
+
+def build_node_tags(apps, schema_editor):
+    """按节点的 tags 列表生成 NodeTag，规则与 mindmaps.tags.parse_tags 相同"""
+    MindMapNode = apps.get_model('mindmaps', 'MindMapNode')
+    NodeTag = apps.get_model('mindmaps', 'NodeTag')
+    nodes = MindMapNode.objects.order_by('pk').only('pk', 'project_id', 'tags')
+    last_pk = 0
+    while True:
+        chunk = list(nodes.filter(pk__gt=last_pk)[:1000])
+        if not chunk:
+            return
+        rows = []
+        for node in chunk:
+            seen = set()
+            for tag in node.tags or []:
+                if isinstance(tag, dict):
+                    text, style = tag.get('text'), tag.get('style')
+                else:
+                    text, style = tag, None
+                text = str(text).strip()[:100] if text is not None else ''
+                if not text or text in seen:
+                    continue
+                seen.add(text)
+                rows.append(NodeTag(
+                    project_id=node.project_id, node_id=node.pk, text=text,
+                    style_data=style if isinstance(style, dict) else {}, sort_order=len(seen) - 1
+                ))
+        NodeTag.objects.bulk_create(rows, batch_size=1000)
+        last_pk = chunk[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mindmaps', '0008_node_entity'),
+        ('projects', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_node_tags, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='nodetag',
+            name='project',
+            field=models.ForeignKey(default=None, on_delete=django.db.models.deletion.CASCADE, related_name='node_tags', to='projects.project', verbose_name='所属项目'),
+            preserve_default=False,
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodetag',
+            unique_together={('node', 'text')},
+        ),
+        migrations.AddIndex(
+            model_name='nodetag',
+            index=models.Index(fields=['project', 'text'], name='mindmaps_no_project_cc321e_idx'),
+        ),
+        migrations.RunPython(build_node_tags, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 from projects.models import Project
+import copy
+import gzip
 import json
 import os
 import uuid
@@ -103,6 +106,9 @@ class MindMapNode(models.Model):
     level = models.PositiveIntegerField(default=0, verbose_name='节点层级')
     sort_order = models.PositiveIntegerField(default=0, verbose_name='排序顺序')
     
+    # 乐观并发控制：每次修改递增
+    version = models.PositiveIntegerField(default=1, verbose_name='版本号')
+    
     class Meta:
         verbose_name = '思维导图节点'
         verbose_name_plural = '思维导图节点'
@@ -118,6 +124,18 @@ class MindMapNode(models.Model):
     def __str__(self):
         return f'{self.project.name} - {self.text[:20]}'
     
+    # 参与编辑日志差异计算和历史重建的字段
+    STATE_FIELDS = [
+        'parent_node_uid', 'text', 'rich_text', 'expand', 'icon', 'hyperlink',
+        'hyperlink_title', 'note', 'tags', 'generalizations',
+        'associative_line_targets', 'associative_line_text',
+    ]
+    
+    def get_state(self):
+        """获取节点当前状态，用于编辑日志和历史重建"""
+        # JSON字段可能被原地修改，必须深拷贝
+        return {field: copy.deepcopy(getattr(self, field)) for field in self.STATE_FIELDS}
+    
     @property
     def content(self):
         """为了兼容旧代码，保留 content 属性"""
@@ -228,19 +246,66 @@ class MindMapNode(models.Model):
             self.node_id = generate_node_id()
         
         # 自动计算层级
-        if self.parent_node_uid:
-            try:
-                parent = MindMapNode.objects.get(
-                    project=self.project, 
-                    node_id=self.parent_node_uid
-                )
-                self.level = parent.level + 1
-            except MindMapNode.DoesNotExist:
-                self.level = 0
-        else:
-            self.level = 0
+        self.level = self.compute_level()
         
-        super().save(*args, **kwargs)
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        
+        # 不带版本号的普通保存同样推进版本号，并发的条件更新才能发现这次修改
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'version'}
+        current_version = self.version
+        self.version = models.F('version') + 1
+        try:
+            super().save(*args, **kwargs)
+        except Exception:
+            self.version = current_version
+            raise
+        # 写入后的版本号由数据库计算，需要读回；高频的写入路径使用 save_versioned，不需要这次查询
+        self.refresh_from_db(fields=['version'])
+    
+    def compute_level(self):
+        """根据父节点计算层级"""
+        if not self.parent_node_uid:
+            return 0
+        parent_level = MindMapNode.objects.filter(
+            project_id=self.project_id,
+            node_id=self.parent_node_uid
+        ).values_list('level', flat=True).first()
+        return parent_level + 1 if parent_level is not None else 0
+    
+    def save_versioned(self, expected_version, fields, new_version=None):
+        """按版本号条件更新（UPDATE ... WHERE version = expected_version），不加行锁
+        
+        Args:
+            expected_version: 客户端修改所基于的版本号
+            fields: 需要写入的字段
+            new_version: 写入后的版本号，默认为 expected_version + 1
+        
+        Returns:
+            bool: 成功时返回 True；节点已被他人修改或已删除时返回 False，数据库不变
+        """
+        fields = set(fields)
+        if 'parent_node_uid' in fields:
+            self.level = self.compute_level()
+            fields.add('level')
+        fields -= {'version', 'updated_at'}
+        if new_version is None:
+            new_version = expected_version + 1
+        now = timezone.now()
+        updated = MindMapNode.objects.filter(pk=self.pk, version=expected_version).update(
+            version=new_version,
+            updated_at=now,
+            **{field: getattr(self, field) for field in fields}
+        )
+        if not updated:
+            return False
+        self.version = new_version
+        self.updated_at = now
+        nodes_saved.send(sender=MindMapNode, nodes=[self], fields=fields)
+        return True
     
     def can_be_edited_by(self, user):
         """检查是否可以被指定用户编辑"""
@@ -249,7 +314,7 @@ class MindMapNode(models.Model):
             return False
         
         # 创建者总是可以编辑非系统默认节点
-        if self.creator == user:
+        if self.creator_id == user.id:
             return True
         
         # 检查用户在项目中的权限
@@ -272,7 +337,7 @@ class MindMapNode(models.Model):
             return False
         
         # 只有创建者可以删除自己的节点
-        if self.creator != user:
+        if self.creator_id != user.id:
             return False
         
         # 不能删除有子节点的节点
@@ -1012,14 +1077,28 @@ class NodeEditLog(models.Model):
         ('create', '创建'),
         ('update', '更新'),
         ('delete', '删除'),
+        ('move', '移动'),
     ]
     
+    # 节点删除后保留日志，便于归档和历史追溯
     node = models.ForeignKey(
         MindMapNode, 
-        on_delete=models.CASCADE,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
         related_name='edit_logs',
         verbose_name='节点'
     )
+    # 冗余存储案件和节点UID，归档及按案件分页时无需关联节点表
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='edit_logs',
+        verbose_name='所属案件'
+    )
+    node_uid = models.CharField(max_length=100, blank=True, verbose_name='节点UID')
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         on_delete=models.CASCADE,
@@ -1028,6 +1107,9 @@ class NodeEditLog(models.Model):
     action = models.CharField(max_length=10, choices=ACTION_CHOICES, verbose_name='操作类型')
     old_data = models.JSONField(null=True, blank=True, verbose_name='旧数据')
     new_data = models.JSONField(null=True, blank=True, verbose_name='新数据')
+    # 快照日志的 new_data 为操作后的完整状态（删除日志表示节点已不存在），
+    # 其余日志只记录变化的字段
+    is_snapshot = models.BooleanField(default=False, verbose_name='是否完整快照')
     timestamp = models.DateTimeField(auto_now_add=True, verbose_name='操作时间')
     
     class Meta:
@@ -1038,11 +1120,253 @@ class NodeEditLog(models.Model):
             models.Index(fields=['node', '-timestamp']),
             models.Index(fields=['user', '-timestamp']),
             models.Index(fields=['action', '-timestamp']),
+            models.Index(fields=['project', '-timestamp', '-id']),
+            models.Index(fields=['node_uid', '-timestamp']),
         ]
     
     def __str__(self):
         user_name = getattr(self.user, 'real_name', None) or self.user.username
-        return f'{user_name} {self.get_action_display()} {self.node.text[:20]}'
+        node_text = self.node.text[:20] if self.node else self.node_uid
+        return f'{user_name} {self.get_action_display()} {node_text}'
+    
+    def save(self, *args, **kwargs):
+        """保存时从节点补全案件和节点UID"""
+        if self.node is not None:
+            if not self.project_id:
+                self.project_id = self.node.project_id
+            if not self.node_uid:
+                self.node_uid = self.node.node_id
+        super().save(*args, **kwargs)
+    
+    @staticmethod
+    def diff_states(old_state, new_state):
+        """计算字段级差异，返回 (变化前的字段值, 变化后的字段值)"""
+        old_state = old_state or {}
+        old_data = {}
+        new_data = {}
+        for field, value in new_state.items():
+            if field not in old_state or old_state[field] != value:
+                old_data[field] = old_state.get(field)
+                new_data[field] = value
+        return old_data, new_data
+    
+    @classmethod
+    def _snapshot_due(cls, node_uid):
+        """距离上一次快照是否已达到快照间隔"""
+        interval = max(1, getattr(settings, 'EDIT_LOG_SNAPSHOT_INTERVAL', 20))
+        recent = cls.objects.filter(node_uid=node_uid).order_by(
+            '-timestamp', '-id'
+        ).values_list('is_snapshot', flat=True)[:interval - 1]
+        return not any(recent)
+    
+    @classmethod
+    def record(cls, node, user, action, old_state=None):
+        """记录节点编辑日志
+        
+        创建和删除记录完整状态；更新和移动只记录变化的字段，
+        每隔 EDIT_LOG_SNAPSHOT_INTERVAL 条改为记录完整快照，重建历史时从最近的快照开始回放。
+        
+        Args:
+            node: 操作的节点（删除时在 node.delete() 之前调用）
+            user: 操作用户
+            action: create / update / delete / move
+            old_state: 修改前的 node.get_state()，更新和移动时必填
+        
+        Returns:
+            NodeEditLog: 日志对象；没有任何字段变化时返回 None
+        """
+        if action == 'create':
+            return cls.objects.create(
+                node=node, user=user, action=action,
+                new_data=node.get_state(), is_snapshot=True
+            )
+        if action == 'delete':
+            return cls.objects.create(
+                node=node, user=user, action=action,
+                old_data=node.get_state(), is_snapshot=True
+            )
+        
+        new_state = node.get_state()
+        old_data, new_data = cls.diff_states(old_state, new_state)
+        if not new_data:
+            return None
+        
+        is_snapshot = cls._snapshot_due(node.node_id)
+        return cls.objects.create(
+            node=node, user=user, action=action,
+            old_data=old_data,
+            new_data=new_state if is_snapshot else new_data,
+            is_snapshot=is_snapshot
+        )
+    
+    @classmethod
+    def _snapshots_due(cls, node_uids):
+        """批量判断哪些节点距离上一次快照已达到快照间隔，只查询一次"""
+        from django.db.models import F, Window
+        from django.db.models.functions import RowNumber
+        
+        interval = max(1, getattr(settings, 'EDIT_LOG_SNAPSHOT_INTERVAL', 20))
+        recent = cls.objects.filter(node_uid__in=node_uids).annotate(
+            rank=Window(
+                RowNumber(),
+                partition_by=F('node_uid'),
+                order_by=[F('timestamp').desc(), F('id').desc()]
+            )
+        ).filter(rank__lt=interval).values_list('node_uid', 'is_snapshot')
+        # is_snapshot 不能放进查询条件：条件会先于窗口函数生效，排名就只在快照之间计算
+        return set(node_uids) - {node_uid for node_uid, is_snapshot in recent if is_snapshot}
+    
+    @classmethod
+    def record_many(cls, user, entries):
+        """批量记录编辑日志，规则与 record 相同，一次写入
+        
+        Args:
+            entries: [(node, action, old_state)]，删除的节点须在删除之前传入
+        
+        Returns:
+            list: 写入的日志对象（没有字段变化的更新不记录）
+        """
+        diff_uids = [node.node_id for node, action, _ in entries if action not in ('create', 'delete')]
+        due = cls._snapshots_due(diff_uids) if diff_uids else set()
+        
+        logs = []
+        for node, action, old_state in entries:
+            log = cls(
+                node=node, project_id=node.project_id, node_uid=node.node_id,
+                user=user, action=action
+            )
+            if action == 'create':
+                log.new_data = node.get_state()
+                log.is_snapshot = True
+            elif action == 'delete':
+                log.old_data = node.get_state()
+                log.is_snapshot = True
+            else:
+                new_state = node.get_state()
+                old_data, new_data = cls.diff_states(old_state, new_state)
+                if not new_data:
+                    continue
+                log.is_snapshot = node.node_id in due
+                # 同一批次内多次修改同一节点时，只有第一条可能是快照
+                due.discard(node.node_id)
+                log.old_data = old_data
+                log.new_data = new_state if log.is_snapshot else new_data
+            logs.append(log)
+        
+        if not logs:
+            return []
+        logs = cls.objects.bulk_create(logs)
+        
+        # bulk_create 不触发 post_save，提交后按案件累计编辑次数
+        counts = {}
+        for log in logs:
+            counts[log.project_id] = counts.get(log.project_id, 0) + 1
+        transaction.on_commit(lambda: note_edits_for_checkpoint(counts))
+        return logs
+
+
+class EditLogArchive(models.Model):
+    """编辑日志归档索引
+
+    每条记录对应一个 (案件, 月份) 的 gzip NDJSON 归档文件，
+    记录文件内日志的时间和ID范围，读取时据此跳过无关文件。
+    """
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='edit_log_archives',
+        verbose_name='所属案件'
+    )
+    month = models.CharField(max_length=7, verbose_name='归档月份', help_text='格式 YYYY-MM')
+    file_path = models.CharField(max_length=255, verbose_name='归档文件路径', help_text='相对于归档根目录')
+    entry_count = models.PositiveIntegerField(default=0, verbose_name='日志条数')
+    file_size = models.PositiveBigIntegerField(default=0, verbose_name='文件大小(字节)')
+    first_timestamp = models.DateTimeField(verbose_name='最早操作时间')
+    first_log_id = models.BigIntegerField(verbose_name='最早日志ID')
+    last_timestamp = models.DateTimeField(verbose_name='最晚操作时间')
+    last_log_id = models.BigIntegerField(verbose_name='最晚日志ID')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='更新时间')
+    
+    class Meta:
+        verbose_name = '编辑日志归档'
+        verbose_name_plural = '编辑日志归档'
+        unique_together = ('project', 'month')
+        ordering = ['-month']
+        indexes = [
+            models.Index(fields=['project', '-last_timestamp']),
+        ]
+    
+    def __str__(self):
+        return f'{self.project.name} - {self.month} ({self.entry_count}条)'
+
+
+class MapCheckpoint(models.Model):
+    """思维导图完整检查点
+    
+    保存某一时刻案件全部节点的状态（gzip 压缩的 JSON），
+    历史重建时从最近的检查点开始回放编辑日志，无需遍历全部日志。
+    """
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='map_checkpoints',
+        verbose_name='所属案件'
+    )
+    # 检查点包含截至该日志（含）的全部修改
+    last_log_id = models.BigIntegerField(default=0, verbose_name='最后日志ID')
+    last_log_timestamp = models.DateTimeField(verbose_name='最后日志时间')
+    node_count = models.PositiveIntegerField(default=0, verbose_name='节点数量')
+    data = models.BinaryField(verbose_name='压缩的节点状态')
+    data_size = models.PositiveIntegerField(default=0, verbose_name='压缩后大小(字节)')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='创建时间')
+    
+    class Meta:
+        verbose_name = '思维导图检查点'
+        verbose_name_plural = '思维导图检查点'
+        ordering = ['-last_log_timestamp', '-last_log_id']
+        indexes = [
+            models.Index(fields=['project', '-last_log_timestamp', '-last_log_id']),
+        ]
+    
+    def __str__(self):
+        return f'{self.project.name} - {self.last_log_timestamp:%Y-%m-%d %H:%M} ({self.node_count}个节点)'
+    
+    @staticmethod
+    def encode_states(states):
+        """压缩节点状态字典 {node_uid: state}"""
+        raw = json.dumps(states, ensure_ascii=False, separators=(',', ':'), cls=DjangoJSONEncoder)
+        return gzip.compress(raw.encode('utf-8'))
+    
+    def get_states(self):
+        """解压节点状态字典 {node_uid: state}"""
+        return json.loads(gzip.decompress(bytes(self.data)).decode('utf-8'))
+    
+    @classmethod
+    def capture_states(cls, project):
+        """读取案件当前全部节点的状态"""
+        rows = MindMapNode.objects.filter(project=project).order_by(
+            'level', 'sort_order', 'created_at'
+        ).values('node_id', *MindMapNode.STATE_FIELDS)
+        return {row.pop('node_id'): row for row in rows}
+    
+    @classmethod
+    def create_for_project(cls, project):
+        """为案件创建一个检查点"""
+        with transaction.atomic():
+            last_log = NodeEditLog.objects.filter(project=project).order_by(
+                '-timestamp', '-id'
+            ).values('id', 'timestamp').first()
+            states = cls.capture_states(project)
+            data = cls.encode_states(states)
+            return cls.objects.create(
+                project=project,
+                last_log_id=last_log['id'] if last_log else 0,
+                last_log_timestamp=last_log['timestamp'] if last_log else timezone.now(),
+                node_count=len(states),
+                data=data,
+                data_size=len(data)
+            )
 
 
 class AssociativeLine(models.Model):
@@ -1089,7 +1413,17 @@ class AssociativeLine(models.Model):
 
 
 class NodeTag(models.Model):
-    """节点标签模型"""
+    """节点标签模型
+    
+    按标签筛选和统计的索引，与 MindMapNode.tags 保持一致：节点保存和批量写入时由
+    mindmaps.tags 按节点的 tags 列表同步，不要直接修改。
+    """
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='node_tags',
+        verbose_name='所属项目'
+    )
     node = models.ForeignKey(
         MindMapNode,
         on_delete=models.CASCADE,
@@ -1105,8 +1439,10 @@ class NodeTag(models.Model):
         verbose_name = '节点标签'
         verbose_name_plural = '节点标签'
         ordering = ['sort_order', 'created_at']
+        unique_together = ('node', 'text')
         indexes = [
             models.Index(fields=['node', 'sort_order']),
+            models.Index(fields=['project', 'text']),
         ]
     
     def __str__(self):
@@ -1139,3 +1475,68 @@ class NodeGeneralization(models.Model):
         return f'{self.node.text[:20]} - {self.text[:20]}'
 
 
+class NodeEntity(models.Model):
+    """节点中出现的实体（手机号、身份证号、银行卡号、IP地址）的倒排索引，由 mindmaps.entities 维护"""
+    KIND_CHOICES = [
+        ('phone', '手机号'),
+        ('id_card', '身份证号'),
+        ('bank_card', '银行卡号'),
+        ('ip', 'IP地址'),
+    ]
+    
+    project = models.ForeignKey(
+        Project,
+        on_delete=models.CASCADE,
+        related_name='node_entities',
+        verbose_name='所属项目'
+    )
+    node = models.ForeignKey(
+        MindMapNode,
+        on_delete=models.CASCADE,
+        related_name='entities',
+        verbose_name='所属节点'
+    )
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, verbose_name='实体类型')
+    value = models.CharField(max_length=40, verbose_name='实体值', help_text='规范化后的值，如去掉分隔符的号码')
+    
+    class Meta:
+        verbose_name = '节点实体'
+        verbose_name_plural = '节点实体'
+        unique_together = ('node', 'kind', 'value')
+        indexes = [
+            models.Index(fields=['value', 'kind']),
+            models.Index(fields=['project', 'kind']),
+        ]
+    
+    def __str__(self):
+        return f'{self.get_kind_display()} {self.value}'
+
+
+# 信号处理器，累计编辑次数达到阈值时自动创建检查点
+from django.db.models.signals import post_save
+from django.dispatch import receiver, Signal
+
+# bulk_create、bulk_update 和按版本号的条件更新不触发 post_save，由写入方在写入后发送，
+# 参数 nodes 为写入的节点，fields 为写入的字段（None 表示整个节点）
+nodes_saved = Signal()
+
+def note_edits_for_checkpoint(counts):
+    """累计各案件的编辑次数，counts 为 {project_id: 编辑条数}"""
+    # 延迟导入避免循环导入
+    from mindmaps.checkpoints import note_edit
+    for project_id, count in counts.items():
+        try:
+            note_edit(project_id, count)
+        except Exception as e:
+            # 检查点只影响历史重建速度，失败不应阻止编辑
+            import logging
+            logger = logging.getLogger(__name__)
+            logger.error(f"Failed to create checkpoint for project {project_id}: {str(e)}")
+
+@receiver(post_save, sender=NodeEditLog)
+def note_edit_for_checkpoint(sender, instance, created, **kwargs):
+    """编辑日志写入后累计案件的编辑次数"""
+    # 与 record_many 相同在事务提交后执行：检查点不在调用方的写事务中创建，回滚的编辑也不计数
+    if created and instance.project_id:
+        project_id = instance.project_id
+        transaction.on_commit(lambda: note_edits_for_checkpoint({project_id: 1}))
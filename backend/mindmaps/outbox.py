@@ -0,0 +1,179 @@
+"""WebSocket 连接的发送队列
+
+消费者的处理器只把帧放进本连接的队列，由单独的发送任务写出，慢速客户端不会拖住
+处理器，也就不会让通道层里发给这个连接的房间事件越积越多。
+
+- 同一节点排队中的多条 node_updated（节点完整状态）只保留最新一条，光标快照同样只保留最新一帧；
+- 积压超过 MINDMAP_WS_QUEUE_LIMIT 条时丢弃排队中的房间事件，改为发送一条完整快照，
+  快照在轮到发送时才生成，包含被丢弃事件的结果；
+- 直接回复本连接的消息（错误、冲突、文本状态等）不会被丢弃。
+
+发送是否会因客户端慢而阻塞取决于 ASGI 服务器：服务器在写缓冲满时让 send 等待，
+队列才会积压。各连接的队列深度和丢弃、合并、快照次数由 get_stats 汇总。
+"""
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 进程内累计的丢弃、合并和快照次数，以及出现过的最大队列深度
+totals = {
+    'dropped': 0,
+    'merged': 0,
+    'resyncs': 0,
+    'peak_depth': 0,
+}
+
+_outboxes = weakref.WeakSet()
+
+
+def get_queue_limit():
+    return getattr(settings, 'MINDMAP_WS_QUEUE_LIMIT', 200)
+
+
+class _Entry:
+    __slots__ = ('frame', 'droppable', 'merge_key')
+
+    def __init__(self, frame, droppable, merge_key):
+        self.frame = frame
+        self.droppable = droppable
+        self.merge_key = merge_key
+
+
+# 队列中的快照占位，轮到发送时才生成快照
+_RESYNC = _Entry(None, False, None)
+
+
+class Outbox:
+    """一个连接的发送队列
+
+    Args:
+        send: 发送一帧的协程函数
+        build_resync: 生成快照帧的协程函数，积压过多丢弃事件后调用
+    """
+
+    def __init__(self, send, build_resync):
+        self._send = send
+        self._build_resync = build_resync
+        self._queue = deque()
+        self._latest = {}
+        self._ready = asyncio.Event()
+        self._resync_pending = False
+        self._task = None
+        self.depth = 0
+        # 排队中可丢弃的帧数，没有可丢弃的帧时积压也不再扫描队列
+        self.droppable = 0
+        self.dropped = 0
+        self.merged = 0
+        self.resyncs = 0
+        _outboxes.add(self)
+
+    def put(self, frame, droppable=False, merge_key=None):
+        """放入一帧
+
+        Args:
+            droppable: 积压时是否可以丢弃（房间广播的事件），丢弃后以快照补齐
+            merge_key: 相同键的帧只保留最新一条
+        """
+        if merge_key is not None:
+            previous = self._latest.get(merge_key)
+            if previous is not None and previous.frame is not None:
+                previous.frame = None
+                self.depth -= 1
+                if previous.droppable:
+                    self.droppable -= 1
+                self.merged += 1
+                totals['merged'] += 1
+
+        entry = _Entry(frame, droppable, merge_key)
+        self._queue.append(entry)
+        self.depth += 1
+        if droppable:
+            self.droppable += 1
+        if merge_key is not None:
+            self._latest[merge_key] = entry
+        if self.depth > get_queue_limit() and self.droppable:
+            self._shed()
+        elif len(self._queue) > 2 * get_queue_limit():
+            # 合并留下的空位过多时整理队列
+            self._queue = deque(entry for entry in self._queue if entry is _RESYNC or entry.frame is not None)
+        totals['peak_depth'] = max(totals['peak_depth'], self.depth)
+
+        self._ready.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def _shed(self):
+        """丢弃排队中的房间事件，改为发送一条快照"""
+        dropped = 0
+        for entry in self._queue:
+            if entry.droppable and entry.frame is not None:
+                entry.frame = None
+                dropped += 1
+        if not dropped:
+            return
+        self.depth -= dropped
+        self.droppable -= dropped
+        self.dropped += dropped
+        totals['dropped'] += dropped
+        self._latest.clear()
+        self._queue = deque(entry for entry in self._queue if entry is _RESYNC or entry.frame is not None)
+        if not self._resync_pending:
+            self._resync_pending = True
+            self._queue.append(_RESYNC)
+
+    async def _run(self):
+        while True:
+            while not self._queue:
+                self._ready.clear()
+                await self._ready.wait()
+            entry = self._queue.popleft()
+            if entry is _RESYNC:
+                self._resync_pending = False
+                self.resyncs += 1
+                totals['resyncs'] += 1
+                try:
+                    frame = await self._build_resync()
+                except Exception as e:
+                    logger.error(f"Failed to build resync snapshot: {str(e)}")
+                    continue
+            elif entry.frame is None:
+                continue
+            else:
+                frame = entry.frame
+                self.depth -= 1
+                if entry.droppable:
+                    self.droppable -= 1
+                if entry.merge_key is not None and self._latest.get(entry.merge_key) is entry:
+                    del self._latest[entry.merge_key]
+            try:
+                await self._send(frame)
+            except Exception as e:
+                logger.error(f"Failed to send WebSocket frame: {str(e)}")
+                return
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._queue.clear()
+        self._latest.clear()
+        self.depth = 0
+        self.droppable = 0
+        _outboxes.discard(self)
+
+
+def get_stats():
+    """汇总本进程 WebSocket 连接的发送队列状态，用于调整队列上限和通道层容量"""
+    depths = [outbox.depth for outbox in list(_outboxes)]
+    return {
+        'connections': len(depths),
+        'queued': sum(depths),
+        'max_depth': max(depths, default=0),
+        'lagging_connections': sum(1 for depth in depths if depth > get_queue_limit() // 2),
+        'queue_limit': get_queue_limit(),
+        **totals,
+    }
@@ -0,0 +1,52 @@
+"""编辑日志的键集(keyset)分页工具
+
+日志按 (timestamp, id) 倒序排列，游标记录上一页最后一条日志的
+(timestamp, id)，下一页只取严格小于该键的记录，翻页代价与页码无关。
+"""
+import base64
+import json
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(timestamp, log_id):
+    """将 (timestamp, id) 编码为URL安全的游标字符串"""
+    raw = json.dumps([timestamp.isoformat(), log_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """解析游标字符串，返回 (timestamp, id)；格式错误时抛出 ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp_str, log_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        timestamp = parse_datetime(timestamp_str)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('无效的分页游标')
+    if timestamp is None or not isinstance(log_id, int):
+        raise ValueError('无效的分页游标')
+    return timestamp, log_id
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    """解析每页条数，限制在 1 ~ MAX_PAGE_SIZE 之间"""
+    try:
+        page_size = int(value) if value else default
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def keyset_before(key):
+    """返回 (timestamp, id) 严格小于 key 的查询条件"""
+    timestamp, log_id = key
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=log_id)
+
+
+def keyset_after(key):
+    """返回 (timestamp, id) 严格大于 key 的查询条件"""
+    timestamp, log_id = key
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=log_id)
@@ -0,0 +1,197 @@
+"""协作房间在线状态
+
+每个房间一个有序集合，成员为 "用户ID:用户名:连接通道名"，分数为最近一次心跳时间。
+连接定期心跳，读取时先删除超过 MINDMAP_PRESENCE_TTL 秒没有心跳的成员，
+进程崩溃留下的记录会自然过期，不需要额外的清理任务。
+
+配置 MINDMAP_PRESENCE_REDIS_URL 时存放在 Redis，否则（或未安装 redis 库时）
+退化为进程内存储，只适用于单进程部署。
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .rooms import room_group_name
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+def get_ttl():
+    return getattr(settings, 'MINDMAP_PRESENCE_TTL', 60)
+
+
+def get_heartbeat_interval():
+    """心跳间隔取过期时间的三分之一，错过一两次心跳也不会被误判离线"""
+    return get_ttl() / 3
+
+
+def _presence_key(room):
+    return f'mindmap_presence:{room}'
+
+
+def _member(user, channel_name):
+    return f'{user.id}:{user.username}:{channel_name}'
+
+
+def _parse_member(member):
+    if isinstance(member, bytes):
+        member = member.decode('utf-8')
+    user_id, username, channel_name = member.split(':', 2)
+    return int(user_id), username
+
+
+def _users(members):
+    """连接成员去重为用户列表，同一用户多个标签页只算一次"""
+    users = {}
+    for member in members:
+        user_id, username = _parse_member(member)
+        users[user_id] = username
+    return users
+
+
+class MemoryPresenceStore:
+    """进程内在线状态存储"""
+
+    def __init__(self):
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def touch(self, room, member, now):
+        with self._lock:
+            self._rooms.setdefault(room, {})[member] = now
+
+    def remove(self, room, member):
+        with self._lock:
+            members = self._rooms.get(room)
+            if members is not None:
+                members.pop(member, None)
+                if not members:
+                    del self._rooms[room]
+
+    def expire(self, room, cutoff):
+        """删除并返回最近心跳早于 cutoff 的成员"""
+        with self._lock:
+            members = self._rooms.get(room, {})
+            stale = [member for member, score in members.items() if score < cutoff]
+            for member in stale:
+                del members[member]
+            return stale
+
+    def members(self, rooms, cutoff):
+        """批量返回各房间的有效成员"""
+        with self._lock:
+            return [
+                [member for member, score in self._rooms.get(room, {}).items() if score >= cutoff]
+                for room in rooms
+            ]
+
+
+class RedisPresenceStore:
+    """基于 Redis 有序集合的在线状态存储，多进程共享"""
+
+    def __init__(self, url):
+        self._client = redis.Redis.from_url(url)
+
+    def touch(self, room, member, now):
+        key = _presence_key(room)
+        pipe = self._client.pipeline()
+        pipe.zadd(key, {member: now})
+        # 房间里所有人都掉线后整个集合也会过期
+        pipe.expire(key, int(get_ttl()) * 2)
+        pipe.execute()
+
+    def remove(self, room, member):
+        self._client.zrem(_presence_key(room), member)
+
+    def expire(self, room, cutoff):
+        key = _presence_key(room)
+        pipe = self._client.pipeline()
+        pipe.zrangebyscore(key, '-inf', f'({cutoff}')
+        pipe.zremrangebyscore(key, '-inf', f'({cutoff}')
+        stale, _ = pipe.execute()
+        return stale
+
+    def members(self, rooms, cutoff):
+        pipe = self._client.pipeline()
+        for room in rooms:
+            pipe.zrangebyscore(_presence_key(room), cutoff, '+inf')
+        return pipe.execute()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                url = getattr(settings, 'MINDMAP_PRESENCE_REDIS_URL', None)
+                if url and redis is not None:
+                    _store = RedisPresenceStore(url)
+                else:
+                    if url:
+                        logger.warning('redis is not installed, falling back to in-process presence store')
+                    _store = MemoryPresenceStore()
+    return _store
+
+
+def _cutoff(now):
+    return now - get_ttl()
+
+
+def join(room, user, channel_name):
+    """登记连接，返回该用户是否刚刚上线（此前没有其他有效连接）"""
+    store = get_store()
+    now = time.time()
+    online_before = user.id in _users(store.members([room], _cutoff(now))[0])
+    store.touch(room, _member(user, channel_name), now)
+    return not online_before
+
+
+def leave(room, user, channel_name):
+    """注销连接，返回该用户是否已经完全离线"""
+    store = get_store()
+    store.remove(room, _member(user, channel_name))
+    return user.id not in _users(store.members([room], _cutoff(time.time()))[0])
+
+
+def heartbeat(room, user, channel_name):
+    """刷新连接的心跳，顺便清理过期成员
+
+    Returns:
+        list: 因过期而离线的用户名
+    """
+    store = get_store()
+    now = time.time()
+    store.touch(room, _member(user, channel_name), now)
+    stale = _users(store.expire(room, _cutoff(now)))
+    if not stale:
+        return []
+    online = _users(store.members([room], _cutoff(now))[0])
+    return [username for user_id, username in stale.items() if user_id not in online]
+
+
+def online_users(room):
+    """房间内在线的用户名列表"""
+    members = get_store().members([room], _cutoff(time.time()))[0]
+    return sorted(_users(members).values())
+
+
+def presence_counts(project_ids):
+    """批量统计各案件协作房间的在线人数，返回 {project_id: count}"""
+    project_ids = list(project_ids)
+    rooms = [room_group_name(project_id) for project_id in project_ids]
+    members = get_store().members(rooms, _cutoff(time.time())) if rooms else []
+    return {
+        project_id: len(_users(room_members))
+        for project_id, room_members in zip(project_ids, members)
+    }
@@ -0,0 +1,229 @@
+"""按请求采样的 SQL 和耗时分析
+
+ProfilerMiddleware 只分析被选中的请求：管理员带 MINDMAP_PROFILE_HEADER 请求头的请求，
+或按 MINDMAP_PROFILE_SAMPLE_RATE 随机抽中的请求；其余请求只多一次判断。
+
+每个样本记录请求对应的 DRF 视图和 action、查询次数、SQL 总耗时、视图耗时，
+以及重复执行的查询（按去掉参数后的 SQL 归并，IN 列表长度不同也视为同一条），
+重复查询通常就是 N+1。样本存放在进程内的环形缓冲区中，最多保留
+MINDMAP_PROFILE_BUFFER_SIZE 条，由 get_samples / get_summary 读取。
+"""
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+
+# 每个样本最多列出的重复查询数
+MAX_DUPLICATES = 10
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+_lock = threading.Lock()
+_samples = deque(maxlen=max(1, getattr(settings, 'MINDMAP_PROFILE_BUFFER_SIZE', 200)))
+
+
+def fingerprint(sql):
+    """查询的指纹：参数已经是占位符，只需把不同长度的 IN 列表归为一类"""
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+def get_samples(limit=None):
+    """最近的样本，新的在前"""
+    with _lock:
+        samples = list(_samples)
+    samples.reverse()
+    return samples[:limit] if limit else samples
+
+
+def get_summary():
+    """按视图和 action 汇总缓冲区中的样本，查询次数多的在前"""
+    groups = {}
+    for sample in get_samples():
+        key = (sample['view'], sample['action'])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'view': sample['view'],
+                'action': sample['action'],
+                'requests': 0,
+                'queries': 0,
+                'max_queries': 0,
+                'duplicate_queries': 0,
+                'sql_ms': 0.0,
+                'view_ms': 0.0,
+            }
+        group['requests'] += 1
+        group['queries'] += sample['queries']
+        group['max_queries'] = max(group['max_queries'], sample['queries'])
+        group['duplicate_queries'] += sample['duplicate_queries']
+        group['sql_ms'] += sample['sql_ms']
+        group['view_ms'] += sample['view_ms']
+
+    summary = []
+    for group in groups.values():
+        count = group.pop('requests')
+        summary.append({
+            'view': group['view'],
+            'action': group['action'],
+            'requests': count,
+            'avg_queries': round(group['queries'] / count, 1),
+            'max_queries': group['max_queries'],
+            'avg_duplicate_queries': round(group['duplicate_queries'] / count, 1),
+            'avg_sql_ms': round(group['sql_ms'] / count, 2),
+            'avg_view_ms': round(group['view_ms'] / count, 2),
+        })
+    summary.sort(key=lambda item: item['avg_queries'], reverse=True)
+    return summary
+
+
+def clear():
+    with _lock:
+        _samples.clear()
+
+
+class _QueryRecorder:
+    """execute_wrapper：按指纹累计查询次数和耗时"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+            key = fingerprint(sql)
+            stats = self.fingerprints.get(key)
+            if stats is None:
+                self.fingerprints[key] = [1, elapsed]
+            else:
+                stats[0] += 1
+                stats[1] += elapsed
+
+    def duplicates(self):
+        duplicates = [
+            {'sql': sql, 'count': count, 'ms': round(duration * 1000, 2)}
+            for sql, (count, duration) in self.fingerprints.items()
+            if count > 1
+        ]
+        duplicates.sort(key=lambda item: item['count'], reverse=True)
+        return duplicates
+
+
+def view_action(request, view_func):
+    """请求对应的视图名和 DRF action（非 ViewSet 视图为 None）"""
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return getattr(view_func, '__name__', repr(view_func)), None
+    # ViewSet.as_view 的 actions 把请求方法映射到 action
+    actions = getattr(view_func, 'actions', None) or {}
+    return view_class.__name__, actions.get(request.method.lower())
+
+
+class ProfilerMiddleware:
+    """对采样的请求记录 SQL 和耗时，写入进程内的环形缓冲区
+
+    按比例抽中的请求从进入中间件开始记录；请求头只对管理员有效，在 process_view 中
+    （认证中间件之后）检查用户后从视图开始记录，其他用户带请求头不会产生额外开销。
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def is_sampled(self):
+        rate = getattr(settings, 'MINDMAP_PROFILE_SAMPLE_RATE', 0)
+        return rate > 0 and random.random() < rate
+
+    def is_requested(self, request):
+        header = getattr(settings, 'MINDMAP_PROFILE_HEADER', None)
+        if not header or not request.headers.get(header):
+            return False
+        user = getattr(request, 'user', None)
+        return user is not None and user.is_authenticated and (user.is_staff or user.is_superuser)
+
+    def start(self, request):
+        profile = request._profile = {
+            'view': None,
+            'action': None,
+            'started': time.perf_counter(),
+            'view_started': None,
+            'recorder': _QueryRecorder(),
+        }
+        profile['connections'] = _ConnectionWrapper(profile['recorder'])
+        profile['connections'].install()
+        return profile
+
+    def __call__(self, request):
+        request._profile = None
+        if self.is_sampled():
+            self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profile = request._profile
+            if profile is not None:
+                profile['connections'].remove()
+        if profile is not None:
+            self.record(request, response, profile, time.perf_counter())
+        return response
+
+    def record(self, request, response, profile, finished):
+        recorder = profile['recorder']
+        started = profile['started']
+        view_started = profile['view_started'] or started
+        duplicates = recorder.duplicates()
+        user = getattr(request, 'user', None)
+        sample = {
+            'time': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'view': profile['view'],
+            'action': profile['action'],
+            'user': user.username if user is not None and user.is_authenticated else None,
+            'total_ms': round((finished - started) * 1000, 2),
+            'view_ms': round((finished - view_started) * 1000, 2),
+            'sql_ms': round(recorder.duration * 1000, 2),
+            'queries': recorder.count,
+            'duplicate_queries': sum(item['count'] - 1 for item in duplicates),
+            'duplicates': duplicates[:MAX_DUPLICATES],
+        }
+        with _lock:
+            _samples.append(sample)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        profile = getattr(request, '_profile', None)
+        if profile is None:
+            if not self.is_requested(request):
+                return None
+            profile = self.start(request)
+        profile['view'], profile['action'] = view_action(request, view_func)
+        profile['view_started'] = time.perf_counter()
+        return None
+
+
+class _ConnectionWrapper:
+    """在所有数据库连接上安装同一个 execute_wrapper"""
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.connections = []
+
+    def install(self):
+        for connection in connections.all():
+            connection.execute_wrappers.append(self.wrapper)
+            self.connections.append(connection)
+
+    def remove(self):
+        for connection in self.connections:
+            connection.execute_wrappers.remove(self.wrapper)
+        self.connections = []
@@ -0,0 +1,124 @@
+"""思维导图 WebSocket 消息编码
+
+客户端在握手时通过子协议协商编码方式：
+- mindmap.msgpack：二进制帧，首字节为标志位（0 未压缩，1 zlib 压缩），其后为 MessagePack 数据，
+  超过 MINDMAP_WS_COMPRESS_MIN_BYTES 字节的消息会被压缩；客户端发来的二进制帧格式相同，
+  解压后超过 MINDMAP_WS_MAX_FRAME_BYTES 字节的帧直接拒绝，不会完整解压；
+- 未声明子协议（旧客户端）：JSON 文本帧。
+
+广播事件由发送方编码一次 JSON 帧（encode_broadcast）经通道层传递：JSON 连接直接转发，
+MessagePack 连接由 broadcast_frame 转换，同一进程内同一帧只转换一次，房间里没有
+MessagePack 连接时不产生额外的编码和通道层负载。
+"""
+import json
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+MSGPACK_SUBPROTOCOL = 'mindmap.msgpack'
+
+FLAG_PLAIN = 0
+FLAG_ZLIB = 1
+
+# 进程内缓存最近转换过的广播帧数
+TRANSCODE_CACHE_SIZE = 64
+
+_transcoded = OrderedDict()
+
+
+def get_compress_min_bytes():
+    return getattr(settings, 'MINDMAP_WS_COMPRESS_MIN_BYTES', 1024)
+
+
+def get_max_frame_bytes():
+    return getattr(settings, 'MINDMAP_WS_MAX_FRAME_BYTES', 1024 * 1024)
+
+
+def negotiate(subprotocols):
+    """根据客户端声明的子协议选择编码方式
+
+    Returns:
+        tuple: (编码方式, 握手时需要确认的子协议或 None)
+    """
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in (subprotocols or []):
+        return MSGPACK, MSGPACK_SUBPROTOCOL
+    return JSON, None
+
+
+def encode_json(message):
+    return json.dumps(message)
+
+
+def encode_msgpack(message):
+    payload = msgpack.packb(message, use_bin_type=True)
+    if len(payload) >= get_compress_min_bytes():
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            return bytes([FLAG_ZLIB]) + compressed
+    return bytes([FLAG_PLAIN]) + payload
+
+
+def encode(message, protocol):
+    """按指定编码方式编码消息，JSON 返回 str，MessagePack 返回 bytes"""
+    if protocol == MSGPACK:
+        return encode_msgpack(message)
+    return encode_json(message)
+
+
+def encode_broadcast(message):
+    """广播事件只编码一次 JSON 帧"""
+    return encode_json(message)
+
+
+def broadcast_frame(frame, protocol):
+    """把广播的 JSON 帧转换为连接协商的协议；房间内同协议的连接共用一次转换结果"""
+    if protocol == JSON:
+        return frame
+    key = (protocol, frame)
+    converted = _transcoded.get(key)
+    if converted is not None:
+        _transcoded.move_to_end(key)
+        return converted
+    converted = encode(json.loads(frame), protocol)
+    _transcoded[key] = converted
+    if len(_transcoded) > TRANSCODE_CACHE_SIZE:
+        _transcoded.popitem(last=False)
+    return converted
+
+
+def decode(text_data=None, bytes_data=None):
+    """解码客户端消息；格式错误时抛出 ValueError"""
+    if text_data is not None:
+        data = json.loads(text_data)
+    elif bytes_data and msgpack is not None:
+        flag, payload = bytes_data[0], bytes_data[1:]
+        if flag == FLAG_ZLIB:
+            # 限制解压后的大小，防止很小的帧解压出大量数据
+            decompressor = zlib.decompressobj()
+            try:
+                payload = decompressor.decompress(payload, get_max_frame_bytes())
+            except zlib.error:
+                raise ValueError('无效的消息格式')
+            if decompressor.unconsumed_tail:
+                raise ValueError('消息过大')
+        elif flag != FLAG_PLAIN:
+            raise ValueError('无效的消息格式')
+        try:
+            data = msgpack.unpackb(payload, raw=False)
+        except Exception:
+            raise ValueError('无效的消息格式')
+    else:
+        raise ValueError('无效的消息格式')
+
+    if not isinstance(data, dict):
+        raise ValueError('无效的消息格式')
+    return data
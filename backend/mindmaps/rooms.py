@@ -0,0 +1,84 @@
+"""思维导图协作房间
+
+房间组名的约定，房间所在分片的通道层，以及从 HTTP 视图、后台任务等消费者之外的代码
+向房间内 WebSocket 连接发送通知。
+"""
+import logging
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+
+from . import event_log, metrics, protocol
+from .sharding import room_layer_aliases
+
+logger = logging.getLogger(__name__)
+
+
+def room_group_name(project_id):
+    """案件协作房间的组名"""
+    return f'mindmap_{project_id}'
+
+
+def room_channel_layers(room):
+    """房间广播需要发往的通道层（迁移分片期间包括旧分片），返回 [(别名, 通道层)]"""
+    layers = [(alias, get_channel_layer(alias)) for alias in room_layer_aliases(room)]
+    return [(alias, layer) for alias, layer in layers if layer is not None]
+
+
+async def group_send(room, event):
+    """向房间组发送事件"""
+    for alias, channel_layer in room_channel_layers(room):
+        started = time.perf_counter()
+        await channel_layer.group_send(room, event)
+        metrics.CHANNEL_LAYER_SEND.observe(time.perf_counter() - started, alias)
+
+
+def send_to_room(project_id, message):
+    """从同步代码向房间广播消息；通道层不可用时只记录日志"""
+    try:
+        async_to_sync(group_send)(room_group_name(project_id), message)
+    except Exception as e:
+        logger.error(f"Failed to send {message.get('type')} to room {project_id}: {str(e)}")
+
+
+async def publish(room, message):
+    """向房间组广播事件：修改类事件先编号并写入事件日志，再编码一次 JSON 帧"""
+    if message['type'] in event_log.SEQUENCED_EVENTS:
+        try:
+            message = await sync_to_async(event_log.append)(room, message)
+        except Exception as e:
+            # 事件日志不可用时照常广播，重连的客户端会收到快照
+            logger.error(f"Failed to append {message['type']} to event log of {room}: {str(e)}")
+    event = {
+        'type': message['type'],
+        'frame': protocol.encode_broadcast(message)
+    }
+    if message['type'] == 'node_updated':
+        # 事件携带节点的完整状态，接收方发送队列积压时同一节点只需保留最新一条
+        event['merge_key'] = message['node']['id']
+    elif message['type'] == 'user_left':
+        # 接收方据此清除离开用户的光标
+        event['user'] = message['user']
+    await group_send(room, event)
+
+
+async def broadcast_to_room(project_id, message):
+    """从消费者之外的异步代码向房间广播事件，帧格式与 MindMapConsumer.broadcast 相同"""
+    try:
+        await publish(room_group_name(project_id), message)
+    except Exception as e:
+        logger.error(f"Failed to broadcast {message['type']} to room {project_id}: {str(e)}")
+
+
+def notify_member_permission_changed(project_id, user_id, permission):
+    """通知房间内该用户的连接刷新缓存的成员权限
+
+    Args:
+        permission: 新的权限；成员被移除时为 None
+    """
+    send_to_room(project_id, {
+        'type': 'member_permission_changed',
+        'user_id': user_id,
+        'permission': permission,
+    })
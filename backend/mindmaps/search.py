@@ -0,0 +1,259 @@
+"""节点全文检索
+
+索引节点的 text、note、tags、hyperlink_title 以及图片和附件的文件名，每个节点一行：
+SQLite 使用 FTS5 虚拟表，PostgreSQL 使用 tsvector 列和 GIN 索引，表由迁移 0007 创建。
+
+中文没有空格分词，索引前在 Python 中切分：
+- 连续的汉字切成相邻两字一组（二元组），再加上末尾的单字，单字查询用前缀匹配；
+- 连续的字母数字作为一个词，查询时最后一个词按前缀匹配（输入号码前几位即可）；
+- 以空格或连字符分隔的数字组（138-0013-8000、138 0013 8000）另外连成一个词，输入连续号码
+  也能检索到分隔写法；查询中以连字符分隔的数字组同样连起来，空格仍表示多个检索词；
+- 查询按同样规则切分，同一段内的词按短语（相邻）匹配，各段之间为 AND。
+
+节点保存（post_save）、删除（post_delete）、图片和附件变化时更新索引；
+bulk_create、bulk_update 和按版本号的条件更新由写入方发送 nodes_saved 信号。
+已有数据用 rebuild_search_index 命令建立索引，切分规则变化后也需重建。
+"""
+import re
+import unicodedata
+
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils.html import strip_tags
+
+from .models import MindMapNode, NodeImage, NodeAttachment, nodes_saved
+from .tags import parse_tags
+
+TABLE = 'mindmaps_nodesearch'
+
+# 参与索引的节点字段，只修改其他字段的保存不更新索引
+INDEXED_FIELDS = {'text', 'note', 'tags', 'hyperlink_title'}
+
+_CJK_CHARS = '\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_TOKEN = re.compile(f'[{_CJK_CHARS}]+|[0-9a-z]+')
+_CJK = re.compile(f'[{_CJK_CHARS}]')
+_DIGIT_GROUPS = re.compile(r'(?<![0-9a-z-])[0-9]+(?:[-\s][0-9]+)+(?![0-9a-z-])')
+_HYPHEN_DIGIT_GROUPS = re.compile(r'(?<![0-9a-z-])[0-9]+(?:-[0-9]+)+(?![0-9a-z-])')
+_SEPARATORS = re.compile(r'[-\s]')
+
+
+def _normalize(text):
+    """全角转半角、小写"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def _runs(text):
+    """规范化后切出汉字段和字母数字段"""
+    return _TOKEN.findall(_normalize(text))
+
+
+def _joined_digit_groups(text):
+    """分隔写法的数字组去掉分隔符后的号码"""
+    return [_SEPARATORS.sub('', match.group()) for match in _DIGIT_GROUPS.finditer(_normalize(text))]
+
+
+def _bigrams(run):
+    return [run[index:index + 2] for index in range(len(run) - 1)]
+
+
+def tokenize(text):
+    """索引用的词序列，以空格连接"""
+    tokens = []
+    for run in _runs(text):
+        if _CJK.match(run):
+            tokens.extend(_bigrams(run))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    tokens.extend(_joined_digit_groups(text))
+    return ' '.join(tokens)
+
+
+def _query_groups(query):
+    """查询切分为 [(词列表, 是否前缀匹配)]，每组按短语匹配"""
+    groups = []
+    query = _HYPHEN_DIGIT_GROUPS.sub(lambda match: match.group().replace('-', ''), _normalize(query))
+    runs = _runs(query)
+    for index, run in enumerate(runs):
+        if _CJK.match(run):
+            if len(run) == 1:
+                groups.append(([run], True))
+            else:
+                groups.append((_bigrams(run), False))
+        else:
+            groups.append(([run], index == len(runs) - 1))
+    return groups
+
+
+def node_document(node, file_names=()):
+    text = strip_tags(node.text) if node.rich_text else node.text
+    parts = [text, node.note, node.hyperlink_title]
+    parts.extend(text for text, _ in parse_tags(node.tags))
+    parts.extend(file_names)
+    return tokenize(' '.join(part for part in parts if part))
+
+
+def _file_names(node_pks):
+    names = {}
+    for model in (NodeImage, NodeAttachment):
+        for node_pk, name in model.objects.filter(node_id__in=node_pks).values_list('node_id', 'original_name'):
+            names.setdefault(node_pk, []).append(name)
+    return names
+
+
+# 各数据库的读写语句
+
+def _is_postgresql():
+    return connection.vendor == 'postgresql'
+
+
+def _delete_rows(cursor, node_pks):
+    placeholders = ', '.join(['%s'] * len(node_pks))
+    column = 'node_pk' if _is_postgresql() else 'rowid'
+    cursor.execute(f'DELETE FROM {TABLE} WHERE {column} IN ({placeholders})', list(node_pks))
+
+
+def _insert_rows(cursor, rows):
+    if _is_postgresql():
+        cursor.executemany(
+            f"INSERT INTO {TABLE} (node_pk, project_id, document) VALUES (%s, %s, to_tsvector('simple', %s))",
+            rows
+        )
+    else:
+        cursor.executemany(f'INSERT INTO {TABLE} (rowid, project_id, content) VALUES (%s, %s, %s)', rows)
+
+
+def _match_sqlite(groups):
+    phrases = []
+    for tokens, prefix in groups:
+        phrase = '"' + ' '.join(tokens) + '"'
+        phrases.append(phrase + '*' if prefix else phrase)
+    return ' '.join(phrases)
+
+
+def _match_postgresql(groups):
+    phrases = []
+    for tokens, prefix in groups:
+        terms = [f"'{token}'" for token in tokens]
+        if prefix:
+            terms[-1] += ':*'
+        phrases.append('(' + ' <-> '.join(terms) + ')')
+    return ' & '.join(phrases)
+
+
+# 索引维护
+
+def index_nodes(nodes):
+    """重建这些节点的索引行"""
+    nodes = [node for node in nodes if node.pk is not None]
+    if not nodes:
+        return
+    names = _file_names([node.pk for node in nodes])
+    rows = [(node.pk, node.project_id, node_document(node, names.get(node.pk, ()))) for node in nodes]
+    with connection.cursor() as cursor:
+        _delete_rows(cursor, [node.pk for node in nodes])
+        _insert_rows(cursor, rows)
+
+
+def remove_nodes(node_pks):
+    node_pks = [pk for pk in node_pks if pk is not None]
+    if not node_pks:
+        return
+    with connection.cursor() as cursor:
+        _delete_rows(cursor, node_pks)
+
+
+def rebuild(project_id=None, chunk_size=1000):
+    """按批重建索引，返回索引的节点数"""
+    nodes = MindMapNode.objects.order_by('pk')
+    if project_id is not None:
+        nodes = nodes.filter(project_id=project_id)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLE} WHERE project_id = %s', [project_id])
+    else:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {TABLE}')
+
+    count = 0
+    last_pk = 0
+    while True:
+        chunk = list(nodes.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return count
+        index_nodes(chunk)
+        count += len(chunk)
+        last_pk = chunk[-1].pk
+
+
+def search_nodes(user, query, project_id=None, limit=20):
+    """在用户参与的案件中检索节点，返回按相关度排序的 [(节点, 得分)]
+
+    得分越大越相关。查询中没有可检索的字符时返回空列表。
+    """
+    groups = _query_groups(query)
+    if not groups:
+        return []
+
+    # 只检索用户是成员的案件
+    scope = 'project_id IN (SELECT project_id FROM projects_projectmember WHERE user_id = %s)'
+    params = [user.id]
+    if project_id is not None:
+        scope += ' AND project_id = %s'
+        params.append(project_id)
+
+    if _is_postgresql():
+        sql = (
+            f"SELECT node_pk, ts_rank(document, to_tsquery('simple', %s)) AS score FROM {TABLE} "
+            f"WHERE document @@ to_tsquery('simple', %s) AND {scope} ORDER BY score DESC LIMIT %s"
+        )
+        match = _match_postgresql(groups)
+        params = [match, match] + params + [limit]
+    else:
+        # bm25 越小越相关，取相反数作为得分
+        sql = (
+            f'SELECT rowid, -bm25({TABLE}) AS score FROM {TABLE} '
+            f'WHERE {TABLE} MATCH %s AND {scope} ORDER BY score DESC LIMIT %s'
+        )
+        params = [_match_sqlite(groups)] + params + [limit]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        scores = dict(cursor.fetchall())
+
+    nodes = MindMapNode.objects.filter(pk__in=scores).select_related('project')
+    return sorted(((node, scores[node.pk]) for node in nodes), key=lambda hit: hit[1], reverse=True)
+
+
+# 信号处理器
+
+@receiver(post_save, sender=MindMapNode)
+def index_saved_node(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and not INDEXED_FIELDS & set(update_fields)):
+        return
+    index_nodes([instance])
+
+
+@receiver(nodes_saved, sender=MindMapNode)
+def index_bulk_saved_nodes(sender, nodes, fields=None, **kwargs):
+    if fields is not None and not INDEXED_FIELDS & set(fields):
+        return
+    index_nodes(nodes)
+
+
+@receiver(post_delete, sender=MindMapNode)
+def remove_deleted_node(sender, instance, **kwargs):
+    remove_nodes([instance.pk])
+
+
+@receiver(post_save, sender=NodeImage)
+@receiver(post_save, sender=NodeAttachment)
+@receiver(post_delete, sender=NodeImage)
+@receiver(post_delete, sender=NodeAttachment)
+def index_file_node(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    node = MindMapNode.objects.filter(pk=instance.node_id).first()
+    if node is not None:
+        index_nodes([node])
+
@@ -1,7 +1,11 @@
+from django.contrib.auth import get_user_model
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
 from .models import MindMapNode, NodeEditLog
 from users.serializers import UserSerializer
 
+User = get_user_model()
+
 class MindMapNodeSerializer(serializers.ModelSerializer):
     creator = UserSerializer(read_only=True)
     creator_name = serializers.CharField(source='creator.real_name', read_only=True)
@@ -16,9 +20,9 @@ class MindMapNodeSerializer(serializers.ModelSerializer):
             'id', 'node_id', 'parent_node_uid', 'creator', 'creator_name', 'content', 'text', 
             'icon', 'note', 'hyperlink', 'is_root', 'is_system_default', 'tags', 
             'children_count', 'can_edit', 'can_delete', 'can_add_children',
-            'created_at', 'updated_at', 'level', 'sort_order'
+            'created_at', 'updated_at', 'level', 'sort_order', 'version'
         ]
-        read_only_fields = ['id', 'is_root', 'is_system_default', 'creator', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'is_root', 'is_system_default', 'creator', 'created_at', 'updated_at', 'version']
     
     def get_children_count(self, obj):
         return obj.get_children().count()
@@ -87,22 +91,15 @@ class NodeUpdateSerializer(serializers.ModelSerializer):
         fields = ['content', 'text', 'icon', 'note', 'hyperlink', 'tags']
     
     def update(self, instance, validated_data):
+        old_state = instance.get_state()
+        instance = super().update(instance, validated_data)
+        
         # 记录编辑日志
         request = self.context.get('request')
         if request and request.user:
-            NodeEditLog.objects.create(
-                node=instance,
-                user=request.user,
-                action='update',
-                old_data={
-                    'content': instance.content,
-                    'note': instance.note,
-                    'text': instance.text
-                },
-                new_data=validated_data
-            )
+            NodeEditLog.record(instance, request.user, 'update', old_state)
         
-        return super().update(instance, validated_data)
+        return instance
 
 class MindMapTreeSerializer(serializers.ModelSerializer):
     """递归序列化思维导图树形结构"""
@@ -144,8 +141,53 @@ class MindMapTreeSerializer(serializers.ModelSerializer):
 
 class NodeEditLogSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
-    node_text = serializers.CharField(source='node.content', read_only=True)
+    node_text = serializers.SerializerMethodField()
     
     class Meta:
         model = NodeEditLog
-        fields = ['id', 'user', 'action', 'node_text', 'old_data', 'new_data', 'timestamp']
+        fields = ['id', 'user', 'action', 'node_uid', 'node_text', 'old_data', 'new_data', 'is_snapshot', 'timestamp']
+    
+    def get_node_text(self, obj):
+        # 节点删除后日志仍保留，此时没有关联节点
+        return obj.node.content if obj.node else ''
+
+
+def serialize_archived_logs(project_id, records):
+    """用 NodeEditLogSerializer 序列化归档记录，返回格式与在线日志完全一致
+    
+    归档记录还原为未保存的 NodeEditLog，操作用户和节点按当前数据关联（各一次查询），
+    与在线日志的关联方式相同；用户已删除时使用归档时记录的用户信息。
+    """
+    if not records:
+        return []
+    user_ids = {record['user']['id'] for record in records}
+    users = {user.id: user for user in User.objects.filter(id__in=user_ids)}
+    node_uids = {record['node_uid'] for record in records}
+    nodes = {
+        node.node_id: node
+        for node in MindMapNode.objects.filter(project_id=project_id, node_id__in=node_uids)
+    }
+    
+    logs = []
+    for record in records:
+        archived_user = record['user']
+        user = users.get(archived_user['id']) or User(
+            id=archived_user['id'],
+            username=archived_user.get('username', ''),
+            real_name=archived_user.get('real_name', ''),
+            police_number=archived_user.get('police_number', ''),
+            date_joined=None
+        )
+        logs.append(NodeEditLog(
+            id=record['id'],
+            project_id=project_id,
+            node=nodes.get(record['node_uid']),
+            node_uid=record['node_uid'],
+            user=user,
+            action=record['action'],
+            old_data=record['old_data'],
+            new_data=record['new_data'],
+            is_snapshot=record.get('is_snapshot', False),
+            timestamp=parse_datetime(record['timestamp'])
+        ))
+    return NodeEditLogSerializer(logs, many=True).data
@@ -0,0 +1,80 @@
+"""协作房间分片
+
+房间组（mindmap_{project_id}）按一致性哈希分布到 MINDMAP_ROOM_SHARDS 列出的通道层别名上，
+每个别名是 CHANNEL_LAYERS 中的一项配置，通常各自指向一个 Redis。
+房间的连接都加入该房间所在分片的通道层，广播也只发往这个分片。
+
+增加分片时只有约 1/N 的房间换到新分片。迁移期间把原来的分片列表配置为
+MINDMAP_ROOM_SHARDS_PREVIOUS：新连接加入新分片，广播同时发往新旧分片，
+迁移前建立的连接不会漏收；这些连接都断开后再删除 MINDMAP_ROOM_SHARDS_PREVIOUS。
+"""
+import bisect
+import hashlib
+
+from django.conf import settings
+
+# 每个分片在哈希环上的虚拟节点数，越多房间分布越均匀
+VIRTUAL_NODES = 160
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """一致性哈希环"""
+
+    def __init__(self, shards, virtual_nodes=VIRTUAL_NODES):
+        if not shards:
+            raise ValueError('至少需要一个分片')
+        points = sorted(
+            (_hash(f'{shard}#{index}'), shard)
+            for shard in shards
+            for index in range(virtual_nodes)
+        )
+        self.shards = list(shards)
+        self._keys = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def get(self, key):
+        """键所在的分片：哈希值顺时针方向的第一个虚拟节点"""
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._shards[index]
+
+
+_rings = {}
+
+
+def _get_ring(shards):
+    shards = tuple(shards)
+    ring = _rings.get(shards)
+    if ring is None:
+        ring = _rings[shards] = HashRing(shards)
+    return ring
+
+
+def get_shards():
+    return list(getattr(settings, 'MINDMAP_ROOM_SHARDS', None) or ['default'])
+
+
+def get_previous_shards():
+    return list(getattr(settings, 'MINDMAP_ROOM_SHARDS_PREVIOUS', None) or [])
+
+
+def room_layer_alias(room):
+    """房间所在分片的通道层别名，新连接加入这个通道层"""
+    shards = get_shards()
+    if len(shards) == 1:
+        return shards[0]
+    return _get_ring(shards).get(room)
+
+
+def room_layer_aliases(room):
+    """房间广播需要发往的通道层别名：当前分片，以及迁移期间的旧分片"""
+    aliases = [room_layer_alias(room)]
+    previous = get_previous_shards()
+    if previous:
+        old_alias = _get_ring(previous).get(room)
+        if old_alias not in aliases:
+            aliases.append(old_alias)
+    return aliases
@@ -0,0 +1,111 @@
+"""节点标签索引
+
+MindMapNode.tags（simple-mind-map 的标签列表，元素为字符串或 {'text', 'style'}）仍随节点数据
+读写，NodeTag 是它的索引：按案件+标签文本建索引，按标签筛选节点和统计标签不再扫描 JSON。
+
+节点保存（post_save）和批量写入（nodes_saved）时同步：一次查询读出这些节点现有的 NodeTag，
+与 tags 列表比较后批量新增、删除和更新，标签没有变化的节点不产生写入。
+节点删除时 NodeTag 随外键级联删除。
+"""
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import MindMapNode, NodeTag, nodes_saved
+
+TEXT_MAX_LENGTH = NodeTag._meta.get_field('text').max_length
+
+
+def parse_tags(tags):
+    """把节点的 tags 列表转换为 [(文本, 样式)]，去掉空标签和重复标签"""
+    parsed = []
+    seen = set()
+    for tag in tags or []:
+        if isinstance(tag, dict):
+            text, style = tag.get('text'), tag.get('style')
+        else:
+            text, style = tag, None
+        text = str(text).strip()[:TEXT_MAX_LENGTH] if text is not None else ''
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        parsed.append((text, style if isinstance(style, dict) else {}))
+    return parsed
+
+
+def sync_nodes(nodes):
+    """按节点的 tags 列表同步 NodeTag"""
+    nodes = [node for node in nodes if node.pk is not None]
+    if not nodes:
+        return
+
+    existing = {}
+    for tag in NodeTag.objects.filter(node_id__in=[node.pk for node in nodes]):
+        existing.setdefault(tag.node_id, {})[tag.text] = tag
+
+    to_create = []
+    to_update = []
+    to_delete = []
+    for node in nodes:
+        current = existing.get(node.pk, {})
+        for index, (text, style) in enumerate(parse_tags(node.tags)):
+            tag = current.pop(text, None)
+            if tag is None:
+                to_create.append(NodeTag(
+                    project_id=node.project_id, node_id=node.pk,
+                    text=text, style_data=style, sort_order=index
+                ))
+            elif tag.sort_order != index or tag.style_data != style:
+                tag.sort_order = index
+                tag.style_data = style
+                to_update.append(tag)
+        to_delete.extend(tag.id for tag in current.values())
+
+    if not (to_create or to_update or to_delete):
+        return
+    with transaction.atomic():
+        if to_delete:
+            NodeTag.objects.filter(id__in=to_delete).delete()
+        if to_update:
+            NodeTag.objects.bulk_update(to_update, ['sort_order', 'style_data'], batch_size=1000)
+        if to_create:
+            NodeTag.objects.bulk_create(to_create, batch_size=1000)
+
+
+def tag_facets(project_id):
+    """案件中各标签的节点数，一次分组查询，节点多的在前"""
+    return list(
+        NodeTag.objects.filter(project_id=project_id)
+        .values('text')
+        .annotate(count=Count('id'))
+        .order_by('-count', 'text')
+    )
+
+
+def nodes_with_tag(project_id, text):
+    """案件中带有该标签的节点UID"""
+    return list(
+        NodeTag.objects.filter(project_id=project_id, text=text.strip())
+        .order_by('node_id')
+        .values_list('node__node_id', flat=True)
+    )
+
+
+# 信号处理器
+
+@receiver(post_save, sender=MindMapNode)
+def sync_saved_node(sender, instance, created=False, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and 'tags' not in update_fields):
+        return
+    # 新建且没有标签的节点不需要查询
+    if created and not instance.tags:
+        return
+    sync_nodes([instance])
+
+
+@receiver(nodes_saved, sender=MindMapNode)
+def sync_bulk_saved_nodes(sender, nodes, fields=None, **kwargs):
+    if fields is not None and 'tags' not in fields:
+        return
+    sync_nodes(nodes)
@@ -1,3 +1,1717 @@
-from django.test import TestCase
+import asyncio
+import os
+import random
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase, force_authenticate
+
+from projects.models import Project, ProjectMember
+from users.models import CustomUser
+
+from . import checkpoints, edit_log_archive, entities, event_log, presence, profiling, protocol, rooms
+from .batch import apply_node_batch
+from .cursors import CursorCoalescer
+from .edit_history import reconstruct_node_state
+from .edit_log_archive import archive_edit_logs
+from .models import EditLogArchive, MapCheckpoint, MindMapNode, NodeAttachment, NodeEditLog, NodeTag
+from .outbox import Outbox
+from .routing import websocket_urlpatterns
+from .serializers import serialize_archived_logs
+from .sharding import HashRing, room_layer_alias
+from .text_ot import apply, transform, text_hub, persist_text
+from .time_travel import reconstruct_project_states
+from .views import MindMapNodeViewSet
+from .write_buffer import node_write_buffer
+
+# WebSocket 测试使用进程内的通道层、在线状态和事件日志，不依赖 Redis
+WS_TEST_SETTINGS = {
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'MINDMAP_ROOM_SHARDS': ['default'],
+    'MINDMAP_ROOM_SHARDS_PREVIOUS': [],
+    'MINDMAP_PRESENCE_REDIS_URL': None,
+    'MINDMAP_EVENT_LOG_REDIS_URL': None,
+}
+
+
+def create_user(username, index):
+    return CustomUser.objects.create_user(
+        username=username,
+        password='password',
+        real_name=username,
+        police_number=f'P{index:05d}',
+        phone_number=f'1380000{index:04d}'
+    )
+
+
+def create_project(creator, members=(), permission='edit', root_uid='root'):
+    """创建案件，creator 和 members 都以 permission 权限加入，并创建根节点（节点UID全局唯一）"""
+    project = Project.objects.create(
+        name='测试案件',
+        case_number=f'CASE-{creator.id}',
+        filing_unit='direct',
+        case_summary='测试',
+        creator=creator
+    )
+    for user in (creator, *members):
+        ProjectMember.objects.get_or_create(project=project, user=user, defaults={'permission': permission})
+    MindMapNode.objects.create(
+        project=project, node_id=root_uid, parent_node_uid='', creator=creator, text='根节点', is_root=True
+    )
+    return project
+
+
+def random_op(text, rng):
+    """随机生成一个作用于 text 的操作"""
+    op = []
+    position = 0
+    while position < len(text):
+        length = rng.randint(1, len(text) - position)
+        kind = rng.choice(('retain', 'delete', 'insert'))
+        if kind == 'retain':
+            op.append(length)
+            position += length
+        elif kind == 'delete':
+            op.append(-length)
+            position += length
+        else:
+            op.append(rng.choice(('a', 'bc', '中文')))
+    if rng.random() < 0.5:
+        op.append('尾')
+    return op
+
+
+@override_settings(**WS_TEST_SETTINGS)
+class MindMapConsumerTestCase(TestCase):
+    """WebSocket 测试的基类：每个测试使用新的事件日志和在线状态，结束时清理进程内的协同文档和写回缓冲"""
+
+    def setUp(self):
+        event_log._store = event_log.MemoryEventLog()
+        presence._store = presence.MemoryPresenceStore()
+        self.communicators = []
+
+    def tearDown(self):
+        for registry in (text_hub.documents, node_write_buffer.pending):
+            for item in registry.values():
+                task = getattr(item, 'flush_task', None) or getattr(item, 'task', None)
+                if task is not None:
+                    task.cancel()
+            registry.clear()
+        event_log._store = None
+        presence._store = None
+
+    def communicator(self, user, project, query='', subprotocols=None):
+        path = f'/ws/mindmap/{project.id}/' + (f'?{query}' if query else '')
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        return communicator
+
+    async def connect(self, user, project, query='', subprotocols=None):
+        communicator = self.communicator(user, project, query, subprotocols)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.communicators.append(communicator)
+        await self.drain(communicator)
+        return communicator
+
+    async def disconnect_all(self):
+        """断开测试中建立的连接，断开时会写回缓冲的修改"""
+        for communicator in self.communicators:
+            await communicator.disconnect()
+        self.communicators = []
+
+    async def drain(self, communicator):
+        """读出已到达的全部消息"""
+        messages = []
+        while not await communicator.receive_nothing(0.05):
+            messages.append(await self.receive(communicator))
+        return messages
+
+    async def receive(self, communicator):
+        """读取一条消息，JSON 文本帧和 MessagePack 二进制帧都解码为字典"""
+        frame = await communicator.receive_output()
+        if frame['type'] != 'websocket.send':
+            self.fail(f"unexpected {frame['type']}")
+        return protocol.decode(frame.get('text'), frame.get('bytes'))
+
+    async def receive_type(self, communicator, message_type):
+        """读取消息直到收到指定类型"""
+        while True:
+            message = await self.receive(communicator)
+            if message['type'] == message_type:
+                return message
+
+
+class TextTransformTests(TestCase):
+    def test_transform_converges(self):
+        rng = random.Random(37)
+        for _ in range(500):
+            text = ''.join(rng.choice('abcdef') for _ in range(rng.randint(0, 12)))
+            op_a, op_b = random_op(text, rng), random_op(text, rng)
+            a_prime, b_prime = transform(op_a, op_b)
+            self.assertEqual(apply(apply(text, op_a), b_prime), apply(apply(text, op_b), a_prime))
+
+    def test_concurrent_inserts_at_same_position(self):
+        a_prime, b_prime = transform([2, 'x'], [2, 'y'])
+        self.assertEqual(apply(apply('ab', [2, 'x']), b_prime), 'abxy')
+        self.assertEqual(apply(apply('ab', [2, 'y']), a_prime), 'abxy')
+
+
+class TextOTConsumerTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.other = create_user('other', 2)
+        self.project = create_project(self.owner, [self.other])
+        self.node = MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner, text='hello'
+        )
+
+    async def test_concurrent_ops_converge(self):
+        first = await self.connect(self.owner, self.project)
+        second = await self.connect(self.owner, self.project)
+        for communicator in (first, second):
+            await communicator.send_json_to({'type': 'text_open', 'node_id': 'n1', 'field': 'text'})
+            state = await self.receive_type(communicator, 'text_state')
+            self.assertEqual(state['revision'], 0)
+
+        # 两个连接都基于版本 0 提交
+        await first.send_json_to({'type': 'text_op', 'node_id': 'n1', 'field': 'text', 'revision': 0, 'op': [5, ' world']})
+        await second.send_json_to({'type': 'text_op', 'node_id': 'n1', 'field': 'text', 'revision': 0, 'op': ['>> ', 5]})
+
+        texts = []
+        for communicator in (first, second):
+            text = 'hello'
+            for _ in range(2):
+                text = apply(text, (await self.receive_type(communicator, 'text_op'))['op'])
+            texts.append(text)
+        self.assertEqual(texts, ['>> hello world', '>> hello world'])
+
+        document = text_hub.get('n1', 'text')
+        self.assertEqual(document.text, '>> hello world')
+        await text_hub.flush(document)
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, '>> hello world')
+        await self.disconnect_all()
+
+    async def test_non_creator_cannot_open_or_submit(self):
+        owner = await self.connect(self.owner, self.project)
+        other = await self.connect(self.other, self.project)
+
+        await other.send_json_to({'type': 'text_open', 'node_id': 'n1', 'field': 'text'})
+        self.assertEqual((await self.receive_type(other, 'error'))['message'], '只能编辑自己创建的节点')
+
+        await owner.send_json_to({'type': 'text_open', 'node_id': 'n1', 'field': 'text'})
+        await self.receive_type(owner, 'text_state')
+        await other.send_json_to({'type': 'text_op', 'node_id': 'n1', 'field': 'text', 'revision': 0, 'op': ['x', 5]})
+        self.assertEqual((await self.receive_type(other, 'error'))['type'], 'error')
+        self.assertEqual(text_hub.get('n1', 'text').text, 'hello')
+        await self.disconnect_all()
+
+    async def test_non_creator_node_update_on_hot_text_is_refused(self):
+        owner = await self.connect(self.owner, self.project)
+        other = await self.connect(self.other, self.project)
+        await owner.send_json_to({'type': 'text_open', 'node_id': 'n1', 'field': 'text'})
+        await self.receive_type(owner, 'text_state')
+
+        await other.send_json_to({'type': 'node_update', 'node_id': 'n1', 'updates': {'text': 'hacked'}})
+        self.assertEqual((await self.receive_type(other, 'error'))['message'], '节点不存在或无权限修改')
+
+        document = text_hub.get('n1', 'text')
+        self.assertEqual(document.text, 'hello')
+        self.assertFalse(document.dirty)
+        await node_write_buffer.flush_all()
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, 'hello')
+        await self.disconnect_all()
+
+    def test_persist_text_keeps_other_fields(self):
+        # 文档加载后其他途径修改了 note，写回文本不能覆盖它
+        MindMapNode.objects.filter(pk=self.node.pk).update(note='concurrent note', version=5)
+        self.assertTrue(persist_text(self.project.id, 'n1', 'text', 'merged', self.owner))
+        self.node.refresh_from_db()
+        self.assertEqual((self.node.text, self.node.note, self.node.version), ('merged', 'concurrent note', 6))
+        self.assertEqual(NodeEditLog.objects.filter(node_uid='n1', action='update').count(), 1)
+        self.assertFalse(persist_text(self.project.id, 'missing', 'text', 'merged', self.owner))
+
+
+    @override_settings(MINDMAP_TEXT_FLUSH_DELAY=0.2)
+    async def test_failed_persist_waits_for_flush_delay(self):
+        document = text_hub.subscribe(await text_hub.load(self.project.id, 'n1', 'text'), 'channel')
+        attempts = []
+
+        def failing_persist(*args):
+            attempts.append(time.monotonic())
+            raise OperationalError('database is locked')
+
+        with mock.patch('mindmaps.text_ot.persist_text', side_effect=failing_persist):
+            with self.assertLogs('mindmaps.text_ot', 'ERROR'):
+                text_hub.submit(document, 0, [5, '!'], self.owner)
+                await asyncio.sleep(0.5)
+
+        # 每次失败后等待 flush_delay 再重试，而不是立即重试
+        self.assertTrue(1 <= len(attempts) <= 3)
+        for previous, current in zip(attempts, attempts[1:]):
+            self.assertGreaterEqual(current - previous, 0.19)
+        self.assertTrue(document.dirty)
+
+        await text_hub.flush(document)
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, 'hello!')
+
+
+@override_settings(**WS_TEST_SETTINGS)
+class NodeBatchTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.other = create_user('other', 2)
+        self.project = create_project(self.owner, [self.other])
+        self.node = MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner, text='n1'
+        )
+        MindMapNode.objects.create(
+            project=self.project, node_id='n3', parent_node_uid='root', creator=self.owner, text='n3'
+        )
+
+    async def send_batch(self, communicator, operations):
+        await communicator.send_json_to({'type': 'batch', 'operations': operations})
+
+    async def node_texts(self):
+        return await sync_to_async(dict)(
+            MindMapNode.objects.filter(project=self.project, node_id__in=['n1', 'n2', 'n3']).values_list('node_id', 'text')
+        )
+
+    async def test_batch_applies_together_and_broadcasts_once(self):
+        sender = await self.connect(self.owner, self.project)
+        receiver = await self.connect(self.other, self.project)
+        await self.send_batch(sender, [
+            {'type': 'node_create', 'parent_id': 'root', 'node_data': {'uid': 'n2', 'text': 'n2'}},
+            {'type': 'node_update', 'node_id': 'n1', 'updates': {'text': 'changed'}, 'version': 1},
+            {'type': 'node_delete', 'node_id': 'n3'},
+        ])
+
+        message = await self.receive(receiver)
+        self.assertEqual(message['type'], 'nodes_changed')
+        self.assertEqual(message['user'], 'owner')
+        self.assertIsInstance(message['seq'], int)
+        self.assertEqual([node['id'] for node in message['created']], ['n2'])
+        self.assertEqual(
+            [(node['id'], node['text'], node['version']) for node in message['updated']],
+            [('n1', 'changed', 2)]
+        )
+        self.assertEqual(message['deleted'], ['n3'])
+        # 整批只有一条广播
+        self.assertTrue(await receiver.receive_nothing(0.1))
+        await self.disconnect_all()
+
+        self.assertEqual(await self.node_texts(), {'n1': 'changed', 'n2': 'n2'})
+        actions = await sync_to_async(list)(
+            NodeEditLog.objects.filter(project=self.project).order_by('id').values_list('node_uid', 'action')
+        )
+        self.assertEqual(actions, [('n2', 'create'), ('n1', 'update'), ('n3', 'delete')])
+
+    async def test_failing_operation_rolls_back_the_whole_batch(self):
+        communicator = await self.connect(self.owner, self.project)
+        await self.send_batch(communicator, [
+            {'type': 'node_create', 'parent_id': 'root', 'node_data': {'uid': 'n2', 'text': 'n2'}},
+            {'type': 'node_update', 'node_id': 'n1', 'updates': {'text': 'changed'}},
+            {'type': 'node_update', 'node_id': 'missing', 'updates': {'text': 'x'}},
+        ])
+        error = await self.receive_type(communicator, 'error')
+        self.assertEqual(error['index'], 2)
+        await self.disconnect_all()
+
+        self.assertEqual(await self.node_texts(), {'n1': 'n1', 'n3': 'n3'})
+        self.assertFalse(await sync_to_async(NodeEditLog.objects.filter(project=self.project).exists)())
+
+    async def test_stale_version_returns_conflict(self):
+        communicator = await self.connect(self.owner, self.project)
+        await self.send_batch(communicator, [
+            {'type': 'node_delete', 'node_id': 'n3'},
+            {'type': 'node_update', 'node_id': 'n1', 'updates': {'text': 'stale'}, 'version': 5},
+        ])
+        conflict = await self.receive_type(communicator, 'conflict')
+        self.assertEqual((conflict['index'], conflict['node_id']), (1, 'n1'))
+        self.assertEqual((conflict['node']['text'], conflict['node']['version']), ('n1', 1))
+        await self.disconnect_all()
+        self.assertEqual(await self.node_texts(), {'n1': 'n1', 'n3': 'n3'})
+
+    async def test_invalid_operations_report_their_index(self):
+        communicator = await self.connect(self.owner, self.project)
+        cases = [
+            ([{'type': 'node_delete', 'node_id': 'n3'}, 'not an operation'], 1),
+            ([{'type': 'node_move', 'node_id': 'n1'}], 0),
+            ([{'type': 'node_update', 'node_id': 'n1', 'updates': {'creator': 2}}], 0),
+            ([{'type': 'node_update', 'node_id': 'n1', 'updates': {}, 'version': 'one'}], 0),
+            ([{'type': 'node_create', 'parent_id': 'missing', 'node_data': {}}], 0),
+        ]
+        for operations, index in cases:
+            await self.send_batch(communicator, operations)
+            error = await self.receive_type(communicator, 'error')
+            self.assertEqual(error['index'], index, operations)
+
+        await self.send_batch(communicator, [])
+        self.assertNotIn('index', await self.receive_type(communicator, 'error'))
+        with mock.patch('mindmaps.consumers.MAX_BATCH_OPERATIONS', 2):
+            await self.send_batch(communicator, [{'type': 'node_delete', 'node_id': 'n3'}] * 3)
+            self.assertIn('最多 2 条', (await self.receive_type(communicator, 'error'))['message'])
+        await self.disconnect_all()
+        self.assertEqual(await self.node_texts(), {'n1': 'n1', 'n3': 'n3'})
+
+    def attach_file(self, node):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        return NodeAttachment.objects.create(
+            node=node, file=SimpleUploadedFile('evidence.txt', b'evidence'),
+            original_name='evidence.txt', file_size=8, uploader=self.owner
+        )
+
+    def test_deleted_node_files_are_removed_after_commit(self):
+        path = self.attach_file(self.node).file.path
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_node_batch(self.project.id, self.owner, [{'type': 'node_delete', 'node_id': 'n1'}], True)
+        self.assertFalse(os.path.exists(path))
+
+    async def test_root_nodes_store_the_same_parent_from_every_path(self):
+        communicator = await self.connect(self.owner, self.project)
+        await communicator.send_json_to({'type': 'node_create', 'node_data': {'uid': 'single_root', 'text': '根'}})
+        await self.receive_type(communicator, 'node_created')
+        await communicator.send_json_to({'type': 'batch', 'operations': [
+            {'type': 'node_create', 'node_data': {'uid': 'batch_root', 'text': '根'}},
+        ]})
+        await self.receive_type(communicator, 'nodes_changed')
+        await self.disconnect_all()
+
+        parents = await sync_to_async(dict)(
+            MindMapNode.objects.filter(node_id__in=['single_root', 'batch_root']).values_list('node_id', 'parent_node_uid')
+        )
+        self.assertEqual(parents, {'single_root': '', 'batch_root': ''})
+
+    def test_rolled_back_delete_keeps_files(self):
+        path = self.attach_file(self.node).file.path
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                apply_node_batch(self.project.id, self.owner, [{'type': 'node_delete', 'node_id': 'n1'}], True)
+                raise RuntimeError('later failure')
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(NodeAttachment.objects.filter(node=self.node).exists())
+
+
+class NodeWriteBufferTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.node = MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner, text=''
+        )
+
+    async def update(self, updates, version=None):
+        return await node_write_buffer.update(self.project.id, 'n1', self.owner, 'channel', updates, version=version)
+
+    async def test_updates_are_merged_into_one_write(self):
+        for text in ('a', 'ab', 'abc'):
+            node = await self.update({'text': text, 'unknown': 1})
+            self.assertEqual(node.text, text)
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, '')
+
+        await node_write_buffer.flush(['n1'])
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, 'abc')
+        self.assertNotIn('n1', node_write_buffer.pending)
+        logs = await sync_to_async(list)(NodeEditLog.objects.filter(node_uid='n1', action='update'))
+        self.assertEqual(len(logs), 1)
+
+    async def test_database_error_keeps_pending_edits(self):
+        await self.update({'text': 'kept'})
+        with mock.patch.object(MindMapNode, 'save_versioned', side_effect=OperationalError('database is locked')):
+            with self.assertLogs('mindmaps.write_buffer', 'ERROR'):
+                await node_write_buffer.flush(['n1'])
+
+        entry = node_write_buffer.pending.get('n1')
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.fields, {'text'})
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, '')
+
+        # 数据库恢复后重试写回成功
+        await node_write_buffer.flush(['n1'])
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, 'kept')
+        self.assertNotIn('n1', node_write_buffer.pending)
+
+    async def test_deleted_node_drops_pending_edits(self):
+        await self.update({'text': 'lost'})
+        await sync_to_async(MindMapNode.objects.filter(pk=self.node.pk).delete)()
+        await node_write_buffer.flush(['n1'])
+        self.assertNotIn('n1', node_write_buffer.pending)
+
+    async def test_disconnect_flushes_edits(self):
+        communicator = await self.connect(self.owner, self.project)
+        await communicator.send_json_to({'type': 'node_update', 'node_id': 'n1', 'updates': {'text': 'typed'}})
+        await self.receive_type(communicator, 'node_updated')
+        await self.disconnect_all()
+        await sync_to_async(self.node.refresh_from_db)()
+        self.assertEqual(self.node.text, 'typed')
+
+
+class MemberPermissionTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.member = create_user('member', 2)
+        self.project = create_project(self.owner, members=[self.member])
+        MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.member, text=''
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+
+    def set_permission(self, permission):
+        """通过成员管理接口修改权限，接口会通知房间刷新缓存"""
+        response = self.client.put(
+            f'/api/projects/{self.project.id}/update_member_permission/',
+            {'username': 'member', 'permission': permission}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    async def edit(self, communicator, text):
+        await communicator.send_json_to({'type': 'node_update', 'node_id': 'n1', 'updates': {'text': text}})
+        return await self.receive(communicator)
+
+    async def test_permission_is_cached_for_the_connection(self):
+        communicator = await self.connect(self.member, self.project)
+        # 直接修改数据库不会通知连接，编辑仍按连接时的权限判断
+        await sync_to_async(ProjectMember.objects.filter(user=self.member).update)(permission='read')
+        message = await self.edit(communicator, 'cached')
+        self.assertEqual(message['type'], 'node_updated')
+        await self.disconnect_all()
+
+    async def test_demoted_member_cannot_edit_after_event(self):
+        communicator = await self.connect(self.member, self.project)
+        self.assertEqual((await self.edit(communicator, 'before'))['type'], 'node_updated')
+
+        await sync_to_async(self.set_permission)('read')
+        message = await self.receive_type(communicator, 'permission_changed')
+        self.assertEqual(message['permission'], 'read')
+        message = await self.edit(communicator, 'after')
+        self.assertEqual(message, {'type': 'error', 'message': '没有编辑权限'})
+        await self.disconnect_all()
+
+    async def test_promoted_viewer_can_edit_after_event(self):
+        await sync_to_async(ProjectMember.objects.filter(user=self.member).update)(permission='read')
+        communicator = await self.connect(self.member, self.project)
+        self.assertEqual((await self.edit(communicator, 'before'))['type'], 'error')
+
+        await sync_to_async(self.set_permission)('edit')
+        await self.receive_type(communicator, 'permission_changed')
+        message = await self.edit(communicator, 'after')
+        self.assertEqual(message['type'], 'node_updated')
+        self.assertEqual(message['node']['text'], 'after')
+        await self.disconnect_all()
+
+    async def test_removed_member_is_disconnected(self):
+        communicator = await self.connect(self.member, self.project)
+        response = await sync_to_async(self.client.delete)(
+            f'/api/projects/{self.project.id}/remove_member/', {'username': 'member'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        message = await self.receive_type(communicator, 'error')
+        self.assertEqual(message['message'], '你已被移出该案件')
+        self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        await self.disconnect_all()
+
+    async def test_event_for_another_member_is_ignored(self):
+        owner = await self.connect(self.owner, self.project)
+        await sync_to_async(self.set_permission)('read')
+        self.assertTrue(await owner.receive_nothing(0.1))
+        await owner.send_json_to({'type': 'node_create', 'parent_id': 'root', 'node_data': {'uid': 'n2', 'text': '新节点'}})
+        self.assertEqual((await self.receive(owner))['type'], 'node_created')
+        await self.disconnect_all()
+
+
+class NodeVersionTests(APITestCase):
+    def setUp(self):
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.nodes = [
+            MindMapNode.objects.create(
+                project=self.project, node_id=f'n{index}', parent_node_uid='root', creator=self.owner, text=''
+            )
+            for index in range(3)
+        ]
+        self.client.force_authenticate(self.owner)
+
+    def batch_update(self, changes):
+        request = APIRequestFactory().post(
+            '/api/mindmaps/batch-update/', {'projectId': self.project.id, 'changes': changes}, format='json'
+        )
+        force_authenticate(request, self.owner)
+        return MindMapNodeViewSet.as_view({'post': 'batch_update'})(request)
+
+    def texts(self):
+        return list(MindMapNode.objects.filter(node_id__in=['n0', 'n1', 'n2']).order_by('node_id').values_list('text', flat=True))
+
+    def test_save_refreshes_version(self):
+        node = self.nodes[0]
+        node.text = 'changed'
+        node.save()
+        self.assertNotIn('version', node.get_deferred_fields())
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(node.version, 2)
+        self.assertEqual(len(queries), 0)
+
+    def test_save_versioned_knows_new_version_without_select(self):
+        node = self.nodes[0]
+        node.text = 'changed'
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(node.save_versioned(1, ['text']))
+        self.assertEqual(node.version, 2)
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT') and '"version"' in query['sql']])
+        self.assertFalse(node.save_versioned(1, ['text']))
+
+    def test_update_with_stale_version_conflicts(self):
+        url = '/api/mindmaps/nodes/update/'
+        response = self.client.put(url, {'projectId': self.project.id, 'node_uid': 'n0', 'version': 1, 'data': {'text': 'first'}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['node']['version'], 2)
+
+        response = self.client.put(url, {'projectId': self.project.id, 'node_uid': 'n0', 'version': 1, 'data': {'text': 'stale'}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['node']['text'], 'first')
+
+    def test_batch_update_rejects_malformed_version_before_writing(self):
+        response = self.batch_update([
+            {'action': 'update', 'node_uid': 'n0', 'node_data': {'text': 'a'}},
+            {'action': 'update', 'node_uid': 'n1', 'node_data': {'text': 'b'}, 'version': 'abc'},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['index'], 1)
+        self.assertEqual(self.texts(), ['', '', ''])
+
+    def test_batch_update_reports_conflicts_per_change(self):
+        response = self.batch_update([
+            {'action': 'update', 'node_uid': 'n0', 'node_data': {'text': 'a'}, 'version': 1},
+            {'action': 'update', 'node_uid': 'n1', 'node_data': {'text': 'b'}, 'version': 7},
+        ])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['success'] for result in response.data['results']], [True, False])
+        self.assertTrue(response.data['results'][1]['conflict'])
+        self.assertEqual(self.texts(), ['a', '', ''])
+
+    def test_batch_update_rolls_back_on_error(self):
+        record = NodeEditLog.record
+        calls = []
+
+        def failing_record(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError('log failed')
+            return record(*args, **kwargs)
+
+        with mock.patch.object(NodeEditLog, 'record', side_effect=failing_record):
+            response = self.batch_update([
+                {'action': 'update', 'node_uid': 'n0', 'node_data': {'text': 'a'}},
+                {'action': 'update', 'node_uid': 'n1', 'node_data': {'text': 'b'}},
+            ])
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(self.texts(), ['', '', ''])
+
+
+class EditLogArchiveTests(APITestCase):
+    def setUp(self):
+        archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_root.cleanup)
+        archive_settings = override_settings(EDIT_LOG_ARCHIVE_ROOT=archive_root.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.client.force_authenticate(self.owner)
+        self.url = f'/api/projects/{self.project.id}/nodes/logs/'
+
+        # 前 4 条早于归档期限，其中第 2、3 条时间相同，只能靠ID区分先后
+        now = timezone.now()
+        offsets = [90, 60, 60, 40, 5, 1]
+        for index, days in enumerate(offsets):
+            node = MindMapNode.objects.create(
+                project=self.project, node_id=f'n{index}', parent_node_uid='root', creator=self.owner, text=f'节点{index}'
+            )
+            log = NodeEditLog.record(node, self.owner, 'create')
+            NodeEditLog.objects.filter(id=log.id).update(timestamp=now - timedelta(days=days))
+        self.cutoff = now - timedelta(days=30)
+
+    def read_pages(self, page_size):
+        results = []
+        cursor = None
+        while True:
+            params = {'page_size': page_size}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            results.extend(response.data['results'])
+            cursor = response.data['next_cursor']
+            if not cursor:
+                return results
+
+    def test_archived_logs_have_live_shape(self):
+        live = self.client.get(self.url, {'page_size': 10}).data['results']
+
+        self.assertEqual(archive_edit_logs(self.cutoff)['archived'], 4)
+        self.assertEqual(NodeEditLog.objects.filter(project=self.project).count(), 2)
+
+        merged = self.client.get(self.url, {'page_size': 10}).data['results']
+        self.assertEqual(merged, live)
+
+    def test_cursor_pages_span_live_and_archive(self):
+        expected = self.read_pages(page_size=10)
+        archive_edit_logs(self.cutoff)
+
+        for page_size in (1, 2, 3):
+            pages = self.read_pages(page_size)
+            self.assertEqual([log['id'] for log in pages], [log['id'] for log in expected])
+            self.assertEqual(pages, expected)
+
+    def test_archive_files_are_parsed_once_across_pages(self):
+        expected = self.read_pages(page_size=10)
+        archive_edit_logs(self.cutoff)
+        with mock.patch('mindmaps.edit_log_archive._read_archive', wraps=edit_log_archive._read_archive) as read:
+            self.assertEqual(self.read_pages(page_size=1), expected)
+            self.assertEqual(read.call_count, EditLogArchive.objects.filter(project=self.project).count())
+
+            # 追加归档后重新读取该月份的文件
+            log = NodeEditLog.objects.create(
+                node=MindMapNode.objects.get(node_id='n0'), user=self.owner, action='update', new_data={'text': '追加'}
+            )
+            NodeEditLog.objects.filter(id=log.id).update(timestamp=timezone.now() - timedelta(days=90))
+            archive_edit_logs(self.cutoff)
+            read.reset_mock()
+            pages = self.read_pages(page_size=2)
+            self.assertEqual(read.call_count, 1)
+        self.assertEqual(len(pages), len(expected) + 1)
+        self.assertIn(log.id, [item['id'] for item in pages])
+
+    def test_filters_apply_to_archived_logs(self):
+        archive_edit_logs(self.cutoff)
+        response = self.client.get(self.url, {'node': 'n1'})
+        self.assertEqual([log['node_uid'] for log in response.data['results']], ['n1'])
+        self.assertEqual(response.data['results'][0]['node_text'], '节点1')
+
+    def test_legacy_archive_records_are_normalized(self):
+        log = NodeEditLog.objects.select_related('node', 'user').get(node_uid='n0')
+        expected = self.client.get(self.url, {'node': 'n0'}).data['results'][0]
+        legacy_record = {
+            'id': log.id,
+            'project_id': self.project.id,
+            'node_uid': 'n0',
+            'node_text': log.node.text,
+            'user': {'id': self.owner.id, 'username': 'owner', 'real_name': 'owner', 'police_number': 'P00001'},
+            'action': log.action,
+            'old_data': log.old_data,
+            'new_data': log.new_data,
+            'is_snapshot': log.is_snapshot,
+            'timestamp': log.timestamp.isoformat(),
+        }
+        self.assertEqual(serialize_archived_logs(self.project.id, [legacy_record]), [expected])
+
+
+class EditLogFilterTests(APITestCase):
+    def setUp(self):
+        archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_root.cleanup)
+        archive_settings = override_settings(EDIT_LOG_ARCHIVE_ROOT=archive_root.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.owner = create_user('owner', 1)
+        self.member = create_user('member', 2)
+        self.project = create_project(self.owner, members=[self.member])
+        self.client.force_authenticate(self.owner)
+        self.url = f'/api/projects/{self.project.id}/nodes/logs/'
+        self.now = timezone.now()
+
+        nodes = {
+            node_id: MindMapNode.objects.create(
+                project=self.project, node_id=node_id, parent_node_uid='root', creator=self.owner, text=node_id
+            )
+            for node_id in ('n1', 'n2')
+        }
+        # (标签, 节点, 用户, 操作, 几天前)
+        entries = [
+            ('L1', 'n1', self.owner, 'create', 10),
+            ('L2', 'n1', self.member, 'update', 8),
+            ('L3', 'n2', self.member, 'create', 6),
+            ('L4', 'n2', self.owner, 'update', 4),
+            ('L5', 'n1', self.owner, 'update', 2),
+            ('L6', 'n2', self.member, 'delete', 1),
+        ]
+        self.labels = {}
+        for label, node_id, user, action, days in entries:
+            node = nodes[node_id]
+            node.text = label
+            log = NodeEditLog.objects.create(node=node, user=user, action=action, new_data={'text': label})
+            NodeEditLog.objects.filter(id=log.id).update(timestamp=self.days_ago(days))
+            self.labels[log.id] = label
+        self.archived = False
+
+    def days_ago(self, days):
+        return self.now - timedelta(days=days)
+
+    def assertFiltered(self, params, expected):
+        """过滤结果应为 expected（按时间倒序）；第一次调用时再归档 5 天前的日志并检查一遍"""
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([self.labels[log['id']] for log in response.data['results']], expected)
+        if not self.archived:
+            self.archived = True
+            self.assertEqual(archive_edit_logs(self.days_ago(5))['archived'], 3)
+            self.assertFiltered(params, expected)
+
+    def test_user_filter(self):
+        self.assertFiltered({'user': self.member.id}, ['L6', 'L3', 'L2'])
+
+    def test_action_filter(self):
+        self.assertFiltered({'action': 'update'}, ['L5', 'L4', 'L2'])
+
+    def test_time_range_filter(self):
+        # since 含边界，until 不含
+        self.assertFiltered(
+            {'since': self.days_ago(8).isoformat(), 'until': self.days_ago(2).isoformat()},
+            ['L4', 'L3', 'L2']
+        )
+        self.assertFiltered({'since': self.days_ago(3).isoformat()}, ['L6', 'L5'])
+        self.assertFiltered({'until': self.days_ago(7).isoformat()}, ['L2', 'L1'])
+
+    def test_node_filter(self):
+        self.assertFiltered({'node': 'n2'}, ['L6', 'L4', 'L3'])
+
+    def test_combined_filters(self):
+        self.assertFiltered({
+            'node': 'n1',
+            'user': self.owner.id,
+            'action': 'update',
+            'since': self.days_ago(9).isoformat(),
+        }, ['L5'])
+        self.assertFiltered({'node': 'n1', 'user': self.member.id, 'until': self.days_ago(9).isoformat()}, [])
+
+    def test_invalid_filters_are_rejected(self):
+        for params in ({'action': 'rename'}, {'user': 'owner'}, {'since': 'yesterday'}):
+            with self.subTest(params=params):
+                response = self.client.get(self.url, params)
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(next(iter(params)), response.data['fields'])
+
+
+class NodeSearchTests(APITestCase):
+    url = '/api/mindmaps/search/'
+
+    def setUp(self):
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.client.force_authenticate(self.owner)
+        for node_id, text in [
+            ('hyphen', '联系电话 138-0013-8000'),
+            ('space', '备用号码 138 0013 8000'),
+            ('plain', '机主号码13800138000'),
+            ('other', '联系电话 139-0013-8000'),
+        ]:
+            MindMapNode.objects.create(
+                project=self.project, node_id=node_id, parent_node_uid='root', creator=self.owner, text=text
+            )
+
+    def search(self, query):
+        response = self.client.get(self.url, {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted(hit['node_id'] for hit in response.data['results'])
+
+    def test_contiguous_number_finds_separated_numbers(self):
+        self.assertEqual(self.search('13800138000'), ['hyphen', 'plain', 'space'])
+        self.assertEqual(self.search('１３８００１３８０００'), ['hyphen', 'plain', 'space'])
+
+    def test_number_prefix_finds_separated_numbers(self):
+        self.assertEqual(self.search('1380013'), ['hyphen', 'plain', 'space'])
+
+    def test_hyphenated_query_finds_every_form(self):
+        self.assertEqual(self.search('138-0013-8000'), ['hyphen', 'plain', 'space'])
+
+    def test_dict_tags_index_only_their_text(self):
+        MindMapNode.objects.create(
+            project=self.project, node_id='tagged', parent_node_uid='root', creator=self.owner,
+            text='嫌疑人', tags=[{'text': '重点人员', 'style': {'fill': 'red'}}, '在逃']
+        )
+        self.assertEqual(self.search('重点人员'), ['tagged'])
+        self.assertEqual(self.search('在逃'), ['tagged'])
+        for query in ('text', 'style', 'fill', 'red'):
+            self.assertEqual(self.search(query), [])
+
+    def test_separated_groups_still_match_individually(self):
+        self.assertEqual(self.search('联系电话 0013'), ['hyphen', 'other'])
+
+
+@override_settings(EDIT_LOG_SNAPSHOT_INTERVAL=4)
+class EditLogDiffTests(APITestCase):
+    def setUp(self):
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.start = timezone.now() - timedelta(days=1)
+        self.node = MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner, text='v0'
+        )
+        self.logs = [NodeEditLog.record(self.node, self.owner, 'create')]
+        self.set_time(self.logs[0], 0)
+        # 每一步之后的节点状态，用于核对重建结果
+        self.states = [self.node.get_state()]
+
+    def set_time(self, log, minutes):
+        NodeEditLog.objects.filter(id=log.id).update(timestamp=self.start + timedelta(minutes=minutes))
+
+    def at(self, step):
+        """第 step 步日志之后、下一步之前的时刻"""
+        return self.start + timedelta(minutes=step, seconds=30)
+
+    def edit(self, **fields):
+        old_state = self.node.get_state()
+        for field, value in fields.items():
+            setattr(self.node, field, value)
+        self.node.save()
+        log = NodeEditLog.record(self.node, self.owner, 'update', old_state)
+        self.set_time(log, len(self.logs))
+        self.logs.append(log)
+        self.states.append(self.node.get_state())
+        return log
+
+    def test_updates_store_only_changed_fields(self):
+        log = self.edit(text='v1', note='备注')
+        self.assertFalse(log.is_snapshot)
+        self.assertEqual(log.old_data, {'text': 'v0', 'note': ''})
+        self.assertEqual(log.new_data, {'text': 'v1', 'note': '备注'})
+        # 没有字段变化时不记录
+        self.assertIsNone(NodeEditLog.record(self.node, self.owner, 'update', self.node.get_state()))
+
+    def test_snapshot_every_interval_logs(self):
+        for index in range(1, 10):
+            self.edit(text=f'v{index}')
+        self.assertEqual(
+            [log.is_snapshot for log in self.logs],
+            [True, False, False, False, True, False, False, False, True, False]
+        )
+        # 快照记录完整状态
+        self.assertEqual(self.logs[4].new_data, self.states[4])
+        self.assertEqual(self.logs[4].old_data, {'text': 'v3'})
+
+    def test_record_many_continues_the_snapshot_cadence(self):
+        for index in range(1, 4):
+            self.edit(text=f'v{index}')
+        old_state = self.node.get_state()
+        self.node.text = 'batch'
+        logs = NodeEditLog.record_many(self.owner, [(self.node, 'update', old_state)])
+        self.assertEqual([log.is_snapshot for log in logs], [True])
+        self.assertEqual(logs[0].new_data, self.node.get_state())
+
+    def test_reconstructs_every_step_from_diff_chains(self):
+        edits = [
+            {'text': 'v1'}, {'note': 'n'}, {'tags': ['a']}, {'text': 'v2', 'expand': False},
+            {'parent_node_uid': 'other'}, {'icon': ['priority_1']}, {'text': 'v3'}, {'note': ''},
+        ]
+        for fields in edits:
+            self.edit(**fields)
+
+        for step, expected in enumerate(self.states):
+            state, replayed = reconstruct_node_state(self.project.id, 'n1', self.at(step))
+            self.assertEqual(state, expected, f'step {step}')
+            # 从最近的快照开始回放，不超过快照间隔
+            self.assertLessEqual(replayed, 4)
+        self.assertEqual(reconstruct_node_state(self.project.id, 'n1', self.start - timedelta(minutes=1)), (None, 0))
+
+        log = NodeEditLog.record(self.node, self.owner, 'delete')
+        self.set_time(log, len(self.logs))
+        self.assertEqual(reconstruct_node_state(self.project.id, 'n1', self.at(len(self.logs))), (None, 1))
+
+    def test_history_api(self):
+        for index in range(1, 6):
+            self.edit(text=f'v{index}')
+        url = f'/api/projects/{self.project.id}/nodes/history/'
+        self.client.force_authenticate(self.owner)
+
+        response = self.client.get(url, {'node': 'n1', 'at': self.at(2).isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['exists'])
+        self.assertEqual(response.data['state'], self.states[2])
+        self.assertEqual(response.data['replayed_logs'], 3)
+
+        # 默认为当前时刻，从第 4 步的快照开始回放
+        response = self.client.get(url, {'node': 'n1'})
+        self.assertEqual(response.data['state']['text'], 'v5')
+        self.assertEqual(response.data['replayed_logs'], 2)
+
+        response = self.client.get(url, {'node': 'missing'})
+        self.assertEqual((response.data['exists'], response.data['state']), (False, None))
+
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(url, {'node': 'n1', 'at': 'yesterday'}).status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(create_user('outsider', 2))
+        self.assertEqual(self.client.get(url, {'node': 'n1'}).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TimeTravelTests(APITestCase):
+    def setUp(self):
+        archive_root = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_root.cleanup)
+        archive_settings = override_settings(EDIT_LOG_ARCHIVE_ROOT=archive_root.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.now = timezone.now()
+
+        # 10 天前创建 n1，8 天前、6 天前修改，4 天前创建 n2，2 天前删除 n1
+        n1 = self.create_node('n1', 'v1', days_ago=10)
+        self.edit(n1, 'v2', days_ago=8)
+        self.checkpoint = MapCheckpoint.create_for_project(self.project)
+        self.edit(n1, 'v3', days_ago=6)
+        self.create_node('n2', 'other', days_ago=4)
+        log = NodeEditLog.record(n1, self.owner, 'delete')
+        n1.delete()
+        self.set_time(log, days_ago=2)
+
+    def days_ago(self, days):
+        return self.now - timedelta(days=days)
+
+    def set_time(self, log, days_ago):
+        NodeEditLog.objects.filter(id=log.id).update(timestamp=self.days_ago(days_ago))
+
+    def create_node(self, node_id, text, days_ago):
+        node = MindMapNode.objects.create(
+            project=self.project, node_id=node_id, parent_node_uid='root', creator=self.owner, text=text
+        )
+        self.set_time(NodeEditLog.record(node, self.owner, 'create'), days_ago)
+        return node
+
+    def edit(self, node, text, days_ago):
+        old_state = node.get_state()
+        node.text = text
+        node.save()
+        self.set_time(NodeEditLog.record(node, self.owner, 'update', old_state), days_ago)
+
+    def texts_at(self, days_ago):
+        result = reconstruct_project_states(self.project, self.days_ago(days_ago))
+        # 案件创建时生成的默认节点没有编辑日志，只比较测试中编辑的节点
+        texts = {node_uid: state['text'] for node_uid, state in result['states'].items() if node_uid in ('n1', 'n2')}
+        return texts, result['checkpoint_id']
+
+    def test_replays_forward_from_checkpoint(self):
+        texts, checkpoint_id = self.texts_at(5)
+        self.assertEqual(texts, {'n1': 'v3'})
+        self.assertEqual(checkpoint_id, self.checkpoint.id)
+
+    def test_undoes_backward_from_current_state(self):
+        texts, checkpoint_id = self.texts_at(3)
+        self.assertEqual(texts, {'n1': 'v3', 'n2': 'other'})
+        self.assertIsNone(checkpoint_id)
+        self.assertEqual(self.texts_at(1)[0], {'n2': 'other'})
+        self.assertEqual(self.texts_at(11)[0], {})
+
+    def test_reads_archived_logs(self):
+        MapCheckpoint.objects.all().delete()
+        self.assertEqual(archive_edit_logs(self.days_ago(7))['archived'], 2)
+        self.assertEqual(self.texts_at(9)[0], {'n1': 'v1'})
+        self.assertEqual(self.texts_at(7)[0], {'n1': 'v2'})
+
+    def test_time_travel_api(self):
+        url = f'/api/projects/{self.project.id}/nodes/time-travel/'
+        self.client.force_authenticate(self.owner)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.get(url, {'at': self.days_ago(5).isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        root = next(child for child in response.data['map']['children'] if child['data']['uid'] == 'root')
+        self.assertEqual([child['data']['text'] for child in root['children']], ['v3'])
+
+        self.client.force_authenticate(create_user('outsider', 2))
+        self.assertEqual(self.client.get(url, {'at': self.days_ago(5).isoformat()}).status_code, status.HTTP_403_FORBIDDEN)
+
+
+@override_settings(MAP_CHECKPOINT_EVERY_EDITS=3)
+class MapCheckpointTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.node = MindMapNode.objects.get(project=self.project, node_id='root')
+
+    def edit(self, text):
+        old_state = self.node.get_state()
+        self.node.text = text
+        self.node.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            NodeEditLog.record(self.node, self.owner, 'update', old_state)
+
+    def test_rolled_back_edits_do_not_create_checkpoints(self):
+        checkpoints.create_checkpoint_if_due(self.project)
+        self.edit('a')
+        self.edit('b')
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    NodeEditLog.record(self.node, self.owner, 'update', {**self.node.get_state(), 'text': 'x'})
+                    raise RuntimeError('write failed')
+        self.assertEqual(MapCheckpoint.objects.filter(project=self.project).count(), 1)
+
+    def test_checkpoint_is_created_after_the_write_commits(self):
+        checkpoints.create_checkpoint_if_due(self.project)
+        self.edit('a')
+        self.edit('b')
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                old_state = self.node.get_state()
+                self.node.text = 'c'
+                self.node.save()
+                NodeEditLog.record(self.node, self.owner, 'update', old_state)
+                self.assertEqual(MapCheckpoint.objects.filter(project=self.project).count(), 1)
+        self.assertEqual(MapCheckpoint.objects.filter(project=self.project).count(), 2)
+
+    def test_checkpoint_is_created_after_enough_edits(self):
+        self.assertTrue(checkpoints.checkpoint_due(self.project))
+        checkpoints.create_checkpoint_if_due(self.project)
+
+        self.edit('a')
+        self.edit('b')
+        self.assertFalse(checkpoints.checkpoint_due(self.project))
+        self.assertEqual(MapCheckpoint.objects.filter(project=self.project).count(), 1)
+
+        # 第三条编辑日志写入后立即创建
+        self.edit('c')
+        latest = checkpoints.latest_checkpoint(self.project)
+        self.assertEqual(MapCheckpoint.objects.filter(project=self.project).count(), 2)
+        self.assertEqual(latest.get_states()['root']['text'], 'c')
+        self.assertFalse(checkpoints.checkpoint_due(self.project))
+
+    @override_settings(MAP_CHECKPOINT_INTERVAL_HOURS=1)
+    def test_checkpoint_is_due_after_interval_only_with_edits(self):
+        checkpoint = checkpoints.create_checkpoint_if_due(self.project)
+        later = checkpoint.created_at + timedelta(hours=2)
+        self.assertFalse(checkpoints.checkpoint_due(self.project, now=later))
+        self.edit('a')
+        self.assertTrue(checkpoints.checkpoint_due(self.project, now=later))
+
+    def test_retention_thins_old_checkpoints(self):
+        now = timezone.make_aware(datetime(2026, 6, 30, 12))
+        times = {
+            'latest': datetime(2026, 6, 30, 10),
+            'recent': datetime(2026, 6, 27, 10),
+            'recent_same_day': datetime(2026, 6, 27, 9),
+            'daily': datetime(2026, 6, 10, 18),
+            'daily_same_day': datetime(2026, 6, 10, 9),
+            'daily_other_day': datetime(2026, 6, 9, 9),
+            'monthly': datetime(2026, 2, 20),
+            'monthly_same_month': datetime(2026, 2, 3),
+            'monthly_other_month': datetime(2026, 1, 15),
+        }
+        for name, timestamp in times.items():
+            MapCheckpoint.objects.create(
+                project=self.project, last_log_timestamp=timezone.make_aware(timestamp),
+                node_count=0, data=MapCheckpoint.encode_states({'name': name})
+            )
+
+        self.assertEqual(checkpoints.prune_checkpoints(self.project, now=now, dry_run=True), 2)
+        self.assertEqual(checkpoints.prune_checkpoints(self.project, now=now), 2)
+        remaining = {checkpoint.get_states()['name'] for checkpoint in MapCheckpoint.objects.filter(project=self.project)}
+        self.assertEqual(remaining, set(times) - {'daily_same_day', 'monthly_same_month'})
+
+
+@override_settings(MINDMAP_WS_QUEUE_LIMIT=3)
+class OutboxTests(SimpleTestCase):
+    def make_outbox(self):
+        """发送在 release 之前一直阻塞，模拟写缓冲已满的慢速客户端"""
+        self.sent = []
+        self.release = asyncio.Event()
+
+        async def send(frame):
+            await self.release.wait()
+            self.sent.append(frame)
+
+        async def build_resync():
+            return 'snapshot'
+
+        return Outbox(send, build_resync)
+
+    async def flush(self, outbox):
+        """放开发送，等待队列发完后关闭"""
+        self.release.set()
+        for _ in range(20):
+            await asyncio.sleep(0)
+        outbox.close()
+
+    async def test_updates_to_the_same_node_are_merged(self):
+        outbox = self.make_outbox()
+        outbox.put('n1 v1', droppable=True, merge_key='n1')
+        outbox.put('n2 v1', droppable=True, merge_key='n2')
+        outbox.put('n1 v2', droppable=True, merge_key='n1')
+        self.assertEqual((outbox.depth, outbox.merged), (2, 1))
+
+        await self.flush(outbox)
+        self.assertEqual(self.sent, ['n2 v1', 'n1 v2'])
+
+    async def test_backlog_is_replaced_by_a_snapshot(self):
+        outbox = self.make_outbox()
+        outbox.put('reply')
+        for index in range(3):
+            outbox.put(f'event {index}', droppable=True)
+        self.assertEqual((outbox.depth, outbox.dropped), (1, 3))
+
+        # 快照之后的事件照常发送
+        outbox.put('event 3', droppable=True)
+        await self.flush(outbox)
+        self.assertEqual(self.sent, ['reply', 'snapshot', 'event 3'])
+        self.assertEqual(outbox.resyncs, 1)
+
+    async def test_cursor_flood_to_stalled_client_stays_bounded(self):
+        outbox = self.make_outbox()
+        outbox.put('reply')
+        for index in range(1000):
+            outbox.put(f'cursors {index}', droppable=True, merge_key='cursors')
+            self.assertLessEqual(outbox.depth, 2)
+        self.assertEqual(outbox.merged, 999)
+        await self.flush(outbox)
+        self.assertEqual(self.sent, ['reply', 'cursors 999'])
+
+    async def test_backlog_without_droppable_frames_is_not_rescanned(self):
+        outbox = self.make_outbox()
+        with mock.patch.object(outbox, '_shed', wraps=outbox._shed) as shed:
+            for index in range(10):
+                outbox.put(f'reply {index}')
+            self.assertEqual(shed.call_count, 0)
+            outbox.put('event', droppable=True)
+            self.assertEqual(shed.call_count, 1)
+            outbox.put('reply 10')
+            self.assertEqual(shed.call_count, 1)
+        self.assertEqual(outbox.droppable, 0)
+        await self.flush(outbox)
+
+    async def test_replies_are_never_dropped(self):
+        outbox = self.make_outbox()
+        for index in range(5):
+            outbox.put(f'reply {index}')
+        self.assertEqual(outbox.dropped, 0)
+        await self.flush(outbox)
+        self.assertEqual(self.sent, [f'reply {index}' for index in range(5)])
+
+
+class PresenceTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.member = create_user('member', 2)
+        self.outsider = create_user('outsider', 3)
+        self.project = create_project(self.owner, members=[self.member])
+        self.other_project = create_project(self.outsider, root_uid='other_root')
+        self.room = rooms.room_group_name(self.project.id)
+
+    def test_user_is_online_until_last_connection_leaves(self):
+        self.assertTrue(presence.join(self.room, self.owner, 'tab1'))
+        self.assertFalse(presence.join(self.room, self.owner, 'tab2'))
+        self.assertTrue(presence.join(self.room, self.member, 'tab3'))
+        self.assertEqual(presence.online_users(self.room), ['member', 'owner'])
+
+        self.assertFalse(presence.leave(self.room, self.owner, 'tab1'))
+        self.assertEqual(presence.online_users(self.room), ['member', 'owner'])
+        self.assertTrue(presence.leave(self.room, self.owner, 'tab2'))
+        self.assertEqual(presence.online_users(self.room), ['member'])
+
+    @override_settings(MINDMAP_PRESENCE_TTL=60)
+    def test_stale_connections_expire(self):
+        with mock.patch('mindmaps.presence.time.time', return_value=1000):
+            presence.join(self.room, self.owner, 'crashed')
+            presence.join(self.room, self.member, 'alive')
+        # 60 秒内有心跳的连接仍在线
+        with mock.patch('mindmaps.presence.time.time', return_value=1050):
+            self.assertEqual(presence.heartbeat(self.room, self.member, 'alive'), [])
+            self.assertEqual(presence.online_users(self.room), ['member', 'owner'])
+        with mock.patch('mindmaps.presence.time.time', return_value=1070):
+            # 读取时不计入过期成员，心跳时清理并报告离线的用户
+            self.assertEqual(presence.online_users(self.room), ['member'])
+            self.assertEqual(presence.presence_counts([self.project.id]), {self.project.id: 1})
+            self.assertEqual(presence.heartbeat(self.room, self.member, 'alive'), ['owner'])
+            self.assertEqual(presence.heartbeat(self.room, self.member, 'alive'), [])
+
+    async def test_join_and_leave_are_broadcast(self):
+        owner = await self.connect(self.owner, self.project)
+        member = self.communicator(self.member, self.project)
+        await member.connect()
+        self.communicators.append(member)
+        message = await self.receive_type(member, 'online_users')
+        self.assertEqual(message['users'], ['member', 'owner'])
+        message = await self.receive_type(owner, 'user_joined')
+        self.assertEqual(message['user'], 'member')
+
+        # 同一用户再打开一个标签页不重复通知
+        await self.connect(self.member, self.project)
+        self.assertEqual(await self.drain(owner), [])
+
+        await self.communicators.pop().disconnect()
+        self.assertEqual(await self.drain(owner), [])
+        await self.communicators.pop().disconnect()
+        message = await self.receive_type(owner, 'user_left')
+        self.assertEqual(message['user'], 'member')
+        self.assertEqual(await sync_to_async(presence.online_users)(self.room), ['owner'])
+        await self.disconnect_all()
+
+    def test_presence_counts_only_projects_of_the_user(self):
+        presence.join(self.room, self.owner, 'tab1')
+        presence.join(self.room, self.member, 'tab2')
+        presence.join(rooms.room_group_name(self.other_project.id), self.outsider, 'tab3')
+        client = APIClient()
+        client.force_authenticate(self.member)
+
+        response = client.get('/api/projects/presence/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {str(self.project.id): 2})
+
+        # 指定的案件中不是成员的不统计
+        response = client.get('/api/projects/presence/', {'ids': f'{self.project.id},{self.other_project.id}'})
+        self.assertEqual(response.data, {str(self.project.id): 2})
+        response = client.get('/api/projects/presence/', {'ids': str(self.other_project.id)})
+        self.assertEqual(response.data, {})
+
+        response = client.get('/api/projects/presence/', {'ids': 'a,b'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CursorCoalescingTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.alice = create_user('alice', 2)
+        self.bob = create_user('bob', 3)
+        self.project = create_project(self.owner, members=[self.alice, self.bob])
+
+    async def test_coalescer_flushes_latest_values_once_per_interval(self):
+        flushes = []
+
+        async def flush(pending):
+            flushes.append((asyncio.get_running_loop().time(), pending))
+
+        coalescer = CursorCoalescer(flush, interval=0.1)
+        # 空闲后的第一条立即刷新，之后一个周期内的数据合并为一次
+        coalescer.put('a', 0)
+        await asyncio.sleep(0)
+        for value in range(1, 10):
+            coalescer.put('a', value)
+            coalescer.put('b', value * 10)
+        await asyncio.sleep(0.25)
+        coalescer.close()
+
+        self.assertEqual([pending for _, pending in flushes], [{'a': 0}, {'a': 9, 'b': 90}])
+        self.assertGreaterEqual(flushes[1][0] - flushes[0][0], 0.09)
+
+    async def test_cursor_moves_in_one_tick_arrive_as_one_frame(self):
+        with self.settings(MINDMAP_CURSOR_FLUSH_HZ=10):
+            receiver = await self.connect(self.owner, self.project)
+            alice = await self.connect(self.alice, self.project)
+            bob = await self.connect(self.bob, self.project)
+        await self.drain(receiver)
+        await self.drain(alice)
+
+        for x in range(10):
+            await alice.send_json_to({'type': 'cursor_move', 'x': x, 'y': 1})
+            await bob.send_json_to({'type': 'cursor_move', 'x': 100 + x, 'y': 2})
+
+        loop = asyncio.get_running_loop()
+        frames = []
+        while not await receiver.receive_nothing(0.3):
+            message = await self.receive(receiver)
+            self.assertEqual(message['type'], 'cursors')
+            frames.append((loop.time(), message['cursors']))
+
+        # 20 次移动最多合并为发送端和接收端各一次立即刷新加一个周期的帧
+        self.assertLessEqual(len(frames), 3)
+        for (previous, _), (current, _) in zip(frames, frames[1:]):
+            self.assertGreaterEqual(current - previous, 0.08)
+        for _, cursors in frames:
+            users = [cursor['user'] for cursor in cursors]
+            self.assertEqual(len(users), len(set(users)))
+        self.assertEqual(
+            sorted(frames[-1][1], key=lambda cursor: cursor['user']),
+            [{'user': 'alice', 'x': 9, 'y': 1}, {'user': 'bob', 'x': 109, 'y': 2}]
+        )
+        await self.disconnect_all()
+
+
+# 房间分布在 shard_a、shard_b 两个分片上，old 用于模拟迁移前的分片
+SHARD_TEST_SETTINGS = {
+    **WS_TEST_SETTINGS,
+    'CHANNEL_LAYERS': {
+        alias: {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+        for alias in ('default', 'old', 'shard_a', 'shard_b')
+    },
+    'MINDMAP_ROOM_SHARDS': ['shard_a', 'shard_b'],
+}
+
+
+@override_settings(**SHARD_TEST_SETTINGS)
+class RoomShardingTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.room = rooms.room_group_name(self.project.id)
+
+    def test_adding_a_shard_moves_only_its_share_of_rooms(self):
+        keys = [f'mindmap_{index}' for index in range(2000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+
+        for shard in before.shards:
+            share = sum(1 for key in keys if before.get(key) == shard) / len(keys)
+            self.assertGreater(share, 0.2)
+            self.assertLess(share, 0.47)
+
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertLess(len(moved), 0.35 * len(keys))
+        self.assertEqual({after.get(key) for key in moved}, {'d'})
+
+    async def test_room_joins_and_broadcasts_on_its_shard_only(self):
+        alias = room_layer_alias(self.room)
+        other_alias = ({'shard_a', 'shard_b'} - {alias}).pop()
+        sender = await self.connect(self.owner, self.project)
+        receiver = await self.connect(self.owner, self.project)
+        self.assertIn(self.room, get_channel_layer(alias).groups)
+        self.assertNotIn(self.room, get_channel_layer(other_alias).groups)
+
+        await sender.send_json_to({'type': 'node_create', 'parent_id': 'root', 'node_data': {'uid': 'n1', 'text': '新节点'}})
+        message = await self.receive_type(receiver, 'node_created')
+        self.assertEqual(message['node']['id'], 'n1')
+        await self.disconnect_all()
+
+    async def test_broadcasts_reach_previous_shard_during_migration(self):
+        with self.settings(MINDMAP_ROOM_SHARDS=['old']):
+            old_client = await self.connect(self.owner, self.project)
+        with self.settings(MINDMAP_ROOM_SHARDS_PREVIOUS=['old']):
+            new_client = await self.connect(self.owner, self.project)
+            await new_client.send_json_to({'type': 'node_create', 'parent_id': 'root', 'node_data': {'uid': 'n1', 'text': '新节点'}})
+            message = await self.receive_type(old_client, 'node_created')
+        self.assertEqual(message['node']['id'], 'n1')
+        await self.disconnect_all()
+
+
+class EntityIndexTests(APITestCase):
+    url = '/api/mindmaps/entities/'
+
+    def setUp(self):
+        self.owner = create_user('owner', 1)
+        self.other = create_user('other', 2)
+        self.project = create_project(self.owner)
+        self.other_project = create_project(self.other, root_uid='other_root')
+        self.node = MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner,
+            text='机主电话 138-0013-8000', note='身份证11010519491231002x'
+        )
+        MindMapNode.objects.create(
+            project=self.other_project, node_id='n2', parent_node_uid='other_root', creator=self.other,
+            text='联系人 13800138000'
+        )
+
+    def lookup(self, user, value, **params):
+        self.client.force_authenticate(user)
+        response = self.client.get(self.url, {'value': value, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return sorted((project['project_id'], node['node_id']) for project in response.data['projects'] for node in project['nodes'])
+
+    def test_extracts_normalized_entities(self):
+        found = entities.extract_entities(
+            '电话 138 0013 8000，全角１３９００１３９０００，卡号4111 1111 1111 1111，'
+            'IP 192.168.1.10，无效IP 256.1.1.1，长串2138001380001'
+        )
+        self.assertEqual(found, {
+            ('phone', '13800138000'), ('phone', '13900139000'),
+            ('bank_card', '4111111111111111'), ('ip', '192.168.1.10'),
+        })
+
+    def test_members_see_only_their_cases(self):
+        self.assertEqual(self.lookup(self.owner, '138 0013 8000'), [(self.project.id, 'n1')])
+        self.assertEqual(self.lookup(self.owner, '11010519491231002x', kind='id_card'), [(self.project.id, 'n1')])
+
+    def test_staff_see_every_case(self):
+        self.owner.is_staff = True
+        self.owner.save()
+        self.assertEqual(
+            self.lookup(self.owner, '13800138000'),
+            [(self.project.id, 'n1'), (self.other_project.id, 'n2')]
+        )
+
+    def test_index_follows_node_edits(self):
+        self.node.text = '号码已注销'
+        self.node.save(update_fields=['text'])
+        self.assertEqual(self.lookup(self.owner, '13800138000'), [])
+        self.assertEqual(self.lookup(self.owner, '11010519491231002X'), [(self.project.id, 'n1')])
+
+    def test_rejects_unknown_kind(self):
+        self.client.force_authenticate(self.owner)
+        response = self.client.get(self.url, {'value': '13800138000', 'kind': 'email'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class NodeTagIndexTests(APITestCase):
+    def setUp(self):
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        self.client.force_authenticate(self.owner)
+        self.node = MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner,
+            tags=['嫌疑人', {'text': '重点', 'style': {'fill': 'red'}}, '嫌疑人', ' ', None]
+        )
+        MindMapNode.objects.create(
+            project=self.project, node_id='n2', parent_node_uid='root', creator=self.owner, tags=['重点']
+        )
+
+    def tag_rows(self, node):
+        return list(NodeTag.objects.filter(node=node).order_by('sort_order').values_list('text', 'style_data', 'sort_order'))
+
+    def test_tags_are_indexed_without_blanks_or_duplicates(self):
+        self.assertEqual(self.tag_rows(self.node), [('嫌疑人', {}, 0), ('重点', {'fill': 'red'}, 1)])
+
+    def test_versioned_save_resyncs_tags(self):
+        self.node.tags = [{'text': '重点', 'style': {'fill': 'blue'}}, '已抓获']
+        self.assertTrue(self.node.save_versioned(self.node.version, ['tags']))
+        self.assertEqual(self.tag_rows(self.node), [('重点', {'fill': 'blue'}, 0), ('已抓获', {}, 1)])
+
+    def test_saves_without_tag_changes_do_not_touch_the_index(self):
+        self.node.text = '改名'
+        with CaptureQueriesContext(connection) as queries:
+            self.node.save(update_fields=['text'])
+        self.assertFalse([query for query in queries if 'mindmaps_nodetag' in query['sql']])
+
+    def test_tag_facets_and_filter(self):
+        response = self.client.get(f'/api/projects/{self.project.id}/nodes/tags/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['tags'], [{'tag': '重点', 'count': 2}, {'tag': '嫌疑人', 'count': 1}])
+
+        url = f'/api/projects/{self.project.id}/nodes/by-tag/'
+        self.assertEqual(self.client.get(url, {'tag': ' 重点 '}).data['node_ids'], ['n1', 'n2'])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.force_authenticate(create_user('outsider', 2))
+        self.assertEqual(self.client.get(url, {'tag': '重点'}).status_code, status.HTTP_403_FORBIDDEN)
+
+
+class EventReplayTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+        MindMapNode.objects.create(
+            project=self.project, node_id='n1', parent_node_uid='root', creator=self.owner, text=''
+        )
+
+    async def make_events(self, communicator, count):
+        for index in range(count):
+            await communicator.send_json_to({'type': 'node_update', 'node_id': 'n1', 'updates': {'text': str(index)}})
+            await self.receive_type(communicator, 'node_updated')
+
+    async def test_new_connection_gets_current_seq(self):
+        communicator = self.communicator(self.owner, self.project)
+        await communicator.connect()
+        self.communicators.append(communicator)
+        messages = await self.drain(communicator)
+        self.assertIn({'type': 'sync', 'seq': 0}, messages)
+        await self.disconnect_all()
+
+    async def test_reconnect_replays_missed_events(self):
+        first = await self.connect(self.owner, self.project)
+        await self.make_events(first, 3)
+
+        second = self.communicator(self.owner, self.project, 'last_seq=1')
+        await second.connect()
+        self.communicators.append(second)
+        replayed = [message for message in await self.drain(second) if 'seq' in message]
+        self.assertEqual([(message['type'], message['seq']) for message in replayed], [('node_updated', 2), ('node_updated', 3)])
+        self.assertEqual(replayed[-1]['node']['text'], '2')
+        await self.disconnect_all()
+
+    async def test_replay_request_fills_gap(self):
+        communicator = await self.connect(self.owner, self.project)
+        await self.make_events(communicator, 3)
+        await self.drain(communicator)
+
+        await communicator.send_json_to({'type': 'replay', 'last_seq': 2})
+        message = await communicator.receive_json_from()
+        self.assertEqual((message['type'], message['seq']), ('node_updated', 3))
+        self.assertTrue(await communicator.receive_nothing(0.05))
+
+        await communicator.send_json_to({'type': 'replay', 'last_seq': 'x'})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        await self.disconnect_all()
+
+    @override_settings(MINDMAP_EVENT_LOG_SIZE=2)
+    async def test_gap_outside_log_sends_snapshot(self):
+        communicator = await self.connect(self.owner, self.project)
+        await self.make_events(communicator, 4)
+        await self.drain(communicator)
+
+        await communicator.send_json_to({'type': 'replay', 'last_seq': 1})
+        message = await communicator.receive_json_from()
+        self.assertEqual((message['type'], message['seq']), ('snapshot', 4))
+        self.assertEqual({node['id']: node['text'] for node in message['nodes']}['n1'], '3')
+        await self.disconnect_all()
+
+    async def test_resync_request_sends_snapshot(self):
+        communicator = await self.connect(self.owner, self.project)
+        await self.make_events(communicator, 2)
+        await self.drain(communicator)
+
+        await communicator.send_json_to({'type': 'resync'})
+        message = await communicator.receive_json_from()
+        self.assertEqual((message['type'], message['seq']), ('snapshot', 2))
+        self.assertEqual({node['id']: node['text'] for node in message['nodes']}['n1'], '1')
+        await self.disconnect_all()
+
+
+@override_settings(MINDMAP_PROFILE_HEADER='X-Mindmap-Profile', MINDMAP_PROFILE_SAMPLE_RATE=0)
+class ProfilerMiddlewareTests(APITestCase):
+    url = '/api/projects/{}/nodes/tree/'
+
+    def setUp(self):
+        profiling.clear()
+        self.user = create_user('user', 1)
+        self.staff = create_user('staff', 2)
+        self.staff.is_staff = True
+        self.staff.save()
+        self.project = create_project(self.user, [self.staff])
+
+    def tearDown(self):
+        profiling.clear()
+
+    def test_header_from_anonymous_or_regular_user_is_ignored(self):
+        self.client.get(self.url.format(self.project.id), HTTP_X_MINDMAP_PROFILE='1')
+        self.client.force_login(self.user)
+        self.client.get(self.url.format(self.project.id), HTTP_X_MINDMAP_PROFILE='1')
+        self.assertEqual(profiling.get_samples(), [])
+
+    def test_header_from_staff_is_profiled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(self.url.format(self.project.id), HTTP_X_MINDMAP_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        samples = profiling.get_samples()
+        self.assertEqual(len(samples), 1)
+        self.assertEqual((samples[0]['view'], samples[0]['action'], samples[0]['user']), ('MindMapNodeViewSet', 'tree', 'staff'))
+        self.assertGreater(samples[0]['queries'], 0)
+
+    @override_settings(MINDMAP_PROFILE_SAMPLE_RATE=1)
+    def test_sampled_requests_are_profiled(self):
+        self.client.get(self.url.format(self.project.id))
+        self.assertEqual(len(profiling.get_samples()), 1)
+
+    def test_samples_are_visible_to_staff_only(self):
+        url = '/api/mindmaps/request-profiles/'
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+
+class MetricsViewTests(TestCase):
+    url = '/metrics'
+
+    def test_loopback_is_not_allowed_by_default(self):
+        # 反向代理之后外部请求的 REMOTE_ADDR 也是 127.0.0.1
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+    @override_settings(MINDMAP_METRICS_ALLOWED_IPS=['10.0.0.5'])
+    def test_allowed_ip(self):
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='10.0.0.6').status_code, 403)
+
+    @override_settings(MINDMAP_METRICS_TOKEN='secret')
+    def test_bearer_token(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(self.url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', response.content.decode())
+
+    def test_staff(self):
+        user = create_user('user', 1)
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+class BroadcastProtocolTests(MindMapConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = create_user('owner', 1)
+        self.project = create_project(self.owner)
+
+    async def test_event_is_encoded_once_for_mixed_protocols(self):
+        json_client = await self.connect(self.owner, self.project)
+        msgpack_client = await self.connect(self.owner, self.project, subprotocols=[protocol.MSGPACK_SUBPROTOCOL])
+
+        sent = []
+        original = rooms.group_send
+
+        async def recording_group_send(room, event):
+            sent.append(event)
+            await original(room, event)
+
+        with mock.patch.object(rooms, 'group_send', recording_group_send):
+            await json_client.send_json_to({
+                'type': 'node_create', 'parent_id': 'root', 'node_data': {'uid': 'n1', 'text': '备注' * 600}
+            })
+            from_json = await self.receive_type(json_client, 'node_created')
+            frame = await msgpack_client.receive_output()
+
+        self.assertEqual(set(sent[0]), {'type', 'frame'})
+        self.assertIsInstance(frame['bytes'], bytes)
+        self.assertEqual(frame['bytes'][0], protocol.FLAG_ZLIB)
+        self.assertEqual(protocol.decode(bytes_data=frame['bytes']), from_json)
+        await self.disconnect_all()
+
+    def test_broadcast_frame_converts_once_per_process(self):
+        frame = protocol.encode_broadcast({'type': 'node_deleted', 'node_id': 'n1', 'seq': 1})
+        self.assertIs(protocol.broadcast_frame(frame, protocol.JSON), frame)
+        converted = protocol.broadcast_frame(frame, protocol.MSGPACK)
+        self.assertIs(protocol.broadcast_frame(frame, protocol.MSGPACK), converted)
+        self.assertEqual(protocol.decode(bytes_data=converted)['node_id'], 'n1')
+
+    @override_settings(MINDMAP_WS_MAX_FRAME_BYTES=64 * 1024)
+    async def test_oversize_compressed_frame_is_rejected(self):
+        # 约 1MB 的消息压缩后只有约 1KB
+        bomb = bytes([protocol.FLAG_ZLIB]) + zlib.compress(
+            protocol.msgpack.packb({'type': 'cursor_move', 'x': 'a' * (1024 * 1024), 'y': 0})
+        )
+        self.assertLess(len(bomb), 4096)
+        with self.assertRaises(ValueError):
+            protocol.decode(bytes_data=bomb)
+
+        client = await self.connect(self.owner, self.project, subprotocols=[protocol.MSGPACK_SUBPROTOCOL])
+        await client.send_to(bytes_data=bomb)
+        self.assertEqual(await self.receive_type(client, 'error'), {'type': 'error', 'message': '无效的消息格式'})
+
+        # 限制以内的压缩帧照常解码
+        small = bytes([protocol.FLAG_ZLIB]) + zlib.compress(protocol.msgpack.packb({'type': 'ping'}))
+        self.assertEqual(protocol.decode(bytes_data=small), {'type': 'ping'})
+        await self.disconnect_all()
 
-# Create your tests here.
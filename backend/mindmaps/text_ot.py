@@ -0,0 +1,447 @@
+"""节点文本的操作转换（OT）协同编辑
+
+节点的 text 和 note 字段支持字符级协同编辑。操作（op）是一个列表，依次描述对文本的处理：
+- 正整数 n：保留 n 个字符；
+- 字符串 s：插入 s；
+- 负整数 -n：删除 n 个字符。
+长度按 Unicode 码点计算（前端需要用 Array.from 处理字符串，而不是 UTF-16 长度）。
+
+服务端为正在编辑的节点字段在内存中维护一份文档（TextDocument），记录版本号和最近的操作历史。
+客户端提交基于某个版本的操作，服务端先与该版本之后的并发操作做转换再应用，然后只广播转换后的操作。
+与 node_update 相同，只有节点的创建者可以打开文档和提交操作。
+合并后的文本在停止输入 MINDMAP_TEXT_FLUSH_DELAY 秒后写回数据库（持续输入时最长
+MINDMAP_TEXT_FLUSH_MAX_DELAY 秒写一次），每次写回记录一条编辑日志。
+
+文档保存在进程内存中，同一案件的连接需要落在同一个进程上（单进程部署或按案件分配进程）。
+"""
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import MindMapNode, NodeEditLog
+
+logger = logging.getLogger(__name__)
+
+# 支持协同编辑的字段
+OT_FIELDS = ('text', 'note')
+
+
+# ==================== 操作的构造与校验 ====================
+
+def _is_retain(component):
+    return isinstance(component, int) and component > 0
+
+
+def _is_delete(component):
+    return isinstance(component, int) and component < 0
+
+
+def _is_insert(component):
+    return isinstance(component, str)
+
+
+def _retain(op, n):
+    if n <= 0:
+        return
+    if op and _is_retain(op[-1]):
+        op[-1] += n
+    else:
+        op.append(n)
+
+
+def _insert(op, text):
+    if not text:
+        return
+    if op and _is_insert(op[-1]):
+        op[-1] += text
+    elif op and _is_delete(op[-1]):
+        # 相邻的插入和删除统一为先插入后删除，便于比较和合并
+        if len(op) >= 2 and _is_insert(op[-2]):
+            op[-2] += text
+        else:
+            op.insert(len(op) - 1, text)
+    else:
+        op.append(text)
+
+
+def _delete(op, n):
+    if n <= 0:
+        return
+    if op and _is_delete(op[-1]):
+        op[-1] -= n
+    else:
+        op.append(-n)
+
+
+def normalize(op):
+    """校验操作格式并合并相邻的同类组件；格式错误时抛出 ValueError"""
+    if not isinstance(op, list):
+        raise ValueError('操作必须是列表')
+    result = []
+    for component in op:
+        if isinstance(component, bool):
+            raise ValueError('无效的操作组件')
+        if _is_retain(component):
+            _retain(result, component)
+        elif _is_delete(component):
+            _delete(result, -component)
+        elif _is_insert(component):
+            _insert(result, component)
+        elif component != 0:
+            raise ValueError('无效的操作组件')
+    return result
+
+
+def base_length(op):
+    """操作要求的原文本长度"""
+    return sum(c if _is_retain(c) else -c for c in op if not _is_insert(c))
+
+
+def target_length(op):
+    """应用操作后的文本长度"""
+    return sum(len(c) if _is_insert(c) else c for c in op if not _is_delete(c))
+
+
+def apply(text, op):
+    """将操作应用到文本"""
+    if base_length(op) != len(text):
+        raise ValueError('操作与文本长度不匹配')
+    parts = []
+    position = 0
+    for component in op:
+        if _is_retain(component):
+            parts.append(text[position:position + component])
+            position += component
+        elif _is_insert(component):
+            parts.append(component)
+        else:
+            position -= component
+    return ''.join(parts)
+
+
+def transform(op_a, op_b):
+    """转换基于同一文本的两个并发操作
+
+    返回 (a', b')，满足 apply(apply(S, a), b') == apply(apply(S, b), a')。
+    两个操作在同一位置插入时，a 的插入排在前面。
+    """
+    if base_length(op_a) != base_length(op_b):
+        raise ValueError('并发操作的基础长度不一致')
+
+    a_prime, b_prime = [], []
+    ops_a, ops_b = list(op_a), list(op_b)
+    index_a, index_b = 0, 0
+    a = ops_a[0] if ops_a else None
+    b = ops_b[0] if ops_b else None
+
+    def next_a():
+        nonlocal index_a
+        index_a += 1
+        return ops_a[index_a] if index_a < len(ops_a) else None
+
+    def next_b():
+        nonlocal index_b
+        index_b += 1
+        return ops_b[index_b] if index_b < len(ops_b) else None
+
+    while a is not None or b is not None:
+        if a is not None and _is_insert(a):
+            _insert(a_prime, a)
+            _retain(b_prime, len(a))
+            a = next_a()
+            continue
+        if b is not None and _is_insert(b):
+            _retain(a_prime, len(b))
+            _insert(b_prime, b)
+            b = next_b()
+            continue
+        if a is None or b is None:
+            raise ValueError('并发操作的长度不一致')
+
+        if _is_retain(a) and _is_retain(b):
+            length = min(a, b)
+            _retain(a_prime, length)
+            _retain(b_prime, length)
+            a = a - length or next_a()
+            b = b - length or next_b()
+        elif _is_delete(a) and _is_delete(b):
+            # 两边删除了同一段文本，转换后都不需要再删除
+            length = min(-a, -b)
+            a = a + length or next_a()
+            b = b + length or next_b()
+        elif _is_delete(a):
+            length = min(-a, b)
+            _delete(a_prime, length)
+            a = a + length or next_a()
+            b = b - length or next_b()
+        else:
+            length = min(a, -b)
+            _delete(b_prime, length)
+            a = a - length or next_a()
+            b = b + length or next_b()
+
+    return a_prime, b_prime
+
+
+def replace_op(old_text, new_text):
+    """生成把 old_text 整体替换为 new_text 的操作，只包含公共前后缀之外的变化"""
+    prefix = 0
+    max_prefix = min(len(old_text), len(new_text))
+    while prefix < max_prefix and old_text[prefix] == new_text[prefix]:
+        prefix += 1
+    suffix = 0
+    max_suffix = max_prefix - prefix
+    while suffix < max_suffix and old_text[-1 - suffix] == new_text[-1 - suffix]:
+        suffix += 1
+
+    op = []
+    _retain(op, prefix)
+    _insert(op, new_text[prefix:len(new_text) - suffix])
+    _delete(op, len(old_text) - prefix - suffix)
+    _retain(op, suffix)
+    return op
+
+
+# ==================== 内存中的协同文档 ====================
+
+class StaleRevision(Exception):
+    """客户端的版本号已超出服务端保留的历史，需要重新获取文档"""
+
+
+def get_history_size():
+    return getattr(settings, 'MINDMAP_TEXT_HISTORY_SIZE', 200)
+
+
+def get_flush_delay():
+    return getattr(settings, 'MINDMAP_TEXT_FLUSH_DELAY', 2)
+
+
+def get_flush_max_delay():
+    return getattr(settings, 'MINDMAP_TEXT_FLUSH_MAX_DELAY', 10)
+
+
+class TextDocument:
+    """一个节点字段的协同文档"""
+
+    def __init__(self, project_id, node_uid, field, text, editable, creator_id=None):
+        self.project_id = str(project_id)
+        self.node_uid = node_uid
+        self.field = field
+        self.text = text
+        self.editable = editable
+        self.creator_id = creator_id
+        self.revision = 0
+        # history[i] 是把版本 history_start + i 变为下一版本的操作
+        self.history = []
+        self.history_start = 0
+        self.subscribers = set()
+
+        self.persisted_text = text
+        self.last_editor = None
+        self.first_dirty_at = None
+        self.last_edit_at = None
+        self.flush_task = None
+
+    @property
+    def dirty(self):
+        return self.text != self.persisted_text
+
+    def can_be_edited_by(self, user):
+        """与 node_update 相同：只能修改自己创建的非系统默认节点"""
+        return self.editable and self.creator_id == user.id
+
+    def apply_client_op(self, revision, op, user):
+        """应用客户端基于 revision 版本的操作，返回转换后的操作"""
+        if revision > self.revision or revision < self.history_start:
+            raise StaleRevision()
+        op = normalize(op)
+        for concurrent in self.history[revision - self.history_start:]:
+            op, _ = transform(op, concurrent)
+        self.text = apply(self.text, op)
+
+        self.history.append(op)
+        self.revision += 1
+        overflow = len(self.history) - get_history_size()
+        if overflow > 0:
+            del self.history[:overflow]
+            self.history_start += overflow
+
+        now = time.monotonic()
+        if self.first_dirty_at is None:
+            self.first_dirty_at = now
+        self.last_edit_at = now
+        self.last_editor = user
+        return op
+
+    def state(self):
+        return {
+            'node_id': self.node_uid,
+            'field': self.field,
+            'revision': self.revision,
+            'text': self.text,
+        }
+
+
+def _load_document(project_id, node_uid, field):
+    values = MindMapNode.objects.filter(
+        project_id=project_id,
+        node_id=node_uid
+    ).values_list(field, 'is_system_default', 'creator_id').first()
+    if values is None:
+        return None
+    text, is_system_default, creator_id = values
+    return TextDocument(
+        project_id, node_uid, field, text or '',
+        editable=not is_system_default, creator_id=creator_id
+    )
+
+
+def persist_text(project_id, node_uid, field, text, user):
+    """将合并后的文本写回数据库并记录一条编辑日志；节点已删除时返回 False
+
+    按版本号条件只更新该字段，期间其他途径写入的字段不会被覆盖；版本号变化时重新读取后重试
+    """
+    while True:
+        node = MindMapNode.objects.filter(project_id=project_id, node_id=node_uid).first()
+        if node is None:
+            return False
+        old_state = node.get_state()
+        setattr(node, field, text)
+        if node.save_versioned(node.version, [field]):
+            NodeEditLog.record(node, user, 'update', old_state)
+            return True
+
+
+class TextHub:
+    """进程内的协同文档注册表"""
+
+    def __init__(self):
+        self.documents = {}
+        self._loading = {}
+
+    def get(self, node_uid, field, project_id=None):
+        document = self.documents.get((node_uid, field))
+        if document is not None and project_id is not None and document.project_id != str(project_id):
+            return None
+        return document
+
+    async def load(self, project_id, node_uid, field):
+        """取得（必要时从数据库加载）文档，登记订阅的连接前用于检查权限；节点不存在时返回 None"""
+        key = (node_uid, field)
+        document = self.documents.get(key)
+        if document is None:
+            # 同一文档并发打开时只加载一次
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = asyncio.ensure_future(
+                    database_sync_to_async(_load_document)(project_id, node_uid, field)
+                )
+                self._loading[key] = loading
+            try:
+                document = await loading
+            finally:
+                self._loading.pop(key, None)
+            if document is None:
+                return None
+        if document.project_id != str(project_id):
+            return None
+        return document
+
+    def subscribe(self, document, channel_name):
+        """登记订阅的连接，返回注册表中的文档（并发加载时以先登记的为准）"""
+        document = self.documents.setdefault((document.node_uid, document.field), document)
+        document.subscribers.add(channel_name)
+        return document
+
+    def submit(self, document, revision, op, user):
+        """应用客户端操作并安排写回，返回转换后的操作"""
+        op = document.apply_client_op(revision, op, user)
+        self._schedule_flush(document)
+        return op
+
+    def replace(self, document, new_text, user):
+        """整字段替换（来自 node_update 等非 OT 的修改），返回等价的操作"""
+        return self.submit(document, document.revision, replace_op(document.text, new_text), user)
+
+    def sync_external(self, document, new_text, user):
+        """文本已由其他途径（如批量操作）写入数据库，同步到文档，返回等价的操作"""
+        op = document.apply_client_op(document.revision, replace_op(document.text, new_text), user)
+        document.persisted_text = new_text
+        return op
+
+    def _schedule_flush(self, document):
+        if document.flush_task is None or document.flush_task.done():
+            document.flush_task = asyncio.ensure_future(self._flush_later(document))
+
+    async def _flush_later(self, document):
+        """停止输入 flush_delay 秒后写回，持续输入时最长 flush_max_delay 秒写回一次"""
+        while document.dirty:
+            now = time.monotonic()
+            due = min(
+                document.last_edit_at + get_flush_delay(),
+                document.first_dirty_at + get_flush_max_delay()
+            )
+            if due > now:
+                await asyncio.sleep(due - now)
+                continue
+            await self.flush(document)
+
+    async def flush(self, document):
+        """立即写回文档"""
+        if not document.dirty:
+            return
+        text = document.text
+        user = document.last_editor
+        document.first_dirty_at = None
+        try:
+            exists = await database_sync_to_async(persist_text)(
+                document.project_id, document.node_uid, document.field, text, user
+            )
+        except Exception as e:
+            logger.error(f"Failed to persist {document.field} of node {document.node_uid}: {str(e)}")
+            # 等待 flush_delay 后重试，数据库不可用时不会连续重试
+            now = time.monotonic()
+            if document.first_dirty_at is None:
+                document.first_dirty_at = now
+            document.last_edit_at = now
+            return
+        document.persisted_text = text
+        if not exists:
+            self.discard(document.node_uid)
+
+    async def flush_all(self):
+        for document in list(self.documents.values()):
+            await self.flush(document)
+
+    async def close(self, node_uid, field, channel_name):
+        """连接不再编辑该文档；没有连接订阅时写回并释放"""
+        document = self.get(node_uid, field)
+        if document is None:
+            return
+        document.subscribers.discard(channel_name)
+        if not document.subscribers:
+            await self.flush(document)
+            if not document.subscribers:
+                if document.flush_task is not None:
+                    document.flush_task.cancel()
+                self.documents.pop((node_uid, field), None)
+
+    async def close_channel(self, channel_name):
+        """连接断开时关闭它打开的全部文档"""
+        for node_uid, field in list(self.documents):
+            document = self.documents.get((node_uid, field))
+            if document is not None and channel_name in document.subscribers:
+                await self.close(node_uid, field, channel_name)
+
+    def discard(self, node_uid):
+        """节点被删除后丢弃它的文档"""
+        for field in OT_FIELDS:
+            document = self.documents.pop((node_uid, field), None)
+            if document is not None and document.flush_task is not None:
+                document.flush_task.cancel()
+
+
+text_hub = TextHub()
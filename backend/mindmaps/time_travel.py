@@ -0,0 +1,173 @@
+"""思维导图时间回溯
+
+重建案件整张思维导图在任意时刻的状态。默认以不晚于目标时刻的最近检查点为起点，
+按时间顺序回放之后的编辑日志；如果目标时刻离现在更近（或者还没有检查点），
+则从当前状态出发，倒序撤销目标时刻之后的日志。两种方式取需要处理日志较少的一种。
+"""
+import sys
+from collections import defaultdict
+
+from django.core.cache import cache
+
+from .models import NodeEditLog, MapCheckpoint
+from .edit_history import apply_log_entry, undo_log_entry
+from .edit_log_archive import iter_archived_records
+from .pagination import keyset_after
+
+# 解压后的检查点缓存时间（秒）
+CHECKPOINT_CACHE_TIMEOUT = 600
+
+LOG_FIELDS = ('node_uid', 'action', 'old_data', 'new_data', 'is_snapshot')
+
+
+def get_checkpoint_states(checkpoint):
+    """读取检查点的节点状态，解压结果按 (案件, 检查点) 缓存"""
+    cache_key = f'mindmap_checkpoint:{checkpoint.project_id}:{checkpoint.id}'
+    states = cache.get(cache_key)
+    if states is None:
+        states = checkpoint.get_states()
+        cache.set(cache_key, states, CHECKPOINT_CACHE_TIMEOUT)
+    return states
+
+
+def find_checkpoint(project, at):
+    """不晚于 at 的最近检查点"""
+    return MapCheckpoint.objects.filter(
+        project=project,
+        last_log_timestamp__lte=at
+    ).defer('data').order_by('-last_log_timestamp', '-last_log_id').first()
+
+
+def _record_to_entry(record):
+    return (
+        record['node_uid'], record['action'], record['old_data'],
+        record['new_data'], record.get('is_snapshot', False)
+    )
+
+
+def _forward_entries(project_id, after_key, at):
+    """按时间正序返回 (after_key, at] 区间内的日志，先归档后在线"""
+    archived = list(iter_archived_records(project_id, before=(at, sys.maxsize), after=after_key))
+    for _, record in reversed(archived):
+        yield _record_to_entry(record)
+
+    live = NodeEditLog.objects.filter(
+        project_id=project_id,
+        timestamp__lte=at
+    ).filter(keyset_after(after_key)).order_by('timestamp', 'id').values_list(*LOG_FIELDS)
+    yield from live.iterator(chunk_size=2000)
+
+
+def _backward_entries(project_id, at):
+    """按时间倒序返回晚于 at 的日志，先在线后归档"""
+    live = NodeEditLog.objects.filter(
+        project_id=project_id,
+        timestamp__gt=at
+    ).order_by('-timestamp', '-id').values_list(*LOG_FIELDS)
+    yield from live.iterator(chunk_size=2000)
+
+    for _, record in iter_archived_records(project_id, after=(at, sys.maxsize)):
+        yield _record_to_entry(record)
+
+
+def reconstruct_project_states(project, at):
+    """重建案件在 at 时刻的全部节点状态
+
+    Returns:
+        dict: {
+            'states': {node_uid: state},
+            'checkpoint_id': 作为起点的检查点ID（从当前状态倒推时为 None）,
+            'replayed_logs': 处理的日志条数,
+        }
+    """
+    checkpoint = find_checkpoint(project, at)
+    backward_count = NodeEditLog.objects.filter(project=project, timestamp__gt=at).count()
+
+    use_checkpoint = False
+    if checkpoint is not None:
+        forward_count = NodeEditLog.objects.filter(
+            project=project,
+            timestamp__lte=at
+        ).filter(keyset_after((checkpoint.last_log_timestamp, checkpoint.last_log_id))).count()
+        use_checkpoint = forward_count <= backward_count
+
+    replayed = 0
+    if use_checkpoint:
+        states = get_checkpoint_states(checkpoint)
+        after_key = (checkpoint.last_log_timestamp, checkpoint.last_log_id)
+        for node_uid, action, old_data, new_data, is_snapshot in _forward_entries(project.id, after_key, at):
+            replayed += 1
+            if not node_uid:
+                continue
+            state = apply_log_entry(states.get(node_uid), action, new_data, is_snapshot)
+            if state is None:
+                states.pop(node_uid, None)
+            else:
+                states[node_uid] = state
+    else:
+        states = MapCheckpoint.capture_states(project)
+        for node_uid, action, old_data, new_data, is_snapshot in _backward_entries(project.id, at):
+            replayed += 1
+            if not node_uid:
+                continue
+            state = undo_log_entry(states.get(node_uid), action, old_data)
+            if state is None:
+                states.pop(node_uid, None)
+            else:
+                states[node_uid] = state
+
+    return {
+        'states': states,
+        'checkpoint_id': checkpoint.id if use_checkpoint else None,
+        'replayed_logs': replayed,
+    }
+
+
+def _state_to_simple_mind_map(node_uid, state, children_map, states):
+    """将节点状态转换为 Simple Mind Map 格式（只读，不含权限和文件信息）"""
+    return {
+        'data': {
+            'text': (state.get('text') or '').strip(),
+            'richText': state.get('rich_text', False),
+            'expand': state.get('expand', True),
+            'uid': node_uid,
+            'icon': state.get('icon') or [],
+            'hyperlink': state.get('hyperlink') or '',
+            'hyperlinkTitle': state.get('hyperlink_title') or '',
+            'note': state.get('note') or '',
+            'tag': state.get('tags') or [],
+            'generalization': state.get('generalizations') or [],
+            'associativeLineTargets': state.get('associative_line_targets') or [],
+            'associativeLineText': state.get('associative_line_text') or {},
+            '_isRoot': not state.get('parent_node_uid'),
+        },
+        'children': [
+            _state_to_simple_mind_map(child_uid, states[child_uid], children_map, states)
+            for child_uid in children_map.get(node_uid, [])
+        ]
+    }
+
+
+def build_simple_mind_map(states, project_name):
+    """将节点状态组装为 Simple Mind Map 树，规则与 simple_mind_map_format 接口一致"""
+    children_map = defaultdict(list)
+    root_uids = []
+    for node_uid, state in states.items():
+        parent_uid = state.get('parent_node_uid')
+        if parent_uid and parent_uid in states:
+            children_map[parent_uid].append(node_uid)
+        else:
+            root_uids.append(node_uid)
+
+    roots = [_state_to_simple_mind_map(uid, states[uid], children_map, states) for uid in root_uids]
+    if len(roots) == 1:
+        return roots[0]
+    return {
+        'data': {
+            'text': project_name,
+            'uid': 'root',
+            'isRoot': True,
+            'expand': True
+        },
+        'children': roots
+    }
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from .views import MindMapNodeViewSet
+from .metrics import metrics_view
 
 # 简化的URL配置
 urlpatterns = [
@@ -12,12 +13,21 @@ urlpatterns = [
     path('api/projects/<int:project_pk>/nodes/tree/', MindMapNodeViewSet.as_view({'get': 'tree'})),
     path('api/projects/<int:project_pk>/nodes/simple-mind-map/', MindMapNodeViewSet.as_view({'get': 'simple_mind_map_format'})),
     path('api/projects/<int:project_pk>/nodes/logs/', MindMapNodeViewSet.as_view({'get': 'logs'})),
+    path('api/projects/<int:project_pk>/nodes/history/', MindMapNodeViewSet.as_view({'get': 'history'})),
+    path('api/projects/<int:project_pk>/nodes/time-travel/', MindMapNodeViewSet.as_view({'get': 'time_travel'})),
     path('api/projects/<int:project_pk>/nodes/stats/', MindMapNodeViewSet.as_view({'get': 'user_stats'})),
+    path('api/projects/<int:project_pk>/nodes/tags/', MindMapNodeViewSet.as_view({'get': 'tags'})),
+    path('api/projects/<int:project_pk>/nodes/by-tag/', MindMapNodeViewSet.as_view({'get': 'by_tag'})),
     
     # 新增的直接访问URL模式，匹配前端请求路径
     path('api/mindmaps/nodes/create/', MindMapNodeViewSet.as_view({'post': 'create_with_project_id'})),
     path('api/mindmaps/nodes/update/', MindMapNodeViewSet.as_view({'put': 'update_with_node_uid'})),
     path('api/mindmaps/nodes/<str:node_uid>/', MindMapNodeViewSet.as_view({'delete': 'delete_by_uid'})),
     path('api/mindmaps/nodes/move/', MindMapNodeViewSet.as_view({'put': 'move_node'})),
+    path('api/mindmaps/search/', MindMapNodeViewSet.as_view({'get': 'search'})),
+    path('api/mindmaps/entities/', MindMapNodeViewSet.as_view({'get': 'entities'})),
+    path('api/mindmaps/ws-stats/', MindMapNodeViewSet.as_view({'get': 'ws_stats'})),
+    path('api/mindmaps/request-profiles/', MindMapNodeViewSet.as_view({'get': 'request_profiles', 'delete': 'request_profiles'})),
+    path('metrics', metrics_view),
     # path('api/mindmaps/batch-update/', MindMapNodeViewSet.as_view({'post': 'batch_update'})),
 ]
@@ -2,15 +2,48 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from django.db import transaction
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 import json
-from .models import MindMapNode, NodeEditLog
+from .models import MindMapNode, NodeEditLog, NodeEntity
 from .serializers import (
     MindMapNodeSerializer, MindMapTreeSerializer,
-    NodeCreateSerializer, NodeUpdateSerializer, NodeEditLogSerializer
+    NodeCreateSerializer, NodeUpdateSerializer, NodeEditLogSerializer,
+    serialize_archived_logs
 )
+from .filters import NodeEditLogFilter
+from .pagination import decode_cursor, parse_page_size
+from .edit_log_archive import fetch_log_page
+from .edit_history import reconstruct_node_state
+from .time_travel import reconstruct_project_states, build_simple_mind_map
+from .outbox import get_stats as get_outbox_stats
+from . import profiling
+from .search import search_nodes
+from . import entities as entity_index
+from .tags import tag_facets, nodes_with_tag
 from projects.models import Project, ProjectMember
 
+# REST 更新接口可以修改的节点字段（text 未提供时保持不变）
+NODE_DATA_FIELDS = ['rich_text', 'expand', 'icon', 'hyperlink', 'hyperlink_title', 'note', 'tags']
+
+def _apply_node_data(node, node_data):
+    """将请求中的节点数据写到节点上，返回需要保存的字段"""
+    node.content = node_data.get('text', node.content)
+    fields = ['text']
+    for field in NODE_DATA_FIELDS:
+        if field in node_data:
+            setattr(node, field, node_data[field])
+            fields.append(field)
+    return fields
+
+def _parse_version(value):
+    """解析客户端提交的版本号，未提供时返回 None"""
+    if value is None or value == '':
+        return None
+    return int(value)
+
 class MindMapNodeViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     
@@ -56,7 +89,8 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
             raise PermissionError("你不是项目成员")
         
         # 保存节点，序列化器会自动设置project和creator
-        serializer.save()
+        node = serializer.save()
+        NodeEditLog.record(node, self.request.user, 'create')
     
     def perform_update(self, serializer):
         # 检查是否可以编辑此节点：只能编辑自己创建的节点
@@ -71,15 +105,7 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
             raise PermissionError("只能删除自己创建的且没有子节点的节点")
         
         # 记录删除日志
-        NodeEditLog.objects.create(
-            node=instance,
-            user=self.request.user,
-            action='delete',
-            old_data={
-                'content': instance.content,
-                'parent_id': instance.parent_node_uid if instance.parent_node_uid else None
-            }
-        )
+        NodeEditLog.record(instance, self.request.user, 'delete')
         instance.delete()
     
     @action(detail=False, methods=['get'])
@@ -171,12 +197,113 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        logs = NodeEditLog.objects.filter(
-            node__project=project
-        ).order_by('-timestamp')[:50]  # 最近50条日志
+        # 过滤条件：node(节点UID)、user(用户ID)、action、since/until(ISO时间)
+        logs = NodeEditLog.objects.filter(project=project).select_related('node', 'user')
+        log_filter = NodeEditLogFilter(request.query_params, queryset=logs)
+        if not log_filter.is_valid():
+            return Response(
+                {'error': '过滤条件无效', 'fields': log_filter.errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        serializer = NodeEditLogSerializer(logs, many=True)
-        return Response(serializer.data)
+        # 键集分页：cursor 为上一页返回的 next_cursor，在线日志读完后继续读取归档
+        before = None
+        cursor = request.query_params.get('cursor')
+        if cursor:
+            try:
+                before = decode_cursor(cursor)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = parse_page_size(request.query_params.get('page_size'))
+        
+        results, next_cursor = fetch_log_page(
+            log_filter.qs,
+            project.id,
+            page_size,
+            before=before,
+            serialize=lambda log: NodeEditLogSerializer(log).data,
+            record_filter=log_filter.matches_record,
+            serialize_records=serialize_archived_logs,
+            since=log_filter.form.cleaned_data.get('since'),
+            until=log_filter.form.cleaned_data.get('until')
+        )
+        return Response({
+            'results': results,
+            'next_cursor': next_cursor
+        })
+    
+    @action(detail=False, methods=['get'])
+    def history(self, request, project_pk=None):
+        """重建节点在指定时刻的状态"""
+        project = get_object_or_404(Project, id=project_pk)
+        
+        # 检查权限
+        try:
+            ProjectMember.objects.get(project=project, user=request.user)
+        except ProjectMember.DoesNotExist:
+            return Response(
+                {'error': '你不是项目成员'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        node_uid = request.query_params.get('node')
+        if not node_uid:
+            return Response(
+                {'error': 'node参数是必需的'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        at = timezone.now()
+        if request.query_params.get('at'):
+            at = parse_datetime(request.query_params['at'])
+            if at is None:
+                return Response(
+                    {'error': 'at参数应为ISO格式时间'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if timezone.is_naive(at):
+                at = timezone.make_aware(at)
+        
+        state, replayed = reconstruct_node_state(project.id, node_uid, at)
+        return Response({
+            'node_uid': node_uid,
+            'at': at,
+            'exists': state is not None,
+            'state': state,
+            'replayed_logs': replayed
+        })
+    
+    @action(detail=False, methods=['get'])
+    def time_travel(self, request, project_pk=None):
+        """重建整张思维导图在指定时刻的状态（simple-mind-map格式，只读）"""
+        project = get_object_or_404(Project, id=project_pk)
+        
+        # 检查权限
+        try:
+            ProjectMember.objects.get(project=project, user=request.user)
+        except ProjectMember.DoesNotExist:
+            return Response(
+                {'error': '你不是项目成员'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        at = parse_datetime(request.query_params.get('at', ''))
+        if at is None:
+            return Response(
+                {'error': 'at参数是必需的，格式为ISO时间'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if timezone.is_naive(at):
+            at = timezone.make_aware(at)
+        
+        result = reconstruct_project_states(project, at)
+        return Response({
+            'at': at,
+            'checkpoint_id': result['checkpoint_id'],
+            'replayed_logs': result['replayed_logs'],
+            'node_count': len(result['states']),
+            'map': build_simple_mind_map(result['states'], project.name)
+        })
     
     @action(detail=False, methods=['get'])
     def user_stats(self, request, project_pk=None):
@@ -268,15 +395,7 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
             node = created_nodes[0]
             
             # 记录创建日志
-            NodeEditLog.objects.create(
-                node=node,
-                user=request.user,
-                action='create',
-                new_data={
-                    'content': node.text,
-                    'parent_uid': node.parent_node_uid
-                }
-            )
+            NodeEditLog.record(node, request.user, 'create')
             
             serializer = MindMapNodeSerializer(node, context={'request': request})
             return Response({
@@ -347,15 +466,7 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
             )
             
             # 记录创建日志
-            NodeEditLog.objects.create(
-                node=node,
-                user=request.user,
-                action='create',
-                new_data={
-                    'content': node.text,
-                    'parent_uid': node.parent_node_uid
-                }
-            )
+            NodeEditLog.record(node, request.user, 'create')
             
             serializer = MindMapNodeSerializer(node, context={'request': request})
             return Response({
@@ -396,39 +507,34 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_403_FORBIDDEN
                 )
             
+            try:
+                version = _parse_version(request.data.get('version'))
+            except (TypeError, ValueError):
+                return Response(
+                    {'error': 'version必须是整数'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
             # 更新节点数据
             node_data = request.data.get('data', {})
-            old_data = {
-                'content': node.content,
-                'text': node.text
-            }
+            old_state = node.get_state()
+            fields = _apply_node_data(node, node_data)
             
-            node.content = node_data.get('text', node.content)
-            # 更新其他字段
-            if 'rich_text' in node_data:
-                node.rich_text = node_data['rich_text']
-            if 'expand' in node_data:
-                node.expand = node_data['expand']
-            if 'icon' in node_data:
-                node.icon = node_data['icon']
-            if 'hyperlink' in node_data:
-                node.hyperlink = node_data['hyperlink']
-            if 'hyperlink_title' in node_data:
-                node.hyperlink_title = node_data['hyperlink_title']
-            if 'note' in node_data:
-                node.note = node_data['note']
-            if 'tags' in node_data:
-                node.tags = node_data['tags']
-            node.save()
+            # 按版本号条件更新：未提供版本号时以本次读取的版本为准，避免覆盖读写之间的并发修改
+            if not node.save_versioned(node.version if version is None else version, fields):
+                current = MindMapNode.objects.filter(project=project, node_id=node_uid).first()
+                if current is None:
+                    return Response(
+                        {'error': '节点已被删除'}, 
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                return Response({
+                    'error': '节点已被他人修改',
+                    'node': MindMapNodeSerializer(current, context={'request': request}).data
+                }, status=status.HTTP_409_CONFLICT)
             
-            # 记录更新日志
-            NodeEditLog.objects.create(
-                node=node,
-                user=request.user,
-                action='update',
-                old_data=old_data,
-                new_data=node_data
-            )
+            # 记录更新日志（只记录变化的字段）
+            NodeEditLog.record(node, request.user, 'update', old_state)
             
             serializer = MindMapNodeSerializer(node, context={'request': request})
             return Response({
@@ -464,6 +570,7 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_403_FORBIDDEN
                 )
             
+            NodeEditLog.record(node, request.user, 'delete')
             node.delete()
             
             return Response({
@@ -517,23 +624,13 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
                     )
             
             # 更新节点的父节点
-            old_parent_uid = node.parent_node_uid
+            old_state = node.get_state()
             node.parent_node_uid = new_parent_uid
             node.is_root = new_parent_uid is None
             node.save()
             
             # 记录移动日志
-            NodeEditLog.objects.create(
-                node=node,
-                user=request.user,
-                action='move',
-                old_data={
-                    'old_parent_id': old_parent_uid
-                },
-                new_data={
-                    'new_parent_id': new_parent_uid
-                }
-            )
+            NodeEditLog.record(node, request.user, 'move', old_state)
             
             serializer = MindMapNodeSerializer(node, context={'request': request})
             return Response({
@@ -576,74 +673,86 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_403_FORBIDDEN
                 )
             
-            results = []
-            for change in changes:
+            if not isinstance(changes, list):
+                return Response(
+                    {'error': 'changes必须是列表'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            
+            # 写入前校验所有修改的格式和版本号，有错误时整批不执行
+            versions = []
+            for index, change in enumerate(changes):
+                if not isinstance(change, dict):
+                    return Response(
+                        {'error': f'第{index + 1}项修改格式错误', 'index': index}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
                 try:
+                    versions.append(_parse_version(change.get('version')))
+                except (TypeError, ValueError):
+                    return Response(
+                        {'error': f'第{index + 1}项修改的version必须是整数', 'index': index}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+            
+            results = []
+            # 整批在一个事务中写入，意外错误时全部回滚；单项的权限和版本冲突只影响该项
+            with transaction.atomic():
+                for change, version in zip(changes, versions):
                     action = change.get('action')
                     node_uid = change.get('node_uid')
-                    node_data = change.get('node_data')
+                    node_data = change.get('node_data') or {}
                     
-                    if action == 'update' and node_uid:
-                        node = MindMapNode.objects.get(
+                    if action != 'update' or not node_uid:
+                        results.append({
+                            'node_uid': node_uid,
+                            'success': False,
+                            'error': '不支持的操作或缺少必要参数'
+                        })
+                        continue
+                    
+                    node = MindMapNode.objects.filter(project=project, node_id=node_uid).first()
+                    if node is None:
+                        results.append({
+                            'node_uid': node_uid,
+                            'success': False,
+                            'error': '节点不存在'
+                        })
+                        continue
+                    
+                    if not node.can_be_edited_by(request.user):
+                        results.append({
+                            'node_uid': node_uid,
+                            'success': False,
+                            'error': '没有编辑权限'
+                        })
+                        continue
+                    
+                    old_state = node.get_state()
+                    fields = _apply_node_data(node, node_data)
+                    
+                    if not node.save_versioned(node.version if version is None else version, fields):
+                        # 版本冲突时返回节点当前状态，客户端据此合并后重试
+                        current = MindMapNode.objects.filter(
                             project=project,
                             node_id=node_uid
-                        )
-                        
-                        if node.can_be_edited_by(request.user):
-                            old_data = {
-                                'content': node.content,
-                                'text': node.text
-                            }
-                            
-                            node.content = node_data.get('text', node.content)
-                            # 更新其他字段
-                            if 'rich_text' in node_data:
-                                node.rich_text = node_data['rich_text']
-                            if 'expand' in node_data:
-                                node.expand = node_data['expand']
-                            if 'icon' in node_data:
-                                node.icon = node_data['icon']
-                            if 'hyperlink' in node_data:
-                                node.hyperlink = node_data['hyperlink']
-                            if 'hyperlink_title' in node_data:
-                                node.hyperlink_title = node_data['hyperlink_title']
-                            if 'note' in node_data:
-                                node.note = node_data['note']
-                            if 'tags' in node_data:
-                                node.tags = node_data['tags']
-                            node.save()
-                            
-                            # 记录日志
-                            NodeEditLog.objects.create(
-                                node=node,
-                                user=request.user,
-                                action='update',
-                                old_data=old_data,
-                                new_data=node_data
-                            )
-                            
-                            results.append({
-                                'node_uid': node_uid,
-                                'success': True
-                            })
-                        else:
-                            results.append({
-                                'node_uid': node_uid,
-                                'success': False,
-                                'error': '没有编辑权限'
-                            })
-                    else:
+                        ).first()
                         results.append({
                             'node_uid': node_uid,
                             'success': False,
-                            'error': '不支持的操作或缺少必要参数'
+                            'conflict': True,
+                            'error': '节点已被他人修改' if current else '节点已被删除',
+                            'node': MindMapNodeSerializer(current, context={'request': request}).data if current else None
                         })
-                        
-                except Exception as e:
+                        continue
+                    
+                    # 记录日志
+                    NodeEditLog.record(node, request.user, 'update', old_state)
+                    
                     results.append({
                         'node_uid': node_uid,
-                        'success': False,
-                        'error': str(e)
+                        'success': True,
+                        'version': node.version
                     })
             
             return Response({
@@ -656,3 +765,131 @@ class MindMapNodeViewSet(viewsets.ModelViewSet):
                 {'error': f'批量更新失败: {str(e)}'}, 
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
+    
+    @action(detail=False, methods=['get'])
+    def tags(self, request, project_pk=None):
+        """案件中的标签及各标签的节点数"""
+        project = get_object_or_404(Project, id=project_pk)
+        if not ProjectMember.objects.filter(project=project, user=request.user).exists():
+            return Response(
+                {'error': '你不是项目成员'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return Response({
+            'tags': [{'tag': item['text'], 'count': item['count']} for item in tag_facets(project.id)]
+        })
+    
+    @action(detail=False, methods=['get'])
+    def by_tag(self, request, project_pk=None):
+        """案件中带有指定标签（查询参数 tag）的节点UID"""
+        project = get_object_or_404(Project, id=project_pk)
+        if not ProjectMember.objects.filter(project=project, user=request.user).exists():
+            return Response(
+                {'error': '你不是项目成员'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        tag = (request.query_params.get('tag') or '').strip()
+        if not tag:
+            return Response({'error': '请指定标签'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'tag': tag, 'node_ids': nodes_with_tag(project.id, tag)})
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """在用户参与的案件中全文检索节点文本、备注、标签、链接标题和文件名，按相关度排序
+        
+        查询参数：q 检索词，project 限定案件ID（可选），limit 返回条数（默认20，最多100）
+        """
+        query = (request.query_params.get('q') or '').strip()
+        if not query:
+            return Response({'error': '请输入检索词'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            project_id = request.query_params.get('project')
+            project_id = int(project_id) if project_id else None
+            limit = min(100, max(1, int(request.query_params.get('limit', 20))))
+        except ValueError:
+            return Response({'error': 'project和limit必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        hits = search_nodes(request.user, query, project_id=project_id, limit=limit)
+        return Response({
+            'query': query,
+            'results': [
+                {
+                    'node_id': node.node_id,
+                    'project_id': node.project_id,
+                    'project_name': node.project.name,
+                    'text': node.text,
+                    'note': node.note[:200],
+                    'tags': node.tags,
+                    'hyperlink_title': node.hyperlink_title,
+                    'updated_at': node.updated_at,
+                    'score': round(score, 4),
+                }
+                for node, score in hits
+            ]
+        })
+    
+    @action(detail=False, methods=['get'])
+    def entities(self, request):
+        """查找提及某个手机号、身份证号、银行卡号或IP地址的案件和节点
+        
+        查询参数：value 实体值（号码可带空格或连字符），kind 限定类型（可选）。
+        普通用户只返回参与的案件，管理员返回全部案件。
+        """
+        value = (request.query_params.get('value') or '').strip()
+        if not value:
+            return Response({'error': '请输入要查找的号码'}, status=status.HTTP_400_BAD_REQUEST)
+        kind = request.query_params.get('kind')
+        if kind and kind not in dict(NodeEntity.KIND_CHOICES):
+            return Response({'error': '无效的实体类型'}, status=status.HTTP_400_BAD_REQUEST)
+        
+        project_ids = None
+        if not (request.user.is_staff or request.user.is_superuser):
+            project_ids = ProjectMember.objects.filter(user=request.user).values('project_id')
+        
+        projects = {}
+        for entity in entity_index.lookup(value, kind=kind, project_ids=project_ids):
+            project = projects.get(entity.project_id)
+            if project is None:
+                project = projects[entity.project_id] = {
+                    'project_id': entity.project_id,
+                    'project_name': entity.project.name,
+                    'case_number': entity.project.case_number,
+                    'nodes': [],
+                }
+            project['nodes'].append({
+                'node_id': entity.node.node_id,
+                'kind': entity.kind,
+                'text': entity.node.text,
+            })
+        return Response({
+            'value': entity_index.normalize_value(value),
+            'project_count': len(projects),
+            'projects': list(projects.values()),
+        })
+    
+    @action(detail=False, methods=['get'])
+    def ws_stats(self, request):
+        """本进程 WebSocket 发送队列的深度和丢弃、合并、快照次数 - 仅管理员可访问"""
+        if not (request.user.is_staff or request.user.is_superuser):
+            return Response({'error': '权限不足'}, status=status.HTTP_403_FORBIDDEN)
+        return Response(get_outbox_stats())
+    
+    @action(detail=False, methods=['get', 'delete'])
+    def request_profiles(self, request):
+        """ProfilerMiddleware 采样的请求：最近的样本和按视图汇总 - 仅管理员可访问
+        
+        查询参数 limit 限制返回的样本数（默认50），DELETE 清空缓冲区
+        """
+        if not (request.user.is_staff or request.user.is_superuser):
+            return Response({'error': '权限不足'}, status=status.HTTP_403_FORBIDDEN)
+        if request.method == 'DELETE':
+            profiling.clear()
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        try:
+            limit = max(1, int(request.query_params.get('limit', 50)))
+        except ValueError:
+            return Response({'error': 'limit必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'summary': profiling.get_summary(),
+            'samples': profiling.get_samples(limit),
+        })
@@ -0,0 +1,291 @@
+"""节点编辑的延迟写回缓冲
+
+输入时客户端会连续发送 node_update。缓冲区按节点合并这些修改：广播立即进行，
+数据库写入在停止修改 MINDMAP_NODE_WRITE_DELAY 秒后进行（持续修改时最长
+MINDMAP_NODE_WRITE_MAX_DELAY 秒写一次），每次写回只记录一条合并后的编辑日志。
+
+连接断开、节点被删除或进程退出（ASGI lifespan.shutdown）时立即写回。
+写回时数据库出错（连接断开、数据库被锁等）保留缓冲的修改，稍后重试。
+缓冲区在进程内存中，其他进程和 REST 接口最多读到延迟窗口之前的数据。
+
+版本号：每次接受的修改使内存中的版本号加一，客户端带上所基于的版本号时，
+若其后有其他连接修改过该节点则拒绝并返回当前状态。写回按加载时的版本号条件更新，
+期间数据库被其他途径修改时：缓冲的字段未被改动则在最新版本上重试，
+否则放弃缓冲的修改并向房间广播数据库中的状态。
+"""
+import asyncio
+import copy
+import logging
+import time
+from collections import deque
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import MindMapNode, NodeEditLog
+from .rooms import broadcast_to_room
+
+logger = logging.getLogger(__name__)
+
+# node_update 允许修改的字段，其余字段忽略
+WRITABLE_FIELDS = set(MindMapNode.STATE_FIELDS) | {'sort_order'}
+
+
+def get_write_delay():
+    return getattr(settings, 'MINDMAP_NODE_WRITE_DELAY', 1)
+
+
+def get_write_max_delay():
+    return getattr(settings, 'MINDMAP_NODE_WRITE_MAX_DELAY', 5)
+
+
+# 每个节点记录最近多少次修改的来源连接，更早的版本号一律视为过期
+WRITER_HISTORY_SIZE = 256
+
+# 写回结果
+WRITTEN = 'written'
+REBASED = 'rebased'
+CONFLICT = 'conflict'
+DELETED = 'deleted'
+
+
+class VersionConflict(Exception):
+    """客户端提交的版本号已过期，node 为节点当前状态"""
+
+    def __init__(self, node):
+        super().__init__('节点已被他人修改')
+        self.node = node
+
+
+class PendingWrite:
+    """一个节点尚未写回的修改"""
+
+    def __init__(self, node):
+        self.node = node
+        # 上一次写回时（或加载时）的状态和版本号，用于计算编辑日志的差异和条件更新
+        self.base_state = node.get_state()
+        self.base_version = node.version
+        # (版本号, 连接通道名)，判断客户端所基于的版本之后是否有其他连接的修改
+        self.writers = deque(maxlen=WRITER_HISTORY_SIZE)
+        self.fields = set()
+        self.user = None
+        self.channels = set()
+        self.first_change_at = None
+        self.last_change_at = None
+        self.task = None
+        self.lock = asyncio.Lock()
+
+
+def _load_node(project_id, node_uid):
+    return MindMapNode.objects.select_related('creator').filter(
+        project_id=project_id,
+        node_id=node_uid
+    ).first()
+
+
+def _persist(node, fields, user, base_state, base_version):
+    """按版本号条件写回节点修改并记录一条编辑日志
+
+    Returns:
+        tuple: (结果, 节点)；写回成功（WRITTEN，或在最新状态上重试后成功的 REBASED）时为写回的节点，
+               CONFLICT 时为数据库中的节点，DELETED 时为 None
+    """
+    result = WRITTEN
+    while True:
+        action = 'move' if base_state['parent_node_uid'] != node.parent_node_uid else 'update'
+        # 数据库错误（如连接断开、数据库被锁）向上抛出，由调用方恢复待写状态后重试；
+        # 只有条件更新未命中且节点已不存在时才视为删除
+        if node.save_versioned(base_version, fields, new_version=node.version):
+            NodeEditLog.record(node, user, action, base_state)
+            return result, node
+
+        current = _load_node(node.project_id, node.node_id)
+        if current is None:
+            return DELETED, None
+        if any(field in base_state and getattr(current, field) != base_state[field] for field in fields):
+            return CONFLICT, current
+        # 缓冲的字段未被其他途径修改（例如只有协同文本被写回），在数据库的最新状态上重试
+        for field in MindMapNode.STATE_FIELDS:
+            if field not in fields:
+                setattr(node, field, copy.deepcopy(getattr(current, field)))
+        base_state = current.get_state()
+        base_version = current.version
+        node.version = max(node.version, current.version + 1)
+        result = REBASED
+
+
+class NodeWriteBuffer:
+    """进程内的节点写回缓冲区"""
+
+    def __init__(self):
+        self.pending = {}
+        self._loading = {}
+
+    async def update(self, project_id, node_uid, user, channel_name, updates, version=None):
+        """合并一次节点修改并安排写回
+
+        Args:
+            version: 客户端修改所基于的版本号，不提供时不检查
+
+        Returns:
+            MindMapNode: 应用修改后的节点（用于广播）；节点不存在或无权限修改时返回 None
+
+        Raises:
+            VersionConflict: 该版本之后节点被其他连接修改过
+        """
+        entry = self.pending.get(node_uid)
+        if entry is None:
+            # 同一节点并发的第一次修改只加载一次
+            loading = self._loading.get(node_uid)
+            if loading is None:
+                loading = asyncio.ensure_future(database_sync_to_async(_load_node)(project_id, node_uid))
+                self._loading[node_uid] = loading
+            try:
+                node = await loading
+            finally:
+                self._loading.pop(node_uid, None)
+            if node is None:
+                return None
+            entry = self.pending.setdefault(node_uid, PendingWrite(node))
+
+        node = entry.node
+        if str(node.project_id) != str(project_id):
+            return None
+        # 只能修改自己创建的节点
+        if node.creator_id != user.id:
+            return None
+        if version is not None and self._is_stale(entry, int(version), channel_name):
+            raise VersionConflict(node)
+
+        fields = [field for field in updates if field in WRITABLE_FIELDS]
+        for field in fields:
+            setattr(node, field, updates[field])
+            entry.fields.add(field)
+        if fields:
+            node.version += 1
+            entry.writers.append((node.version, channel_name))
+
+        now = time.monotonic()
+        if entry.first_change_at is None:
+            entry.first_change_at = now
+        entry.last_change_at = now
+        entry.user = user
+        entry.channels.add(channel_name)
+        if entry.task is None or entry.task.done():
+            entry.task = asyncio.ensure_future(self._flush_later(node_uid, entry))
+        return node
+
+    @staticmethod
+    def _is_stale(entry, version, channel_name):
+        """客户端所基于的版本之后是否有其他连接的修改；自己连续的修改不算冲突"""
+        current = entry.node.version
+        if version == current:
+            return False
+        if version > current or not entry.writers or version < entry.writers[0][0] - 1:
+            return True
+        return any(
+            writer != channel_name
+            for writer_version, writer in entry.writers
+            if writer_version > version
+        )
+
+    async def _flush_later(self, node_uid, entry):
+        while entry.fields:
+            now = time.monotonic()
+            due = min(
+                entry.last_change_at + get_write_delay(),
+                entry.first_change_at + get_write_max_delay()
+            )
+            if due > now:
+                await asyncio.sleep(due - now)
+                continue
+            await self._flush_entry(node_uid, entry)
+        # 没有可写字段的修改不需要继续缓存节点
+        if not entry.fields and not entry.lock.locked() and self.pending.get(node_uid) is entry:
+            del self.pending[node_uid]
+
+    async def _flush_entry(self, node_uid, entry):
+        async with entry.lock:
+            if not entry.fields:
+                return
+            # 写回的是此刻的副本，写库期间新的修改继续作用在缓冲的节点上
+            snapshot = copy.copy(entry.node)
+            state = entry.node.get_state()
+            for field, value in state.items():
+                setattr(snapshot, field, value)
+            fields, entry.fields = entry.fields, set()
+            base_state, entry.base_state = entry.base_state, state
+            base_version, entry.base_version = entry.base_version, snapshot.version
+            entry.first_change_at = None
+
+            try:
+                result, node = await database_sync_to_async(_persist)(
+                    snapshot, fields, entry.user, base_state, base_version
+                )
+            except Exception as e:
+                logger.error(f"Failed to write back node {node_uid}: {str(e)}")
+                # 写回失败时恢复待写状态，间隔 MINDMAP_NODE_WRITE_DELAY 秒后重试
+                entry.fields |= fields
+                entry.base_state = base_state
+                entry.base_version = base_version
+                now = time.monotonic()
+                entry.first_change_at = entry.first_change_at or now
+                entry.last_change_at = now
+                return
+
+            if result == REBASED:
+                # 同步其他途径写入的字段和版本号，此前的版本号对所有连接都已过期
+                for field in MindMapNode.STATE_FIELDS:
+                    if field not in fields and field not in entry.fields:
+                        setattr(entry.node, field, copy.deepcopy(getattr(node, field)))
+                entry.base_state = node.get_state()
+                entry.base_version = node.version
+                entry.node.version = max(entry.node.version, node.version + (1 if entry.fields else 0))
+                entry.writers.append((entry.node.version, None))
+            elif result == CONFLICT:
+                # 缓冲的字段已被其他途径修改，放弃缓冲的修改，让房间内的客户端回到数据库中的状态
+                logger.warning(f"Discarded buffered edits of node {node_uid}: modified concurrently")
+                entry.fields = set()
+                await self._broadcast_current(node)
+
+            if result in (CONFLICT, DELETED) or not entry.fields:
+                if self.pending.get(node_uid) is entry:
+                    del self.pending[node_uid]
+                if entry.task is not None and entry.task is not asyncio.current_task():
+                    entry.task.cancel()
+
+    async def _broadcast_current(self, node):
+        from .consumers import serialize_node
+
+        await broadcast_to_room(node.project_id, {
+            'type': 'node_updated',
+            'node': serialize_node(node)
+        })
+
+    async def flush(self, node_uids):
+        """立即写回指定节点的缓冲修改"""
+        for node_uid in list(node_uids):
+            entry = self.pending.get(node_uid)
+            if entry is not None:
+                await self._flush_entry(node_uid, entry)
+
+    async def flush_channel(self, channel_name):
+        """连接断开时写回它参与修改的节点"""
+        await self.flush([
+            node_uid for node_uid, entry in list(self.pending.items())
+            if channel_name in entry.channels
+        ])
+
+    async def flush_all(self):
+        await self.flush(list(self.pending))
+
+
+node_write_buffer = NodeWriteBuffer()
+
+
+async def flush_pending_edits():
+    """写回进程内所有缓冲的编辑，进程退出前调用"""
+    from .text_ot import text_hub
+
+    await node_write_buffer.flush_all()
+    await text_hub.flush_all()
@@ -5,6 +5,8 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 from django.shortcuts import get_object_or_404
 from .models import Project, ProjectMember, CaseAttachment
+from mindmaps.rooms import notify_member_permission_changed
+from mindmaps.presence import presence_counts
 from .serializers import (
     ProjectSerializer, ProjectCreateSerializer, 
     ProjectMemberSerializer, ProjectMemberInviteSerializer,
@@ -83,6 +85,24 @@ class ProjectViewSet(viewsets.ModelViewSet):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    @action(detail=False, methods=['get'])
+    def presence(self, request):
+        """批量获取案件协作房间的在线人数，用于案件列表
+        
+        ?ids=1,2,3 只统计指定案件，默认统计用户参与的全部案件
+        """
+        project_ids = self.get_queryset().order_by().values_list('id', flat=True)
+        ids = request.query_params.get('ids')
+        if ids:
+            try:
+                requested = [int(project_id) for project_id in ids.split(',') if project_id]
+            except ValueError:
+                return Response({'error': '案件ID格式错误'}, status=status.HTTP_400_BAD_REQUEST)
+            project_ids = project_ids.filter(id__in=requested)
+        
+        counts = presence_counts(project_ids)
+        return Response({str(project_id): count for project_id, count in counts.items()})
+    
     @action(detail=True, methods=['get'])
     def members(self, request, pk=None):
         """获取项目成员列表"""
@@ -131,6 +151,8 @@ class ProjectViewSet(viewsets.ModelViewSet):
             user_to_remove = User.objects.get(username=username)
             member_to_remove = ProjectMember.objects.get(project=project, user=user_to_remove)
             member_to_remove.delete()
+            # 让该成员已打开的思维导图连接立即失效
+            notify_member_permission_changed(project.id, user_to_remove.id, None)
             return Response({'message': '成员移除成功'})
         except (User.DoesNotExist, ProjectMember.DoesNotExist):
             return Response(
@@ -180,6 +202,8 @@ class ProjectViewSet(viewsets.ModelViewSet):
             member = ProjectMember.objects.get(project=project, user=user)
             member.permission = permission
             member.save()
+            # 刷新该成员思维导图连接中缓存的权限
+            notify_member_permission_changed(project.id, user.id, permission)
             return Response(ProjectMemberSerializer(member).data)
         except (User.DoesNotExist, ProjectMember.DoesNotExist):
             return Response(
@@ -19,18 +19,35 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 
 # Third-party imports
+import functools
 import json
 import jwt
 import datetime
+import time
 
 # Local imports
 from .serializers import UserSerializer, UserCreateSerializer
 from .models import LoginAttempt
 from projects.models import ProjectMember
 from mindmaps.models import MindMapNode
+from mindmaps.metrics import FACE_LOGIN_STAGE
 
 CustomUser = get_user_model()
 
+
+def face_login_stage(stage):
+    """记录人脸登录步骤的耗时，响应状态码小于400记为成功"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            started = time.perf_counter()
+            response = func(self, request, *args, **kwargs)
+            result = 'success' if response.status_code < 400 else 'failed'
+            FACE_LOGIN_STAGE.observe(time.perf_counter() - started, stage, result)
+            return response
+        return wrapper
+    return decorator
+
 @ensure_csrf_cookie
 @require_http_methods(["GET"])
 def get_csrf_token(request):
@@ -96,6 +113,7 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
     
     @action(detail=False, methods=['post'], permission_classes=[AllowAny])
+    @face_login_stage('password')
     def login(self, request):
         """用户登录 - 第一步：验证账号密码"""
         police_number = request.data.get('police_number') or request.data.get('username')
@@ -197,6 +215,7 @@ class UserViewSet(viewsets.ModelViewSet):
         })
     
     @action(detail=False, methods=['post'], permission_classes=[AllowAny])
+    @face_login_stage('face_verify')
     def face_verify(self, request):
         """用户登录 - 第二步：前端人脸识别验证"""
         session_token = request.data.get('session_token')
@@ -216,6 +235,13 @@ class UserViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
+        issued_at = getattr(self, '_face_session_issued_at', None)
+        if issued_at:
+            FACE_LOGIN_STAGE.observe(
+                max(0.0, time.time() - issued_at), 'client_face_match',
+                'success' if verification_result.get('success') else 'failed'
+            )
+        
         # 检查前端验证结果
         if verification_result.get('success'):
             # 人脸识别成功，完成登录
@@ -432,6 +458,7 @@ class UserViewSet(viewsets.ModelViewSet):
         })
 
     @action(detail=False, methods=['post'], permission_classes=[AllowAny])
+    @face_login_stage('encodings')
     def get_face_encodings(self, request):
         """获取用户人脸特征数据供前端进行比对"""
         police_number = request.data.get('police_number')
@@ -482,7 +509,8 @@ class UserViewSet(viewsets.ModelViewSet):
             'user_id': user.id,
             'police_number': user.police_number,
             'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=5),  # 5分钟过期
-            'purpose': 'face_verification'
+            'purpose': 'face_verification',
+            'issued_at': time.time()
         }
         
         return jwt.encode(payload, settings.SECRET_KEY, algorithm='HS256')
@@ -495,6 +523,8 @@ class UserViewSet(viewsets.ModelViewSet):
                 return None
                 
             user = CustomUser.objects.get(id=payload['user_id'])
+            # 密码验证通过到提交人脸比对结果的间隔，即前端采集和比对人脸的耗时
+            self._face_session_issued_at = payload.get('issued_at')
             return user
         except (jwt.ExpiredSignatureError, jwt.InvalidTokenError, CustomUser.DoesNotExist):
             return None
@@ -177,6 +177,8 @@ export const projectAPI = {
     api.delete(`/projects/${id}/`),
   getMembers: (id: number) =>
     api.get(`/projects/${id}/members/`),
+  getPresence: (ids?: number[]) =>
+    api.get('/projects/presence/', { params: ids ? { ids: ids.join(',') } : {} }),
   inviteMember: (id: number, data: { username: string; permission: string }) =>
     api.post(`/projects/${id}/invite_member/`, data),
   removeMember: (id: number, data: { username: string }) =>
@@ -258,8 +260,16 @@ export const mindmapAPI = {
     api.get(`/projects/${projectId}/nodes/tree/`),
   getSimpleMindMapFormat: (projectId: number) =>
     api.get(`/projects/${projectId}/nodes/simple-mind-map/`),
-  getLogs: (projectId: number) =>
-    api.get(`/projects/${projectId}/nodes/logs/`),
+  getLogs: (projectId: number, params?: {
+    cursor?: string;
+    page_size?: number;
+    node?: string;
+    user?: number;
+    action?: string;
+    since?: string;
+    until?: string;
+  }) =>
+    api.get(`/projects/${projectId}/nodes/logs/`, { params }),
   getUserStats: (projectId: number) =>
     api.get(`/projects/${projectId}/nodes/stats/`),
 
@@ -311,6 +321,7 @@ export const mindmapAPI = {
     node_uid: string;
     projectId: number;
     data: any;
+    version?: number;  // 修改所基于的版本号，已被他人修改时返回 409 和节点当前状态
   }) => {
     await initializeCSRF()
     const csrfToken = getCSRFToken()
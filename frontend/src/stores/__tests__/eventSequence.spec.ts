@@ -0,0 +1,125 @@
+import { describe, it, expect, vi, beforeEach, afterEach } from 'vitest'
+
+import { EventSequencer, type SequencedEvent } from '../eventSequence'
+
+describe('EventSequencer', () => {
+  let applied: number[]
+  let replays: number[]
+  let resyncs: number
+  let sequencer: EventSequencer
+
+  const event = (seq: number): SequencedEvent => ({ type: 'node_updated', seq })
+
+  beforeEach(() => {
+    vi.useFakeTimers()
+    applied = []
+    replays = []
+    resyncs = 0
+    sequencer = new EventSequencer(
+      (data) => applied.push(data.seq ?? -1),
+      (lastSeq) => replays.push(lastSeq),
+      () => resyncs++,
+      1000
+    )
+    sequencer.handle({ type: 'sync', seq: 9 })
+    applied = []
+  })
+
+  afterEach(() => {
+    vi.useRealTimers()
+  })
+
+  it('applies events that arrive out of order in sequence', () => {
+    sequencer.handle(event(11))
+    expect(applied).toEqual([])
+    sequencer.handle(event(10))
+    expect(applied).toEqual([10, 11])
+    expect(sequencer.lastSeq).toBe(11)
+
+    vi.advanceTimersByTime(2000)
+    expect(replays).toEqual([])
+  })
+
+  it('drops only events that were already applied', () => {
+    sequencer.handle(event(10))
+    sequencer.handle(event(10))
+    sequencer.handle(event(12))
+    sequencer.handle(event(12))
+    sequencer.handle(event(11))
+    expect(applied).toEqual([10, 11, 12])
+  })
+
+  it('requests a replay when a gap is not filled in time', () => {
+    sequencer.handle(event(12))
+    vi.advanceTimersByTime(999)
+    expect(replays).toEqual([])
+    vi.advanceTimersByTime(1)
+    expect(replays).toEqual([9])
+
+    // 补发的事件按序应用，之前暂存的事件随后应用
+    sequencer.handle(event(10))
+    sequencer.handle(event(11))
+    sequencer.handle(event(12))
+    expect(applied).toEqual([10, 11, 12])
+  })
+
+  it('retries the replay with backoff and then requests a full resync', () => {
+    sequencer.handle(event(12))
+    vi.advanceTimersByTime(1000)
+    expect(replays).toEqual([9])
+    vi.advanceTimersByTime(1999)
+    expect(replays).toEqual([9])
+    vi.advanceTimersByTime(1)
+    expect(replays).toEqual([9, 9])
+    vi.advanceTimersByTime(4000)
+    expect(replays).toEqual([9, 9, 9])
+    expect(resyncs).toBe(0)
+
+    vi.advanceTimersByTime(8000)
+    expect(replays).toEqual([9, 9, 9])
+    expect(resyncs).toBe(1)
+
+    // 快照补齐后不再重试
+    sequencer.handle({ type: 'snapshot', seq: 12, nodes: [] })
+    vi.advanceTimersByTime(60000)
+    expect(resyncs).toBe(1)
+    expect(replays).toEqual([9, 9, 9])
+  })
+
+  it('restarts the retry count when the gap makes progress', () => {
+    sequencer.handle(event(12))
+    vi.advanceTimersByTime(3000)
+    expect(replays).toEqual([9, 9])
+
+    // 补发只补齐了一部分，剩下的缺口从头计数
+    sequencer.handle(event(10))
+    sequencer.handle(event(14))
+    vi.advanceTimersByTime(4000)
+    expect(replays).toEqual([9, 9, 10])
+    vi.advanceTimersByTime(1000)
+    expect(replays).toEqual([9, 9, 10])
+    vi.advanceTimersByTime(1000)
+    expect(replays).toEqual([9, 9, 10, 10])
+    expect(resyncs).toBe(0)
+  })
+
+  it('starts a new gap with the initial delay', () => {
+    sequencer.handle(event(11))
+    vi.advanceTimersByTime(3000)
+    expect(replays).toEqual([9, 9])
+    sequencer.handle(event(10))
+    expect(applied).toEqual([10, 11])
+
+    sequencer.handle(event(13))
+    vi.advanceTimersByTime(1000)
+    expect(replays).toEqual([9, 9, 11])
+  })
+
+  it('resumes from a snapshot and discards older pending events', () => {
+    sequencer.handle(event(12))
+    sequencer.handle(event(15))
+    sequencer.handle({ type: 'snapshot', seq: 14, nodes: [] })
+    expect(applied).toEqual([14, 15])
+    expect(sequencer.lastSeq).toBe(15)
+  })
+})
@@ -0,0 +1,129 @@
+// 房间事件按序号应用：多进程部署和通道层转发时事件可能乱序到达，
+// 序号不连续的事件先暂存，缺口补齐后按序应用；缺口超时仍未补齐时请求服务端补发，
+// 补发请求（或其回复）丢失时按指数退避重试，多次重试仍未补齐则请求完整快照
+
+export interface SequencedEvent {
+  type: string
+  seq?: number
+  [key: string]: any
+}
+
+// 缺口等待多久（毫秒）后请求补发
+export const GAP_TIMEOUT = 1000
+// 补发请求的最多次数，之后改为请求完整快照
+export const MAX_REPLAY_ATTEMPTS = 3
+// 重试间隔的上限（毫秒）
+export const MAX_GAP_DELAY = 10000
+
+export class EventSequencer {
+  // 已按序应用的最大序号，之前的事件都已应用
+  lastSeq: number | null = null
+  private pending = new Map<number, SequencedEvent>()
+  private gapTimer: ReturnType<typeof setTimeout> | null = null
+  // 从 replayFrom 开始的缺口已请求补发的次数
+  private replayAttempts = 0
+  private replayFrom: number | null = null
+
+  constructor(
+    private apply: (event: SequencedEvent) => void,
+    private requestReplay: (lastSeq: number) => void,
+    private requestResync: () => void,
+    private gapTimeout = GAP_TIMEOUT
+  ) {}
+
+  // 切换案件时清空
+  reset() {
+    this.lastSeq = null
+    this.pending.clear()
+    this.clearGapTimer()
+  }
+
+  handle(event: SequencedEvent) {
+    const seq = event.seq
+    if (typeof seq !== 'number') {
+      this.apply(event)
+      return
+    }
+
+    if (event.type === 'sync' || event.type === 'snapshot') {
+      // 快照已包含此前的全部修改
+      this.lastSeq = seq
+      this.apply(event)
+      this.drain()
+      return
+    }
+
+    if (this.lastSeq === null) {
+      this.lastSeq = seq
+      this.apply(event)
+      return
+    }
+
+    // 已应用或已暂存的事件（重连补发与实时广播重复）
+    if (seq <= this.lastSeq || this.pending.has(seq)) {
+      return
+    }
+
+    if (seq === this.lastSeq + 1) {
+      this.lastSeq = seq
+      this.apply(event)
+      this.drain()
+      return
+    }
+
+    this.pending.set(seq, event)
+    if (!this.gapTimer) {
+      this.scheduleGapCheck()
+    }
+  }
+
+  private scheduleGapCheck() {
+    const delay = Math.min(this.gapTimeout * 2 ** this.replayAttempts, MAX_GAP_DELAY)
+    this.gapTimer = setTimeout(() => this.checkGap(), delay)
+  }
+
+  private checkGap() {
+    this.gapTimer = null
+    if (!this.pending.size || this.lastSeq === null) {
+      return
+    }
+    // 上次请求之后缺口有进展时重新计数
+    if (this.replayFrom !== this.lastSeq) {
+      this.replayFrom = this.lastSeq
+      this.replayAttempts = 0
+    }
+    if (this.replayAttempts < MAX_REPLAY_ATTEMPTS) {
+      this.replayAttempts += 1
+      this.requestReplay(this.lastSeq)
+    } else {
+      this.requestResync()
+    }
+    this.scheduleGapCheck()
+  }
+
+  private drain() {
+    for (const seq of this.pending.keys()) {
+      if (this.lastSeq !== null && seq <= this.lastSeq) {
+        this.pending.delete(seq)
+      }
+    }
+    while (this.lastSeq !== null && this.pending.has(this.lastSeq + 1)) {
+      const next = this.pending.get(this.lastSeq + 1)!
+      this.pending.delete(this.lastSeq + 1)
+      this.lastSeq += 1
+      this.apply(next)
+    }
+    if (!this.pending.size) {
+      this.clearGapTimer()
+    }
+  }
+
+  private clearGapTimer() {
+    if (this.gapTimer) {
+      clearTimeout(this.gapTimer)
+      this.gapTimer = null
+    }
+    this.replayAttempts = 0
+    this.replayFrom = null
+  }
+}
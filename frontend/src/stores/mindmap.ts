@@ -1,6 +1,7 @@
 import { defineStore } from 'pinia'
 import { ref } from 'vue'
 import { mindmapAPI } from '@/api'
+import { EventSequencer } from './eventSequence'
 
 export interface MindMapNode {
   id: number
@@ -58,6 +59,8 @@ export const useMindMapStore = defineStore('mindmap', () => {
   
   // WebSocket 连接
   let websocket: WebSocket | null = null
+  // 按序号应用房间事件，重连同一案件时以已应用的最大序号请求补发错过的事件
+  let lastSeqProjectId: number | null = null
   const isConnected = ref(false)
   const onlineUsers = ref<string[]>([])
   
@@ -135,7 +138,7 @@ export const useMindMapStore = defineStore('mindmap', () => {
   const fetchEditLogs = async (projectId: number) => {
     try {
       const response = await mindmapAPI.getLogs(projectId)
-      editLogs.value = response.data
+      editLogs.value = response.data.results
       return response.data
     } catch (error) {
       throw error
@@ -159,7 +162,12 @@ export const useMindMapStore = defineStore('mindmap', () => {
       websocket.close()
     }
     
-    const wsUrl = `ws://localhost:8000/ws/mindmap/${projectId}/`
+    if (lastSeqProjectId !== projectId) {
+      sequencer.reset()
+      lastSeqProjectId = projectId
+    }
+    const query = sequencer.lastSeq !== null ? `?last_seq=${sequencer.lastSeq}` : ''
+    const wsUrl = `ws://localhost:8000/ws/mindmap/${projectId}/${query}`
     websocket = new WebSocket(wsUrl)
     
     websocket.onopen = () => {
@@ -182,8 +190,12 @@ export const useMindMapStore = defineStore('mindmap', () => {
     }
   }
   
-  // 处理WebSocket消息
+  // 处理WebSocket消息：带序号的事件乱序到达时暂存，缺口未能及时补齐则请求服务端补发
   const handleWebSocketMessage = (data: any) => {
+    sequencer.handle(data)
+  }
+  
+  const applyWebSocketMessage = (data: any) => {
     switch (data.type) {
       case 'node_created':
         // 添加新节点到列表
@@ -202,11 +214,72 @@ export const useMindMapStore = defineStore('mindmap', () => {
         // 删除节点
         nodes.value = nodes.value.filter(n => n.node_id !== data.node_id)
         break
+      case 'nodes_changed':
+        // 批量操作的合并结果
+        data.created.forEach((node: any) => {
+          if (!nodes.value.find(n => n.node_id === node.id)) {
+            nodes.value.push(node)
+          }
+        })
+        data.updated.forEach((node: any) => {
+          const index = nodes.value.findIndex(n => n.node_id === node.id)
+          if (index !== -1) {
+            nodes.value[index] = { ...nodes.value[index], ...node }
+          }
+        })
+        nodes.value = nodes.value.filter(n => !data.deleted.includes(n.node_id))
+        break
+      case 'conflict': {
+        // 修改基于的版本已过期，以服务端返回的当前状态为准
+        if (data.node) {
+          const index = nodes.value.findIndex(n => n.node_id === data.node.id)
+          if (index !== -1) {
+            nodes.value[index] = { ...nodes.value[index], ...data.node }
+          }
+        }
+        break
+      }
+      case 'snapshot':
+        // 错过的事件太多，以服务端的完整状态为准
+        nodes.value = data.nodes.map((node: any) => ({ ...node, node_id: node.id }))
+        break
       case 'online_users':
         onlineUsers.value = data.users
         break
-      case 'cursor_moved':
-        // 处理其他用户的光标移动
+      case 'user_joined':
+        if (!onlineUsers.value.includes(data.user)) {
+          onlineUsers.value.push(data.user)
+        }
+        break
+      case 'user_left':
+        onlineUsers.value = onlineUsers.value.filter((user: string) => user !== data.user)
+        break
+      case 'text_op': {
+        // 字符级文本操作：正整数保留、字符串插入、负整数删除（按码点计算长度）
+        const target = nodes.value.find(n => n.node_id === data.node_id)
+        const field = data.field as 'text' | 'note'
+        if (target) {
+          const chars = Array.from(String(target[field] ?? ''))
+          const result: string[] = []
+          let position = 0
+          for (const component of data.op) {
+            if (typeof component === 'string') {
+              result.push(component)
+            } else if (component > 0) {
+              result.push(...chars.slice(position, position + component))
+              position += component
+            } else {
+              position -= component
+            }
+          }
+          if (position === chars.length) {
+            target[field] = result.join('')
+          }
+        }
+        break
+      }
+      case 'cursors':
+        // 处理其他用户的光标移动（服务端按周期合并后批量推送）
         break
       case 'user_selected':
         // 处理其他用户的选择
@@ -224,6 +297,12 @@ export const useMindMapStore = defineStore('mindmap', () => {
     }
   }
   
+  const sequencer = new EventSequencer(
+    applyWebSocketMessage,
+    (lastSeq) => sendWebSocketMessage({ type: 'replay', last_seq: lastSeq }),
+    () => sendWebSocketMessage({ type: 'resync' })
+  )
+  
   // 断开WebSocket连接
   const disconnectWebSocket = () => {
     if (websocket) {